@@ -1,31 +1,56 @@
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
 import pyvisa
 
+from scpi_state import ShadowedInstrument
+
+
+def standard_error(values: np.ndarray) -> float:
+    if len(values) < 2:
+        return np.inf
+    return float(values.std(ddof=1) / np.sqrt(len(values)))
+
+
+def parse_bool(response: str) -> bool:
+    return bool(int(response))
 
-class NRP50S:
-    def __init__(self, resource_name: str):
-        rm = pyvisa.ResourceManager()
+
+def parse_str(response: str) -> str:
+    return response.strip().upper()
+
+
+class NRP50S(ShadowedInstrument):
+    def __init__(self, resource_name: str, rm: Optional[pyvisa.ResourceManager] = None):
+        rm = pyvisa.ResourceManager() if rm is None else rm
         self.dev = rm.open_resource(resource_name)
         self.dev.read_termination = "\n"
+        # commands from different threads (e.g. clients of the instrument server)
+        # must not interleave on the same session
+        self.lock = threading.RLock()
+        self._init_shadow(self.lock)
 
     def _query(self, command: str) -> str:
-        return self.dev.query(command)
+        with self.lock:
+            return self.dev.query(command)
 
     def _write(self, command: str):
-        self.dev.write(command)
+        with self.lock:
+            self.dev.write(command)
 
     @property
     def frequency(self) -> float:
-        return float(self._query("SENS:FREQ?"))
+        return self._get_setting("SENS:FREQ", float)
 
     @frequency.setter
     def frequency(self, frequency: float):
-        self._write(f"SENS:FREQ {frequency}")
-        assert frequency == self.frequency
+        self._set_setting("SENS:FREQ", float(frequency), float)
 
     @property
     def average(self) -> bool:
-        response = self._query("SENS:TRAC:AVER:STAT?")
-        return bool(int(response))
+        return self._get_setting("SENS:TRAC:AVER:STAT", parse_bool)
 
     @average.setter
     def average(self, state: bool):
@@ -33,20 +58,108 @@ class NRP50S:
             _state = "ON"
         else:
             _state = "OFF"
-        self._write(f"SENS:TRAC:AVER:STAT {_state}")
-        assert state == self.average
+        self._set_setting("SENS:TRAC:AVER:STAT", bool(state), parse_bool, _state)
 
     @property
     def average_count(self) -> int:
-        return self._query("SENS:TRAC:AVER:COUN?")
+        return self._get_setting("SENS:TRAC:AVER:COUN", int)
 
     @average_count.setter
     def average_count(self, count: int):
-        self._write(f"SENS:TRAC:AVER:COUN {count}")
-        assert count == self.average_count
+        self._set_setting("SENS:TRAC:AVER:COUN", int(count), int)
+
+    def reset(self):
+        self._write("*RST")
+        self.invalidate()
 
     def initiate(self):
         self._write("INIT")
 
     def fetch(self) -> float:
         return float(self._query("FETCH?"))
+
+    @property
+    def measuring(self) -> bool:
+        # bit 4 of the operation status register is set while a measurement runs
+        return bool(int(self._query("STAT:OPER:COND?")) & 16)
+
+    def wait(self, timeout: float = 10.0):
+        # *OPC? is answered once the measurement started by INIT is complete, the
+        # measuring bit may not be set yet right after INIT
+        with self.lock:
+            previous = self.dev.timeout
+            self.dev.timeout = timeout * 1e3
+            try:
+                self._query("*OPC?")
+            except pyvisa.errors.VisaIOError as e:
+                raise TimeoutError(
+                    f"NRP50S measurement not finished in {timeout} s"
+                ) from e
+            finally:
+                self.dev.timeout = previous
+
+    def fetch_buffer(self) -> np.ndarray:
+        return np.array(self._query("FETCH?").split(","), dtype=float)
+
+    def acquire(
+        self, count: int = 5, timeout: float = 10.0, averages: Optional[int] = None
+    ) -> np.ndarray:
+        # count readings in a single buffered acquisition, each the mean of averages
+        # measurements of the meter; the settings are only written when they change
+        # and verified together; no other thread uses the meter in between
+        with self.lock:
+            self.arm(count, averages=averages)
+            self.wait(timeout)
+            return self.fetch_buffer()
+
+    def arm(
+        self,
+        count: int,
+        source: str = "IMM",
+        delay: float = 0.0,
+        averages: Optional[int] = None,
+    ):
+        # start a buffered acquisition of count readings, with an external trigger
+        # source (e.g. "EXT1") one reading is taken delay seconds after each trigger;
+        # the averaging of the meter is left as it is without averages
+        with self.verify_after():
+            self._set_setting("TRIG:SOUR", source.upper(), parse_str)
+            self._set_setting("TRIG:DEL", float(delay), float, tolerance=1e-6)
+            self._set_setting("SENS:BUFF:SIZE", int(count), int)
+            self._set_setting("SENS:BUFF:STAT", True, parse_bool, "ON")
+            self._set_setting("TRIG:COUN", int(count), int)
+            if averages is not None:
+                average = averages > 1
+                self._set_setting("SENS:TRAC:AVER:COUN", int(averages), int)
+                self._set_setting(
+                    "SENS:TRAC:AVER:STAT",
+                    average,
+                    parse_bool,
+                    "ON" if average else "OFF",
+                )
+        self.initiate()
+
+    def measure(
+        self, count: int = 5, timeout: float = 10.0, averages: Optional[int] = None
+    ) -> Tuple[float, float]:
+        # mean and standard error of the mean of count readings
+        values = self.acquire(count, timeout, averages)
+        return float(values.mean()), standard_error(values)
+
+    def measure_until(
+        self,
+        target_error: float,
+        count: int = 5,
+        max_count: int = 100,
+        timeout: float = 10.0,
+        averages: Optional[int] = None,
+    ) -> Tuple[float, float, int]:
+        # acquire batches of count readings until the standard error of the mean
+        # drops below target_error or max_count readings are taken
+        values = np.empty(0)
+        while len(values) < max_count:
+            batch = min(count, max_count - len(values))
+            values = np.concatenate([values, self.acquire(batch, timeout, averages)])
+            if standard_error(values) <= target_error:
+                break
+        return float(values.mean()), standard_error(values), len(values)
@@ -1,17 +1,81 @@
-import pyvisa
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 
+import numpy as np
+import pyvisa
 
-class SPD3303X:
-    def __init__(self, resource: str):
-        self.rm = pyvisa.ResourceManager()
+from scpi_state import ShadowedInstrument
+
+
+@dataclass
+class SettleReport:
+    channel: int
+    voltage: float
+    tolerance: float
+    # [V], the tolerance near 0 V
+    abs_tolerance: float = 0.0
+    settled: bool = False
+    elapsed: float = 0.0
+    # (time [s], voltage [V], current [A]) for every poll, the current is only read
+    # with a current tolerance
+    samples: List[Tuple[float, float, float]] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        state = "settled" if self.settled else "did not settle"
+        last = ", ".join(
+            f"{t:.3f} s: {v:.3f} V" + ("" if math.isnan(i) else f" {i:.3f} A")
+            for t, v, i in self.samples[-5:]
+        )
+        return (
+            f"CH{self.channel} {state} at {self.voltage} V ±{self.tolerance:.0%}"
+            f" (at least {self.abs_tolerance * 1e3:.0f} mV) after"
+            f" {self.elapsed:.3f} s ({len(self.samples)} samples); last samples:"
+            f" {last}"
+        )
+
+
+class SettleError(Exception):
+    def __init__(self, report: SettleReport):
+        super().__init__(str(report))
+        self.report = report
+
+
+# telemetry of the two adjustable channels, time in s since epoch
+snapshot_dtype = np.dtype(
+    [("time", "f8")]
+    + [
+        (f"ch{channel}_{quantity}", "f4")
+        for channel in (1, 2)
+        for quantity in ("voltage", "current", "power")
+    ]
+)
+
+
+class SPD3303X(ShadowedInstrument):
+    # setpoints are not read back after writing, as before; SYST:ERR? is used to
+    # verify writes in verify_after blocks, the SPD3303X has no *OPC?
+    readback = False
+    opc = False
+
+    def __init__(self, resource: str, rm: Optional[pyvisa.ResourceManager] = None):
+        self.rm = pyvisa.ResourceManager() if rm is None else rm
         self.dev = self.rm.open_resource(resource_name=resource)
         self.dev.read_termination = "\n"
+        # commands from different threads (e.g. concurrent sequence steps) must not
+        # interleave on the same session
+        self.lock = threading.RLock()
+        self._init_shadow(self.lock)
 
     def _query(self, command: str) -> str:
-        return self.dev.query(command)
+        with self.lock:
+            return self.dev.query(command)
 
     def _write(self, command: str):
-        self.dev.write(command)
+        with self.lock:
+            self.dev.write(command)
 
     @property
     def idn(self):
@@ -21,36 +85,108 @@ class SPD3303X:
         self._write(f"*SAV{memory}")
 
     def voltage_setpoint(self, voltage: float, channel: int):
-        self._write(f"CH{channel}:VOLT {voltage}")
+        # 1 mV resolution; always written like the outputs, the gate pinch off of
+        # the stop sequences has to reach the supply even if the shadow is stale
+        self._set_setting(
+            f"CH{channel}:VOLT", float(voltage), float, tolerance=5e-4, force=True
+        )
 
     def current_setpoint(self, current: float, channel: int):
-        self._write(f"CH{channel}:CURR {current}")
+        self._set_setting(f"CH{channel}:CURR", float(current), float, tolerance=5e-4)
 
     def power(self, channel: int) -> float:
         return float(self._query(f"MEAS:POWE? CH{channel}"))
 
+    def voltage(self, channel: int) -> float:
+        return float(self._query(f"MEAS:VOLT? CH{channel}"))
+
+    def current(self, channel: int) -> float:
+        return float(self._query(f"MEAS:CURR? CH{channel}"))
+
+    def snapshot(self, measure_power: bool = False) -> np.void:
+        # voltage, current and power of channels 1 and 2 as one snapshot_dtype
+        # record. The power is computed from voltage and current unless
+        # measure_power, which saves a third of the transactions.
+        record = np.zeros((), dtype=snapshot_dtype)
+        record["time"] = time.time()
+        for channel in (1, 2):
+            voltage = self.voltage(channel)
+            current = self.current(channel)
+            record[f"ch{channel}_voltage"] = voltage
+            record[f"ch{channel}_current"] = current
+            record[f"ch{channel}_power"] = (
+                self.power(channel) if measure_power else voltage * current
+            )
+        return record[()]
+
     def output(self, on: bool, channel: int):
+        # always written, switching outputs off has to reach the supply even if this
+        # process thinks it is off already
         if on:
             state = "ON"
         else:
             state = "OFF"
         self._write(f"OUTP CH{channel},{state}")
 
+    def settle(
+        self,
+        channel: int,
+        voltage: float,
+        tolerance: float = 0.02,
+        current_tolerance: Optional[float] = None,
+        stable_samples: int = 3,
+        poll_interval: float = 0.05,
+        timeout: float = 2.0,
+        abs_tolerance: float = 0.01,
+    ) -> SettleReport:
+        # poll the measured voltage until it is within tolerance of the setpoint and
+        # stopped changing for stable_samples consecutive polls; raises SettleError
+        # with all samples on timeout. The tolerance is at least abs_tolerance [V], a
+        # switched off output reads a few mV. With a current_tolerance [A] the
+        # current has to be stable as well, loads with current ripple (fans,
+        # amplifier rails) would not settle with it
+        report = SettleReport(channel, voltage, tolerance, abs_tolerance)
+        band = max(tolerance * abs(voltage), abs_tolerance)
+        t_start = time.perf_counter()
+        while True:
+            t = time.perf_counter() - t_start
+            current = math.nan if current_tolerance is None else self.current(channel)
+            report.samples.append((t, self.voltage(channel), current))
+            report.elapsed = t
+
+            recent = report.samples[-stable_samples:]
+            if len(recent) == stable_samples:
+                voltages = [v for _, v, _ in recent]
+                currents = [i for _, _, i in recent]
+                in_tolerance = all(abs(v - voltage) <= band for v in voltages)
+                voltage_stable = max(voltages) - min(voltages) <= band
+                current_stable = (
+                    current_tolerance is None
+                    or max(currents) - min(currents) <= current_tolerance
+                )
+                if in_tolerance and voltage_stable and current_stable:
+                    report.settled = True
+                    return report
+
+            if t > timeout:
+                raise SettleError(report)
+            time.sleep(poll_interval)
+
     @property
     def ch1_power(self) -> float:
         return self.power(1)
 
     @property
     def ch1_voltage(self) -> float:
-        return float(self._query("MEAS:VOLT? CH1"))
+        return self.voltage(1)
 
     @property
     def ch1_current(self) -> float:
-        return float(self._query("MEAS:CURR? CH1"))
+        return self.current(1)
 
     @property
     def ch1_voltage_setpoint(self) -> float:
-        return float(self._query("CH1:VOLT?"))
+        return self._get_setting("CH1:VOLT", float)
 
     @ch1_voltage_setpoint.setter
     def ch1_voltage_setpoint(self, voltage: float):
@@ -58,7 +194,7 @@ class SPD3303X:
 
     @property
     def ch1_current_setpoint(self) -> float:
-        return float(self._query("CH1:CURR?"))
+        return self._get_setting("CH1:CURR", float)
 
     @ch1_current_setpoint.setter
     def ch1_current_setpoint(self, current: float):
@@ -70,15 +206,15 @@ class SPD3303X:
 
     @property
     def ch2_voltage(self) -> float:
-        return float(self._query("MEAS:VOLT? CH2"))
+        return self.voltage(2)
 
     @property
     def ch2_current(self) -> float:
-        return float(self._query("MEAS:CURR? CH2"))
+        return self.current(2)
 
     @property
     def ch2_voltage_setpoint(self) -> float:
-        return float(self._query("CH2:VOLT?"))
+        return self._get_setting("CH2:VOLT", float)
 
     @ch2_voltage_setpoint.setter
     def ch2_voltage_setpoint(self, voltage: float):
@@ -86,7 +222,7 @@ class SPD3303X:
 
     @property
     def ch2_current_setpoint(self) -> float:
-        return float(self._query("CH2:CURR?"))
+        return self._get_setting("CH2:CURR", float)
 
     @ch2_current_setpoint.setter
     def ch2_current_setpoint(self, current: float):
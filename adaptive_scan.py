@@ -0,0 +1,149 @@
+import heapq
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator, RegularGridInterpolator
+
+# cell: lattice index of the lower left corner and the size in lattice steps
+Cell = Tuple[int, int, int]
+
+
+class AdaptiveScan2D:
+    """
+    Scan measure(x, y) on a coarse grid and recursively split grid cells where the
+    measured cell center or edge midpoints deviate from the bilinear prediction of
+    the corners by more than tolerance, i.e. where the surface curves, e.g. the
+    compression knee of an amplifier. All points lie on a regular lattice refine_levels times finer
+    than the coarse grid.
+    """
+
+    def __init__(
+        self,
+        measure: Callable[[float, float], float],
+        x_range: Tuple[float, float],
+        y_range: Tuple[float, float],
+        coarse: Tuple[int, int] = (6, 6),
+        tolerance: float = 0.2,
+        refine_levels: int = 3,
+        max_points: Optional[int] = None,
+    ):
+        self.measure = measure
+        self.tolerance = tolerance
+        self.max_points = max_points
+        self.refine_levels = refine_levels
+
+        step = 2**refine_levels
+        self.shape = ((coarse[0] - 1) * step + 1, (coarse[1] - 1) * step + 1)
+        self.x = np.linspace(x_range[0], x_range[1], self.shape[0])
+        self.y = np.linspace(y_range[0], y_range[1], self.shape[1])
+        self.coarse_step = step
+
+        self.values: Dict[Tuple[int, int], float] = {}
+
+    def value(self, i: int, j: int) -> float:
+        if (i, j) not in self.values:
+            self.values[(i, j)] = float(self.measure(self.x[i], self.y[j]))
+        return self.values[(i, j)]
+
+    def cell_error(self, cell: Cell) -> float:
+        # largest deviation of the cell center and edge midpoints from the bilinear
+        # prediction of the corners; the midpoints are needed to split the cell anyway
+        i, j, size = cell
+        h = size // 2
+        z00, z10 = self.value(i, j), self.value(i + size, j)
+        z01, z11 = self.value(i, j + size), self.value(i + size, j + size)
+        deviations = [
+            self.value(i + h, j + h) - (z00 + z10 + z01 + z11) / 4,
+            self.value(i + h, j) - (z00 + z10) / 2,
+            self.value(i + h, j + size) - (z01 + z11) / 2,
+            self.value(i, j + h) - (z00 + z01) / 2,
+            self.value(i + size, j + h) - (z10 + z11) / 2,
+        ]
+        error = np.max(np.abs(deviations))
+        # failed readings (nan) don't drive refinement
+        return float(error) if np.isfinite(error) else 0.0
+
+    def budget_left(self, n_new: int) -> bool:
+        if self.max_points is None:
+            return True
+        return len(self.values) + n_new <= self.max_points
+
+    def run(self) -> "AdaptiveScan2D":
+        step = self.coarse_step
+        for i in range(0, self.shape[0], step):
+            for j in range(0, self.shape[1], step):
+                self.value(i, j)
+
+        # refine the cell with the largest error first, so a point budget is spent
+        # where it matters most
+        heap: List[Tuple[float, Cell]] = []
+        for i in range(0, self.shape[0] - 1, step):
+            for j in range(0, self.shape[1] - 1, step):
+                cell = (i, j, step)
+                heapq.heappush(heap, (-self.cell_error(cell), cell))
+
+        while heap:
+            error, (i, j, size) = heapq.heappop(heap)
+            if -error <= self.tolerance or size < 4:
+                continue
+            # each child needs a center and up to 4 edge midpoints
+            if not self.budget_left(16):
+                break
+            half = size // 2
+            for ci, cj in [(i, j), (i + half, j), (i, j + half), (i + half, j + half)]:
+                child = (ci, cj, half)
+                heapq.heappush(heap, (-self.cell_error(child), child))
+        return self
+
+    def points(self) -> np.ndarray:
+        # (x, y, measured) rows in x-major order, like the measurement CSVs
+        keys = sorted(self.values)
+        return np.array([(self.x[i], self.y[j], self.values[(i, j)]) for i, j in keys])
+
+    def interpolator(self) -> LinearNDInterpolator:
+        points = self.points()
+        return LinearNDInterpolator(points[:, :2], points[:, 2])
+
+    def to_grid(
+        self, x: Optional[Sequence[float]] = None, y: Optional[Sequence[float]] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # resample onto a regular grid (default: the full lattice) so the result can
+        # be used like the dense scans with RegularGridInterpolator
+        x = self.x if x is None else np.asarray(x)
+        y = self.y if y is None else np.asarray(y)
+        xx, yy = np.meshgrid(x, y, indexing="ij")
+        return x, y, self.interpolator()(xx, yy)
+
+    def grid_interpolator(self, **kwargs) -> RegularGridInterpolator:
+        x, y, z = self.to_grid()
+        return RegularGridInterpolator((x, y), z, **kwargs)
+
+    def to_csv(self, fname: str, header: Sequence[str], grid: bool = True):
+        # grid=True writes the resampled lattice, which calibration.py reads like a
+        # dense scan; grid=False writes only the measured points
+        if grid:
+            x, y, z = self.to_grid()
+            xx, yy = np.meshgrid(x, y, indexing="ij")
+            data = np.column_stack([xx.ravel(), yy.ravel(), z.ravel()])
+        else:
+            data = self.points()
+        np.savetxt(fname, data, delimiter=",", header=",".join(header), comments="")
+
+
+def synthhd_measure(
+    synthd, rf_out: int, power_meter, count: int = 5
+) -> Callable[[float, float], float]:
+    # measure(frequency [Hz], SynthHD power [dBm]) -> det power [dBm], only retunes
+    # the synthesizer and power meter frequency when it changes
+    state = dict(frequency=None)
+
+    def measure(frequency: float, power: float) -> float:
+        if frequency != state["frequency"]:
+            synthd[rf_out].frequency = frequency
+            power_meter.frequency = frequency
+            state["frequency"] = frequency
+        synthd[rf_out].power = power
+        mean, _ = power_meter.measure(count)
+        return mean
+
+    return measure
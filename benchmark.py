@@ -0,0 +1,382 @@
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from calibration import file_path, load_calibration
+from calibration_chain import load_calibration_chain
+from calibration_inverse import load_inverse_calibration
+from simulation import SimulatedBench, SimulationConfig
+
+# per machine, the lookup times depend on the CPU; not in the repository
+baseline_path = file_path / "benchmark_baseline.json"
+# increased when the simulated timings change, older baselines have to be saved
+# anew; 2: settle to 0 V within an absolute tolerance, no readback noise of
+# disabled outputs; 3: settle reads the voltage only
+baseline_version = 3
+
+# lower is better for all compared metrics; the transaction count of sequences
+# with polling loops varies with timing, so it gets the same relative threshold
+time_metrics = ["time", "per_point"]
+count_metrics = ["transactions"]
+
+
+@dataclass
+class BenchmarkOptions:
+    repeat: int = 3
+    # scales every simulated instrument latency, e.g. 0 to time only the code
+    latency_scale: float = 1.0
+    seed: int = 0
+
+
+Metrics = Dict[str, float]
+benchmarks: Dict[str, Callable[[BenchmarkOptions], Metrics]] = {}
+
+
+def benchmark(name: str):
+    def register(fn: Callable[[BenchmarkOptions], Metrics]):
+        benchmarks[name] = fn
+        return fn
+
+    return register
+
+
+def timed(fn: Callable[[], None], repeat: int, number: int = 1) -> List[float]:
+    # time per call [s] for each of repeat runs of number calls
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t_start) / number)
+    return times
+
+
+def summary(times: List[float], **metrics: float) -> Metrics:
+    return dict(
+        [("time", statistics.median(times)), ("time_min", min(times))], **metrics
+    )
+
+
+def simulated_bench(options: BenchmarkOptions) -> SimulatedBench:
+    config = SimulationConfig(seed=options.seed)
+    config = replace(
+        config,
+        supply_latency=config.supply_latency * options.latency_scale,
+        meter_latency=config.meter_latency * options.latency_scale,
+        synth_latency=config.synth_latency * options.latency_scale,
+        aperture=config.aperture * options.latency_scale,
+    )
+    return SimulatedBench(config)
+
+
+def supplies(bench: SimulatedBench) -> Tuple:
+    return tuple(
+        bench.open(name) for name in ["psu_vg_5pos", "psu_12pos_vd_5neg", "psu_a_5pos"]
+    )
+
+
+def run_simulated(
+    options: BenchmarkOptions,
+    setup: Callable[[SimulatedBench], None],
+    run: Callable[[SimulatedBench], None],
+    points: Optional[int] = None,
+) -> Metrics:
+    # fresh bench for every repetition, only run is timed and its transactions
+    # counted
+    times = []
+    transactions = 0
+    for _ in range(options.repeat):
+        bench = simulated_bench(options)
+        setup(bench)
+        bench.transactions.clear()
+        times += timed(lambda: run(bench), 1)
+        transactions = sum(bench.transactions.values())
+    metrics = summary(times, transactions=transactions)
+    if points is not None:
+        metrics["per_point"] = metrics["time"] / points
+    return metrics
+
+
+@benchmark("enable_all_power")
+def bench_enable_all_power(options: BenchmarkOptions) -> Metrics:
+    from start_all import enable_all_power
+
+    return run_simulated(
+        options, lambda bench: None, lambda bench: enable_all_power(*supplies(bench))
+    )
+
+
+@benchmark("disable_all_power")
+def bench_disable_all_power(options: BenchmarkOptions) -> Metrics:
+    from start_all import enable_all_power
+    from stop_all import disable_all_power
+
+    return run_simulated(
+        options,
+        lambda bench: enable_all_power(*supplies(bench)),
+        lambda bench: disable_all_power(*supplies(bench)),
+    )
+
+
+def vg_scan_setup(bench: SimulatedBench):
+    from startup_26GHz import enable_26GHz_power
+
+    psu_vg_5pos, psu_12pos_vd_5neg, _ = supplies(bench)
+    enable_26GHz_power(psu_vg_5pos, psu_12pos_vd_5neg)
+    bench.synthd[1].frequency = 13.3e9
+    bench.synthd[1].power = 0
+    bench.synthd[1].enable = True
+    bench.route = ("26_7", 0)
+
+
+@benchmark("vg_scan")
+def bench_vg_scan(options: BenchmarkOptions) -> Metrics:
+    # the Vg loop of scan_26GHz_power.py with a settled gate and a 5 reading
+    # power measurement per point
+    vg = np.linspace(1.5, 0.7, 11)
+
+    def run(bench: SimulatedBench):
+        psu_vg_5pos = bench.open("psu_vg_5pos")
+        power_meter = bench.open("power_meter")
+        power_meter.frequency = 26.7e9
+        for v in vg:
+            psu_vg_5pos.ch1_voltage_setpoint = v
+            psu_vg_5pos.settle(1, v)
+            power_meter.measure(5)
+
+    return run_simulated(options, vg_scan_setup, run, len(vg))
+
+
+@benchmark("synth_power_scan")
+def bench_synth_power_scan(options: BenchmarkOptions) -> Metrics:
+    setpoints = np.linspace(-30, 5, 36)
+
+    def setup(bench: SimulatedBench):
+        bench.synthd[1].frequency = 13.3e9
+        bench.synthd[1].enable = True
+
+    def run(bench: SimulatedBench):
+        power_meter = bench.open("power_meter")
+        power_meter.frequency = 13.3e9
+        for setpoint in setpoints:
+            bench.synthd[1].power = setpoint
+            power_meter.measure(5)
+
+    return run_simulated(options, setup, run, len(setpoints))
+
+
+def random_points(n: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-25, 0, n), rng.uniform(0.6, 1.4, n)
+
+
+@benchmark("load_calibration")
+def bench_load_calibration(options: BenchmarkOptions) -> Metrics:
+    # warm call as on every Streamlit rerun: stat the sources, hit the cache
+    load_calibration()
+    return summary(timed(load_calibration, options.repeat, 100))
+
+
+@benchmark("interpolator_single")
+def bench_interpolator_single(options: BenchmarkOptions) -> Metrics:
+    # per point lookup as done by the Streamlit app before CalibrationChain
+    calibration = load_calibration()
+    synth = calibration["synthesizers"]["SynthHD Pro SN416"]["RFB"]
+    amplifier = calibration["26_7"][0]
+
+    def run():
+        amplifier((synth((13.35e9, -5.0)), 0.8))
+
+    return summary(timed(run, options.repeat, 200))
+
+
+@benchmark("chain_single")
+def bench_chain_single(options: BenchmarkOptions) -> Metrics:
+    chain = load_calibration_chain("26_7")
+    return summary(
+        timed(lambda: chain("SN416", "RFB", -5.0, 0.8, 0), options.repeat, 200)
+    )
+
+
+@benchmark("chain_batched")
+def bench_chain_batched(options: BenchmarkOptions) -> Metrics:
+    chain = load_calibration_chain("26_7")
+    setpoint, vg = random_points(100_000, options.seed)
+    times = timed(lambda: chain("SN416", "RFB", setpoint, vg, 0), options.repeat)
+    return summary(times, per_point=statistics.median(times) / len(setpoint))
+
+
+@benchmark("fused_single")
+def bench_fused_single(options: BenchmarkOptions) -> Metrics:
+    chain = load_calibration_chain("26_7", fused=True)
+    return summary(
+        timed(lambda: chain("SN416", "RFB", -5.0, 0.8, 0), options.repeat, 200)
+    )
+
+
+@benchmark("fused_batched")
+def bench_fused_batched(options: BenchmarkOptions) -> Metrics:
+    chain = load_calibration_chain("26_7", fused=True)
+    setpoint, vg = random_points(100_000, options.seed)
+    times = timed(lambda: chain("SN416", "RFB", setpoint, vg, 0), options.repeat)
+    return summary(times, per_point=statistics.median(times) / len(setpoint))
+
+
+@benchmark("fitted_batched")
+def bench_fitted_batched(options: BenchmarkOptions) -> Metrics:
+    chain = load_calibration_chain("26_7", fitted=True)
+    setpoint, vg = random_points(100_000, options.seed)
+    times = timed(lambda: chain("SN416", "RFB", setpoint, vg, 0), options.repeat)
+    return summary(times, per_point=statistics.median(times) / len(setpoint))
+
+
+@benchmark("inverse_batched")
+def bench_inverse_batched(options: BenchmarkOptions) -> Metrics:
+    inverse = load_inverse_calibration("26_7")
+    targets = np.random.default_rng(options.seed).uniform(0, 25, 10_000)
+    times = timed(
+        lambda: inverse.setpoint(targets, "SN416", "RFB", 0.8, 0), options.repeat
+    )
+    return summary(times, per_point=statistics.median(times) / len(targets))
+
+
+def environment() -> Dict[str, str]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=file_path,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return dict(
+        [
+            ("commit", commit),
+            ("python", platform.python_version()),
+            ("numpy", np.__version__),
+            ("platform", platform.platform()),
+            ("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ]
+    )
+
+
+def run_benchmarks(
+    names: List[str], options: BenchmarkOptions, verbose: bool = False
+) -> Dict[str, Metrics]:
+    results: Dict[str, Metrics] = {}
+    for name in names:
+        results[name] = benchmarks[name](options)
+        if verbose:
+            metrics = results[name]
+            line = f"{name:<20} {metrics['time'] * 1e3:>12.4f} ms"
+            if "per_point" in metrics:
+                line += f" {metrics['per_point'] * 1e6:>12.3f} us/point"
+            if "transactions" in metrics:
+                line += f" {metrics['transactions']:>6.0f} transactions"
+            print(line)
+    return results
+
+
+def compare(
+    results: Dict[str, Metrics], baseline: Dict[str, Metrics], threshold: float
+) -> List[str]:
+    # regressions as readable lines, metrics may grow by threshold (relative)
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(name, {}).get(metric)
+            if reference is None:
+                continue
+            if metric in time_metrics and value > reference * (1 + threshold):
+                regressions.append(
+                    f"{name} {metric}: {value:.4g} s vs {reference:.4g} s"
+                    f" (+{value / reference - 1:.0%})"
+                )
+            elif metric in count_metrics and value > reference * (1 + threshold):
+                regressions.append(f"{name} {metric}: {value:.0f} vs {reference:.0f}")
+    return regressions
+
+
+def read_baseline(path: Path) -> Optional[Dict]:
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_baseline(path: Path, results: Dict[str, Metrics], options: BenchmarkOptions):
+    with open(path, "w") as f:
+        json.dump(
+            dict(
+                [
+                    ("version", baseline_version),
+                    ("environment", environment()),
+                    ("options", options.__dict__),
+                    ("results", results),
+                ]
+            ),
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark sequences, scans and calibration lookups"
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help=f"benchmarks to run, default all of {', '.join(benchmarks)}",
+    )
+    parser.add_argument("--baseline", type=Path, default=baseline_path)
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the new baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative slowdown flagged as a regression",
+    )
+    parser.add_argument("--repeat", type=int, default=BenchmarkOptions.repeat)
+    parser.add_argument(
+        "--latency-scale", type=float, default=BenchmarkOptions.latency_scale
+    )
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmarks {unknown}")
+    options = BenchmarkOptions(repeat=args.repeat, latency_scale=args.latency_scale)
+    results = run_benchmarks(args.names or list(benchmarks), options, verbose=True)
+
+    baseline = read_baseline(args.baseline)
+    regressions: List[str] = []
+    if baseline is not None and baseline.get("version", 1) != baseline_version:
+        print(
+            f"baseline {args.baseline} is from an older version of the benchmarks"
+            + ("" if args.save else ", run with --save to record a new one")
+        )
+    elif baseline is not None:
+        if baseline["options"] != options.__dict__:
+            print(f"options differ from the baseline {baseline['options']}")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"no regressions against {baseline['environment']['commit']}")
+
+    if args.save:
+        write_baseline(args.baseline, results, options)
+    sys.exit(1 if regressions else 0)
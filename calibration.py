@@ -0,0 +1,275 @@
+import argparse
+import hashlib
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator, interp1d
+
+file_path = Path(__file__).parent
+cache_path = file_path / "calibration.npz"
+
+# bump when the layout of the arrays or the corrections applied change, this
+# invalidates every entry in an existing calibration.npz
+format_version = 1
+
+# the amplifier scans were all driven by SynthHD Pro SN 416 RFB, the SynthHD dBm
+# setpoints are converted to real output power at the synthesizer frequency
+amplifier_synthesizer = "SN416_RFB"
+amplifier_synth_frequency = dict([("26_7", 13.3e9), ("40", 10e9)])
+# forgot to add 20 dBm to compensate attenuation from directional coupler in the
+# 40 GHz scans, the 26 GHz scans already include it
+coupler_offset = dict([("26_7", 0.0), ("40", 20.0)])
+
+# filename pattern -> calibration name
+calibration_patterns: List[Tuple[re.Pattern, Callable[[re.Match], str]]] = [
+    (
+        re.compile(r"_synthHDPro_SN(\d+)_(RF[AB])_scan\.csv$"),
+        lambda m: f"SN{m[1]}_{m[2]}",
+    ),
+    (re.compile(r"_synthpower_vg(\d)\.csv$"), lambda m: f"26_7_A{m[1]}"),
+    (re.compile(r"_a(\d)_synthd_power\.csv$"), lambda m: f"40_A{m[1]}"),
+]
+
+
+def file_date(fname: str) -> Tuple[int, ...]:
+    # filenames start with either 2023_2_9 or 2023_02_13 or 2023-02-11T12_58_09
+    match = re.match(r"(\d{4})[_-](\d{1,2})[_-](\d{1,2})", fname)
+    if match is None:
+        return ()
+    return tuple(int(m) for m in match.groups())
+
+
+def discover_calibration_files(path: Path = file_path) -> Dict[str, Path]:
+    # the most recent file wins if a calibration was repeated
+    found: Dict[str, Tuple[Tuple[int, ...], Path]] = {}
+    for fname in sorted(path.glob("measurements */data/*.csv")):
+        for pattern, calibration_name in calibration_patterns:
+            match = pattern.search(fname.name)
+            if match is None:
+                continue
+            name = calibration_name(match)
+            date = file_date(fname.name)
+            if name not in found or date >= found[name][0]:
+                found[name] = (date, fname)
+    return dict((name, fname) for name, (_, fname) in sorted(found.items()))
+
+
+def dependencies(name: str) -> List[str]:
+    if name.startswith("SN"):
+        return []
+    return [amplifier_synthesizer]
+
+
+def system(name: str) -> str:
+    return name.rsplit("_", 1)[0]
+
+
+def grid_1D(data: np.ndarray, indices: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    x, y = data.T[indices]
+    return x, y
+
+
+def grid_2D(
+    data: np.ndarray, indices: Sequence[int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    xs, ys, z = data.T[indices]
+    _, idx = np.unique(xs, return_index=True)
+    x = xs[np.sort(idx)]
+    _, idy = np.unique(ys, return_index=True)
+    y = ys[np.sort(idy)]
+    # rows in any order, e.g. one frequency sweep per power, but every grid point
+    # exactly once
+    ix = np.argmax(xs[:, None] == x, axis=1)
+    iy = np.argmax(ys[:, None] == y, axis=1)
+    counts = np.zeros((len(x), len(y)), dtype=int)
+    np.add.at(counts, (ix, iy), 1)
+    if np.any(counts != 1):
+        raise ValueError(
+            f"{np.count_nonzero(counts > 1)} duplicated and"
+            f" {np.count_nonzero(counts == 0)} missing points on a"
+            f" {len(x)} x {len(y)} grid"
+        )
+    grid = np.full((len(x), len(y)), np.nan)
+    grid[ix, iy] = z
+    return x, y, grid
+
+
+def interpolator_2D(
+    arrays: Dict[str, np.ndarray], name: str
+) -> RegularGridInterpolator:
+    return RegularGridInterpolator(
+        (arrays[f"{name}/x"], arrays[f"{name}/y"]), arrays[f"{name}/z"]
+    )
+
+
+def build_entry(
+    name: str, fname: Path, arrays: Dict[str, np.ndarray], path: Path = file_path
+) -> Dict[str, np.ndarray]:
+    # measurement_store imports this module
+    from measurement_store import read_source
+
+    data = read_source(fname, path)
+
+    # SynthHD: frequency [Hz], SynthHD setpoint [dBm] -> measured power [dBm]
+    if name.startswith("SN"):
+        x, y, z = grid_2D(data, [0, 1, 2])
+        return dict([("x", x), ("y", y), ("z", z)])
+
+    fn_synthesizer = interpolator_2D(arrays, amplifier_synthesizer)
+    synth_frequency = amplifier_synth_frequency[system(name)]
+
+    # 26.7 GHz: SynthHD setpoint [dBm], Vg [V] -> det power [dBm]
+    if system(name) == "26_7":
+        x, y, z = grid_2D(data, [0, 1, 2])
+        points = np.vstack([np.ones(len(x)) * synth_frequency, x]).T
+        z = z + coupler_offset[system(name)]
+        return dict([("x", fn_synthesizer(points)), ("y", y), ("z", z)])
+
+    # 40 GHz: SynthHD setpoint [dBm] -> det power [dBm]
+    x, y = grid_1D(data, [0, 1])
+    points = np.vstack([np.ones(len(x)) * synth_frequency, x]).T
+    y = y + coupler_offset[system(name)]
+    return dict([("x", fn_synthesizer(points)), ("y", y)])
+
+
+def entry_fingerprint(fname: Path, dependency_fingerprints: Sequence[str]) -> str:
+    sha = hashlib.sha1()
+    sha.update(str(format_version).encode())
+    sha.update(fname.read_bytes())
+    for fingerprint in dependency_fingerprints:
+        sha.update(fingerprint.encode())
+    return sha.hexdigest()
+
+
+def read_calibration(cache: Path = cache_path) -> Dict[str, np.ndarray]:
+    if not cache.exists():
+        return {}
+    with np.load(cache) as f:
+        if int(f["format_version"]) != format_version:
+            return {}
+        return dict((key, f[key]) for key in f.files if key != "format_version")
+
+
+def write_calibration(arrays: Dict[str, np.ndarray], cache: Path = cache_path):
+    # write to a temporary file first so a concurrent reader never sees a partial
+    # artifact
+    cache_tmp = cache.with_name(f"{cache.stem}.{os.getpid()}.tmp.npz")
+    np.savez(cache_tmp, format_version=np.array(format_version), **arrays)
+    os.replace(cache_tmp, cache)
+
+
+def build_calibration(
+    path: Path = file_path,
+    cache: Path = cache_path,
+    force: bool = False,
+    verbose: bool = False,
+) -> Dict[str, np.ndarray]:
+    files = discover_calibration_files(path)
+    existing = {} if force else read_calibration(cache)
+
+    arrays: Dict[str, np.ndarray] = {}
+    fingerprints: Dict[str, str] = {}
+    rebuilt = False
+    # synthesizers first, the amplifier entries depend on them
+    for name in sorted(files, key=lambda name: len(dependencies(name))):
+        fname = files[name]
+        fingerprint = entry_fingerprint(
+            fname, [fingerprints[dep] for dep in dependencies(name)]
+        )
+        fingerprints[name] = fingerprint
+
+        if str(existing.get(f"{name}/fingerprint", "")) == fingerprint:
+            entry = dict(
+                (key.split("/", 1)[1], value)
+                for key, value in existing.items()
+                if key.split("/", 1)[0] == name
+            )
+            status = "up to date"
+        else:
+            entry = build_entry(name, fname, arrays, path)
+            entry["fingerprint"] = np.array(fingerprint)
+            entry["source"] = np.array(str(fname.relative_to(path).as_posix()))
+            rebuilt = True
+            status = "rebuilt"
+
+        for key, value in entry.items():
+            arrays[f"{name}/{key}"] = value
+        if verbose:
+            print(f"{name:<10} {status:<11} {fname.relative_to(path).as_posix()}")
+
+    if rebuilt or set(arrays) != set(existing):
+        write_calibration(arrays, cache)
+    return arrays
+
+
+def interpolators(
+    arrays: Dict[str, np.ndarray],
+) -> Dict[str, Union[RegularGridInterpolator, interp1d]]:
+    names = sorted(key.split("/")[0] for key in arrays if key.endswith("/x"))
+    fns: Dict[str, Union[RegularGridInterpolator, interp1d]] = {}
+    for name in names:
+        if f"{name}/z" in arrays:
+            fns[name] = interpolator_2D(arrays, name)
+        else:
+            fns[name] = interp1d(arrays[f"{name}/x"], arrays[f"{name}/y"])
+    return fns
+
+
+def source_stat_key(path: Path = file_path) -> Tuple:
+    # a stat per file is cheap enough to do on every Streamlit rerun
+    stat_key = []
+    for fname in discover_calibration_files(path).values():
+        stat = fname.stat()
+        stat_key.append((str(fname), stat.st_mtime_ns, stat.st_size))
+    return tuple(stat_key)
+
+
+@lru_cache(maxsize=1)
+def _load_calibration_arrays(stat_key: Tuple, path: Path) -> Dict[str, np.ndarray]:
+    return build_calibration(path)
+
+
+def load_calibration_arrays(path: Path = file_path) -> Dict[str, np.ndarray]:
+    # the arrays are kept in memory until one of the source files changes
+    return _load_calibration_arrays(source_stat_key(path), path)
+
+
+@lru_cache(maxsize=1)
+def _load_calibration(stat_key: Tuple, path: Path) -> Dict:
+    fns = interpolators(load_calibration_arrays(path))
+    synthesizers: Dict[str, Dict] = {}
+    for name, fn in fns.items():
+        if name.startswith("SN"):
+            serial, output = name.split("_")
+            synthesizers.setdefault(f"SynthHD Pro {serial}", {})[output] = fn
+    return dict(
+        [
+            ("26_7", (fns["26_7_A1"], fns["26_7_A2"])),
+            ("40", (fns["40_A1"], fns["40_A2"])),
+            ("synthesizers", synthesizers),
+        ]
+    )
+
+
+def load_calibration(path: Path = file_path) -> Dict:
+    # the interpolators are kept in memory until one of the source files changes
+    return _load_calibration(source_stat_key(path), path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build calibration.npz from the measurement CSVs"
+    )
+    parser.add_argument(
+        "--output", type=Path, default=cache_path, help="calibration file to write"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="rebuild all entries from scratch"
+    )
+    args = parser.parse_args()
+
+    build_calibration(file_path, args.output, force=args.force, verbose=True)
@@ -0,0 +1,370 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+from scipy.interpolate import RegularGridInterpolator, interp1d
+
+from calibration import file_path, load_calibration_arrays, source_stat_key
+from calibration_fit import LinearFit, load_fits
+from calibration_temperature import TemperatureModel, load_temperature_model
+
+# the SynthHD runs at half (26.7 GHz doubler) or a quarter (40 GHz quadrupler) of the
+# system frequency
+synth_frequencies = dict([("26_7", 26.7e9 / 2), ("40", 40e9 / 4)])
+
+
+def synth_key(synth: str, output: str) -> str:
+    # accept both "SN415" and the "SynthHD Pro SN415" labels used in the app
+    return f"{synth.rsplit(' ', 1)[-1]}_{output}"
+
+
+def bilinear_uniform(
+    tables: np.ndarray,
+    index: np.ndarray,
+    x0: float,
+    dx: float,
+    y0: float,
+    dy: float,
+    x: np.ndarray,
+    y: np.ndarray,
+) -> np.ndarray:
+    # bilinear interpolation in tables[index] on a uniformly spaced grid, the cell
+    # follows from the spacing so no search is needed; nan outside of the grid
+    _, nx, ny = tables.shape
+    fx = (x - x0) / dx
+    fy = (y - y0) / dy if ny > 1 else np.zeros_like(fx)
+    valid = (fx >= 0) & (fx <= nx - 1) & (fy >= 0) & (fy <= ny - 1)
+    ix = np.clip(np.floor(fx).astype(np.intp), 0, max(nx - 2, 0))
+    iy = np.clip(np.floor(fy).astype(np.intp), 0, max(ny - 2, 0))
+    tx = fx - ix
+    ty = fy - iy
+    ix1 = np.minimum(ix + 1, nx - 1)
+    iy1 = np.minimum(iy + 1, ny - 1)
+    z = (
+        tables[index, ix, iy] * (1 - tx) * (1 - ty)
+        + tables[index, ix1, iy] * tx * (1 - ty)
+        + tables[index, ix, iy1] * (1 - tx) * ty
+        + tables[index, ix1, iy1] * tx * ty
+    )
+    return np.where(valid, z, np.nan)
+
+
+class CalibrationChain:
+    """
+    Synthesizer setpoint -> real synthesizer output power -> amplifier output power
+    for one system (26.7 GHz or 40 GHz). All inputs broadcast against each other,
+    points outside of the calibrated range evaluate to nan.
+
+    With a temperature model, a SynthHD temperature [C] passed to the lookups is
+    applied as a setpoint offset relative to the calibration temperature.
+
+    With fits (calibration_fit), the compact piecewise linear fits replace the
+    interpolation of the grids, within their max_error, and amplifier_gradient
+    becomes available.
+    """
+
+    def __init__(
+        self,
+        arrays: Dict[str, np.ndarray],
+        system: str,
+        synth_frequency: Optional[float] = None,
+        fits: Optional[Dict[str, LinearFit]] = None,
+    ):
+        self.system = system
+        self.has_vg = f"{system}_A1/z" in arrays
+        self.fitted = fits is not None
+        self.synth_frequency = (
+            synth_frequencies[system] if synth_frequency is None else synth_frequency
+        )
+
+        self.synthesizers: Dict[str, Union[RegularGridInterpolator, LinearFit]] = {}
+        for key in arrays:
+            name, field = key.split("/", 1)
+            if name.startswith("SN") and field == "z":
+                if fits is not None:
+                    self.synthesizers[name] = fits[name]
+                    continue
+                self.synthesizers[name] = RegularGridInterpolator(
+                    (arrays[f"{name}/x"], arrays[f"{name}/y"]),
+                    arrays[f"{name}/z"],
+                    bounds_error=False,
+                    fill_value=np.nan,
+                )
+
+        self.amplifiers: List[Union[RegularGridInterpolator, interp1d, LinearFit]] = []
+        for name in [f"{system}_A1", f"{system}_A2"]:
+            if fits is not None:
+                self.amplifiers.append(fits[name])
+            elif f"{name}/z" in arrays:
+                self.amplifiers.append(
+                    RegularGridInterpolator(
+                        (arrays[f"{name}/x"], arrays[f"{name}/y"]),
+                        arrays[f"{name}/z"],
+                        bounds_error=False,
+                        fill_value=np.nan,
+                    )
+                )
+            else:
+                self.amplifiers.append(
+                    interp1d(
+                        arrays[f"{name}/x"],
+                        arrays[f"{name}/y"],
+                        bounds_error=False,
+                        fill_value=np.nan,
+                    )
+                )
+
+        self.synth_names = sorted(self.synthesizers)
+
+        # synth, amplifier, setpoint, vg
+        self.fused: Optional[np.ndarray] = None
+        self.fused_setpoints: np.ndarray = np.array([])
+        self.fused_vg: np.ndarray = np.array([])
+
+        self.temperature_model: Optional[TemperatureModel] = None
+
+    @property
+    def vg_range(self) -> Tuple[float, float]:
+        if not self.has_vg:
+            raise ValueError(f"the {self.system} amplifiers have no gate voltage")
+        vg = self.amplifiers[0].grid[1]
+        return float(vg.min()), float(vg.max())
+
+    def synth_index(self, synth: npt.ArrayLike, output: npt.ArrayLike) -> np.ndarray:
+        # index into self.synth_names per point, string comparisons only happen on
+        # the unique values
+        synths, synth_inverse = np.unique(np.asarray(synth), return_inverse=True)
+        outputs, output_inverse = np.unique(np.asarray(output), return_inverse=True)
+        lookup = np.array(
+            [
+                [
+                    (
+                        self.synth_names.index(synth_key(s, o))
+                        if synth_key(s, o) in self.synth_names
+                        else -1
+                    )
+                    for o in outputs.tolist()
+                ]
+                for s in synths.tolist()
+            ],
+            dtype=np.intp,
+        )
+        index = lookup[
+            synth_inverse.reshape(np.shape(synth)),
+            output_inverse.reshape(np.shape(output)),
+        ]
+        if np.any(index < 0):
+            missing = sorted(
+                set(
+                    synth_key(s, o)
+                    for s, o in np.broadcast(synth, output)
+                    if synth_key(s, o) not in self.synth_names
+                )
+            )
+            raise ValueError(f"no synthesizer calibration for {', '.join(missing)}")
+        return index
+
+    def temperature_offset(
+        self,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        temperature: npt.ArrayLike,
+    ) -> np.ndarray:
+        # setpoint offset [dB] of the synthesizer outputs at temperature [C]
+        if self.temperature_model is None:
+            raise ValueError("no temperature model, set chain.temperature_model")
+        # keys are only built for the unique synthesizers and outputs
+        synths, synth_inverse = np.unique(np.asarray(synth), return_inverse=True)
+        outputs, output_inverse = np.unique(np.asarray(output), return_inverse=True)
+        rows = self.temperature_model.index(
+            [[synth_key(s, o) for o in outputs.tolist()] for s in synths.tolist()]
+        )
+        index = rows[
+            synth_inverse.reshape(np.shape(synth)),
+            output_inverse.reshape(np.shape(output)),
+        ]
+        return self.temperature_model.evaluate(index, temperature)
+
+    def effective_setpoint(
+        self,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        setpoint: npt.ArrayLike,
+        temperature: Optional[npt.ArrayLike],
+    ) -> np.ndarray:
+        setpoint = np.asarray(setpoint, dtype=float)
+        if temperature is None:
+            return setpoint
+        return setpoint + self.temperature_offset(synth, output, temperature)
+
+    def synth_power(
+        self,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        setpoint: npt.ArrayLike,
+        temperature: Optional[npt.ArrayLike] = None,
+    ) -> np.ndarray:
+        setpoint = self.effective_setpoint(synth, output, setpoint, temperature)
+        index, setpoint = np.broadcast_arrays(self.synth_index(synth, output), setpoint)
+        result = np.full(setpoint.shape, np.nan)
+        for idx in np.unique(index):
+            mask = index == idx
+            points = np.empty((np.count_nonzero(mask), 2))
+            points[:, 0] = self.synth_frequency
+            points[:, 1] = setpoint[mask]
+            result[mask] = self.synthesizers[self.synth_names[idx]](points)
+        return result
+
+    def amplifier_power(
+        self,
+        input_power: npt.ArrayLike,
+        vg: Optional[npt.ArrayLike] = None,
+        amplifier: npt.ArrayLike = 0,
+    ) -> np.ndarray:
+        if self.has_vg and vg is None:
+            raise ValueError(f"the {self.system} amplifiers require a gate voltage")
+        input_power, vg, amplifier = np.broadcast_arrays(
+            np.asarray(input_power, dtype=float),
+            np.asarray(0.0 if vg is None else vg, dtype=float),
+            np.asarray(amplifier, dtype=np.intp),
+        )
+        result = np.full(input_power.shape, np.nan)
+        for idx in np.unique(amplifier):
+            mask = amplifier == idx
+            if self.has_vg:
+                points = np.empty((np.count_nonzero(mask), 2))
+                points[:, 0] = input_power[mask]
+                points[:, 1] = vg[mask]
+                result[mask] = self.amplifiers[idx](points)
+            else:
+                result[mask] = self.amplifiers[idx](input_power[mask])
+        return result
+
+    def amplifier_gradient(
+        self,
+        input_power: npt.ArrayLike,
+        vg: npt.ArrayLike,
+        amplifier: npt.ArrayLike = 0,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (d output / d input [dB/dB], d output / d Vg [dB/V]) of the fitted
+        # 26.7 GHz amplifiers
+        if not self.fitted or not self.has_vg:
+            raise ValueError("gradients need the fitted 26.7 GHz calibration")
+        input_power, vg, amplifier = np.broadcast_arrays(
+            np.asarray(input_power, dtype=float),
+            np.asarray(vg, dtype=float),
+            np.asarray(amplifier, dtype=np.intp),
+        )
+        d_input = np.full(input_power.shape, np.nan)
+        d_vg = np.full(input_power.shape, np.nan)
+        for idx in np.unique(amplifier):
+            mask = amplifier == idx
+            d_input[mask], d_vg[mask] = self.amplifiers[idx].gradient(
+                input_power[mask], vg[mask]
+            )
+        return d_input, d_vg
+
+    def __call__(
+        self,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        setpoint: npt.ArrayLike,
+        vg: Optional[npt.ArrayLike] = None,
+        amplifier: npt.ArrayLike = 0,
+        temperature: Optional[npt.ArrayLike] = None,
+    ) -> np.ndarray:
+        setpoint = self.effective_setpoint(synth, output, setpoint, temperature)
+        if self.fused is not None:
+            return self._evaluate_fused(synth, output, setpoint, vg, amplifier)
+        return self.amplifier_power(
+            self.synth_power(synth, output, setpoint), vg, amplifier
+        )
+
+    def fuse(
+        self,
+        setpoints: np.ndarray = np.linspace(-30, 5, 351),
+        vg: Optional[np.ndarray] = None,
+    ) -> "CalibrationChain":
+        """
+        Precompute setpoint -> amplifier output tables for every synthesizer output
+        and amplifier. Subsequent calls interpolate in these tables directly, which
+        is accurate to the resolution of the uniformly spaced setpoints and vg.
+        """
+        if not np.allclose(np.diff(setpoints), setpoints[1] - setpoints[0]):
+            raise ValueError("fused setpoints must be uniformly spaced")
+        if self.has_vg:
+            if vg is None:
+                vg_min, vg_max = self.vg_range
+                vg = np.linspace(vg_min, vg_max, len(self.amplifiers[0].grid[1]))
+            if not np.allclose(np.diff(vg), vg[1] - vg[0]):
+                raise ValueError("fused gate voltages must be uniformly spaced")
+        else:
+            vg = np.zeros(1)
+
+        self.fused = None
+        fused = np.empty(
+            (len(self.synth_names), len(self.amplifiers), len(setpoints), len(vg))
+        )
+        sp, v = np.meshgrid(setpoints, vg, indexing="ij")
+        for ids, key in enumerate(self.synth_names):
+            synth, output = key.split("_")
+            for ida in range(len(self.amplifiers)):
+                fused[ids, ida] = self(
+                    synth, output, sp, v if self.has_vg else None, ida
+                )
+        self.fused = fused
+        self.fused_setpoints = np.asarray(setpoints, dtype=float)
+        self.fused_vg = np.asarray(vg, dtype=float)
+        return self
+
+    def _evaluate_fused(
+        self,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        setpoint: npt.ArrayLike,
+        vg: Optional[npt.ArrayLike],
+        amplifier: npt.ArrayLike,
+    ) -> np.ndarray:
+        assert self.fused is not None
+        if self.has_vg and vg is None:
+            raise ValueError(f"the {self.system} amplifiers require a gate voltage")
+        index, amplifier, setpoint, vg = np.broadcast_arrays(
+            self.synth_index(synth, output),
+            np.asarray(amplifier, dtype=np.intp),
+            np.asarray(setpoint, dtype=float),
+            np.asarray(0.0 if vg is None else vg, dtype=float),
+        )
+        n_synth, n_amplifier, n_setpoint, n_vg = self.fused.shape
+        return bilinear_uniform(
+            self.fused.reshape(n_synth * n_amplifier, n_setpoint, n_vg),
+            index * n_amplifier + amplifier,
+            self.fused_setpoints[0],
+            self.fused_setpoints[1] - self.fused_setpoints[0],
+            self.fused_vg[0],
+            self.fused_vg[1] - self.fused_vg[0] if n_vg > 1 else 1.0,
+            setpoint,
+            vg,
+        )
+
+
+@lru_cache(maxsize=4)
+def _load_calibration_chain(
+    stat_key: Tuple, system: str, path: Path, fused: bool, fitted: bool
+) -> CalibrationChain:
+    chain = CalibrationChain(
+        load_calibration_arrays(path), system, fits=load_fits(path) if fitted else None
+    )
+    if fused:
+        chain.fuse()
+    return chain
+
+
+def load_calibration_chain(
+    system: str, path: Path = file_path, fused: bool = False, fitted: bool = False
+) -> CalibrationChain:
+    chain = _load_calibration_chain(source_stat_key(path), system, path, fused, fitted)
+    # refitted separately when the monitoring files change
+    chain.temperature_model = load_temperature_model(path)
+    return chain
@@ -0,0 +1,406 @@
+import argparse
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from calibration import file_path, load_calibration_arrays, source_stat_key
+
+fit_path = file_path / "calibration_fit.npz"
+
+# bump when the fit changes, this refits every entry in an existing
+# calibration_fit.npz
+format_version = 2
+
+
+def greedy_knots(y: np.ndarray, z: np.ndarray, tolerance: float) -> np.ndarray:
+    # fewest grid points, added one at a time at the largest deviation, whose
+    # linear interpolation is within tolerance of every point of z
+    keep = np.zeros(len(y), dtype=bool)
+    keep[[0, -1]] = True
+    while True:
+        error = np.abs(np.interp(y, y[keep], z[keep]) - z)
+        worst = int(np.argmax(error))
+        if error[worst] <= tolerance:
+            return np.flatnonzero(keep)
+        keep[worst] = True
+
+
+class Axis:
+    """
+    Grid cell and position in it of points on an ascending calibration axis. On
+    uniform axes the cell follows from the spacing, on the others (the amplifier
+    input powers) a lookup table of the cell at every multiple of the smallest step
+    finds it in constant time.
+    """
+
+    def __init__(self, points: npt.ArrayLike):
+        self.points = np.asarray(points, dtype=float)
+        self.n = len(self.points)
+        self.lower, self.upper = float(self.points[0]), float(self.points[-1])
+        self.steps = np.diff(self.points)
+        self.uniform = bool(
+            np.allclose(self.steps, self.steps.mean(), rtol=1e-6, atol=0)
+        )
+        # a bucket of the lookup table holds at most one grid point
+        self.lut_dx = float(self.steps.mean() if self.uniform else self.steps.min())
+        n_lut = int(np.ceil((self.upper - self.lower) / self.lut_dx)) + 1
+        lut = self.lower + self.lut_dx * np.arange(n_lut)
+        self.lut = np.clip(
+            np.searchsorted(self.points, lut, "right") - 1, 0, self.n - 2
+        )
+
+    def cell(self, v: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (cell, position in the cell in [0, 1], inside the axis)
+        valid = (v >= self.lower) & (v <= self.upper)
+        with np.errstate(invalid="ignore"):
+            f = (v - self.lower) / self.lut_dx
+            bucket = np.clip(f, 0, len(self.lut) - 1).astype(np.intp)
+        if self.uniform:
+            cell = np.minimum(bucket, self.n - 2)
+            return cell, f - cell, valid
+        cell = np.take(self.lut, bucket)
+        cell += v >= np.take(self.points, cell + 1)
+        cell = np.minimum(cell, self.n - 2)
+        t = (v - np.take(self.points, cell)) / np.take(self.steps, cell)
+        return cell, t, valid
+
+
+class KnotRows:
+    """
+    Piecewise linear functions of y, one per row, stored as the grid indices of
+    their knots and the values there. segment maps (row, grid cell) to the knot
+    starting the line through the cell, so an evaluation is a few gathers.
+    """
+
+    def __init__(
+        self,
+        y: npt.ArrayLike,
+        offsets: np.ndarray,
+        knots: np.ndarray,
+        values: np.ndarray,
+    ):
+        self.axis = Axis(y)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        self.knots = np.asarray(knots, dtype=np.intp)
+        self.values = np.asarray(values, dtype=float)
+        self.knot_y = self.axis.points[self.knots]
+        # the last knot of a row starts no line
+        starts = np.ones(len(self.knots), dtype=bool)
+        starts[self.offsets[1:] - 1] = False
+        self.slope = np.zeros(len(self.knots))
+        self.slope[starts] = (self.values[1:] - self.values[:-1])[starts[:-1]] / (
+            self.knot_y[1:] - self.knot_y[:-1]
+        )[starts[:-1]]
+        cells = np.arange(self.axis.n - 1)
+        # flat, [row * (n - 1) + cell]
+        self.segment = np.concatenate(
+            [
+                self.offsets[row]
+                + np.searchsorted(
+                    self.knots[self.offsets[row] : self.offsets[row + 1]],
+                    cells,
+                    "right",
+                )
+                - 1
+                for row in range(self.n_rows)
+            ]
+        )
+
+    @classmethod
+    def table(cls, y: np.ndarray, z: np.ndarray) -> "KnotRows":
+        # every grid point a knot, exactly the linear interpolation of z
+        n_rows, n = z.shape
+        offsets = np.arange(n_rows + 1) * n
+        return cls(y, offsets, np.tile(np.arange(n), n_rows), z.ravel())
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.axis.points
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.offsets) - 1
+
+    def evaluate(
+        self, row: np.ndarray, cell: np.ndarray, y: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (value, d value / d y) of rows at y in grid cells of y
+        k = np.take(self.segment, row * (self.axis.n - 1) + cell)
+        slope = np.take(self.slope, k)
+        return np.take(self.values, k) + (y - np.take(self.knot_y, k)) * slope, slope
+
+    def grid_values(self) -> np.ndarray:
+        # rows evaluated at the grid points of y
+        n = self.axis.n
+        rows = np.repeat(np.arange(self.n_rows), n)
+        cells = np.tile(np.minimum(np.arange(n), n - 2), self.n_rows)
+        return self.evaluate(rows, cells, np.tile(self.y, self.n_rows))[0].reshape(
+            self.n_rows, n
+        )
+
+
+def fit_rows(
+    y: np.ndarray, z: np.ndarray, tolerance: float, max_fraction: float
+) -> Tuple[KnotRows, bool]:
+    # (rows, fitted), the table if the knots of all rows exceed max_fraction of
+    # the grid points
+    found = []
+    budget = int(max_fraction * z.size)
+    for row in z:
+        knots = greedy_knots(y, row, tolerance)
+        budget -= len(knots)
+        if budget < 0:
+            return KnotRows.table(y, z), False
+        found.append(knots)
+    offsets = np.concatenate([[0], np.cumsum([len(knots) for knots in found])])
+    knots = np.concatenate(found)
+    rows = np.repeat(np.arange(len(z)), np.diff(offsets))
+    return KnotRows(y, offsets, knots, z[rows, knots]), True
+
+
+def ascending(
+    points: np.ndarray, z: np.ndarray, axis: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # descending axes (the gate voltages) are flipped
+    if points[0] > points[-1]:
+        return points[::-1], np.flip(z, axis)
+    return points, z
+
+
+class LinearFit1D:
+    """
+    Piecewise linear fit to a 1D calibration on a subset of its points. nan outside
+    of the calibrated range. The knots are grid points, so max_error, the largest
+    deviation from the raw data, bounds the deviation from its linear
+    interpolation everywhere. fitted is False for the table kept when the bound
+    needs too many knots.
+    """
+
+    def __init__(self, rows: KnotRows, max_error: float, rms: float, fitted: bool):
+        self.rows = rows
+        self.max_error = float(max_error)
+        self.rms = float(rms)
+        self.fitted = fitted
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.rows.y
+
+    @property
+    def size(self) -> int:
+        return len(self.rows.knots)
+
+    def __call__(self, x: npt.ArrayLike, derivative: int = 0) -> np.ndarray:
+        x = np.asarray(x, dtype=float)
+        flat = x.ravel()
+        cell, _, valid = self.rows.axis.cell(flat)
+        value, slope = self.rows.evaluate(np.zeros_like(cell), cell, flat)
+        if derivative == 1:
+            value = slope
+        elif derivative:
+            raise ValueError("only the first derivative is supported")
+        return np.where(valid, value, np.nan).reshape(x.shape)
+
+
+class LinearFit2D:
+    """
+    Fit to a 2D calibration grid, piecewise linear in y on a subset of the grid
+    points of every x row and linear in x between the rows. It is bilinear in every
+    grid cell like the RegularGridInterpolator it replaces, so max_error, the
+    largest deviation from the raw data, bounds the deviation from its bilinear
+    interpolation everywhere. Called with points like the interpolator, grid
+    holds the calibrated axes, ascending.
+    """
+
+    def __init__(
+        self,
+        x: npt.ArrayLike,
+        rows: KnotRows,
+        max_error: float,
+        rms: float,
+        fitted: bool,
+    ):
+        self.axis = Axis(x)
+        self.rows = rows
+        self.max_error = float(max_error)
+        self.rms = float(rms)
+        self.fitted = fitted
+        self.grid = (self.axis.points, self.rows.y)
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.axis.points
+
+    @property
+    def size(self) -> int:
+        return len(self.rows.knots)
+
+    def _rows(self, x: npt.ArrayLike, y: npt.ArrayLike) -> Tuple[np.ndarray, ...]:
+        # values and y slopes of the rows around the points, x cell positions and
+        # steps, inside the grid, shape
+        x, y = np.broadcast_arrays(
+            np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        )
+        shape = x.shape
+        x, y = x.ravel(), y.ravel()
+        ix, tx, valid_x = self.axis.cell(x)
+        iy, _, valid_y = self.rows.axis.cell(y)
+        v0, s0 = self.rows.evaluate(ix, iy, y)
+        v1, s1 = self.rows.evaluate(ix + 1, iy, y)
+        step = np.take(self.axis.steps, ix)
+        return v0, s0, v1, s1, tx, step, valid_x & valid_y, shape
+
+    def __call__(self, points: npt.ArrayLike) -> np.ndarray:
+        points = np.asarray(points, dtype=float)
+        v0, _, v1, _, tx, _, valid, shape = self._rows(points[..., 0], points[..., 1])
+        return np.where(valid, v0 + tx * (v1 - v0), np.nan).reshape(shape)
+
+    def gradient(
+        self, x: npt.ArrayLike, y: npt.ArrayLike
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (d value / d x, d value / d y), constant along x in a grid cell
+        v0, s0, v1, s1, tx, step, valid, shape = self._rows(x, y)
+        dx = np.where(valid, (v1 - v0) / step, np.nan).reshape(shape)
+        dy = np.where(valid, s0 + tx * (s1 - s0), np.nan).reshape(shape)
+        return dx, dy
+
+
+LinearFit = Union[LinearFit1D, LinearFit2D]
+
+
+def fit_entry(
+    arrays: Dict[str, np.ndarray],
+    name: str,
+    tolerance: float = 0.1,
+    max_fraction: float = 0.75,
+) -> LinearFit:
+    x, y = arrays[f"{name}/x"], arrays[f"{name}/y"]
+    two_d = f"{name}/z" in arrays
+    if two_d:
+        x, z = ascending(x, arrays[f"{name}/z"], 0)
+        y, z = ascending(y, z, 1)
+        rows, fitted = fit_rows(y, z, tolerance, max_fraction)
+    else:
+        # a single row over x
+        x, z = ascending(x, y[None], 1)
+        rows, fitted = fit_rows(x, z, tolerance, max_fraction)
+    residual = rows.grid_values() - z
+    error = (float(np.abs(residual).max()), float(np.sqrt(np.mean(residual**2))))
+    if two_d:
+        return LinearFit2D(x, rows, *error, fitted)
+    return LinearFit1D(rows, *error, fitted)
+
+
+def entry_names(arrays: Dict[str, np.ndarray]) -> List[str]:
+    return sorted(key.split("/")[0] for key in arrays if key.endswith("/x"))
+
+
+def fit_arrays(fit: LinearFit) -> Dict[str, np.ndarray]:
+    rows = fit.rows
+    axes = [("x", fit.x)] if isinstance(fit, LinearFit2D) else []
+    return dict(
+        axes
+        + [
+            ("y", rows.y),
+            ("offsets", rows.offsets.astype(np.int32)),
+            ("knots", rows.knots.astype(np.int16)),
+            ("values", rows.values),
+            ("error", np.array([fit.max_error, fit.rms, fit.fitted])),
+        ]
+    )
+
+
+def fit_from_arrays(arrays: Dict[str, np.ndarray], name: str) -> LinearFit:
+    rows = KnotRows(
+        arrays[f"{name}/y"],
+        arrays[f"{name}/offsets"],
+        arrays[f"{name}/knots"],
+        arrays[f"{name}/values"],
+    )
+    max_error, rms, fitted = arrays[f"{name}/error"]
+    if f"{name}/x" in arrays:
+        return LinearFit2D(arrays[f"{name}/x"], rows, max_error, rms, bool(fitted))
+    return LinearFit1D(rows, max_error, rms, bool(fitted))
+
+
+def build_fits(
+    arrays: Dict[str, np.ndarray],
+    tolerance: float = 0.1,
+    max_fraction: float = 0.75,
+    cache: Path = fit_path,
+) -> Dict[str, LinearFit]:
+    # only entries whose calibration fingerprint or fit options changed are refitted
+    existing: Dict[str, np.ndarray] = {}
+    if cache.exists():
+        with np.load(cache) as f:
+            if int(f["format_version"]) == format_version:
+                existing = dict((key, f[key]) for key in f.files)
+
+    fits: Dict[str, LinearFit] = {}
+    stored: Dict[str, np.ndarray] = {}
+    changed = False
+    for name in entry_names(arrays):
+        fingerprint = f"{arrays[f'{name}/fingerprint']}:{tolerance}:{max_fraction}"
+        if str(existing.get(f"{name}/fingerprint", "")) == fingerprint:
+            fits[name] = fit_from_arrays(existing, name)
+        else:
+            fits[name] = fit_entry(arrays, name, tolerance, max_fraction)
+            changed = True
+        for key, value in fit_arrays(fits[name]).items():
+            stored[f"{name}/{key}"] = value
+        stored[f"{name}/fingerprint"] = np.array(fingerprint)
+
+    if changed or set(stored) != set(existing) - {"format_version"}:
+        cache_tmp = cache.with_name(f"{cache.stem}.{os.getpid()}.tmp.npz")
+        np.savez(cache_tmp, format_version=np.array(format_version), **stored)
+        os.replace(cache_tmp, cache)
+    return fits
+
+
+@lru_cache(maxsize=1)
+def _load_fits(stat_key: Tuple, path: Path) -> Dict[str, LinearFit]:
+    return build_fits(load_calibration_arrays(path), cache=path / fit_path.name)
+
+
+def load_fits(path: Path = file_path) -> Dict[str, LinearFit]:
+    # the fits are kept in memory until one of the source files changes
+    return _load_fits(source_stat_key(path), path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fit compact piecewise linear models to the calibration grids"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="max deviation [dB]"
+    )
+    parser.add_argument(
+        "--max-fraction",
+        type=float,
+        default=0.75,
+        help="largest fit kept, as a fraction of the grid points",
+    )
+    args = parser.parse_args()
+
+    arrays = load_calibration_arrays()
+    fits = build_fits(arrays, args.tolerance, args.max_fraction)
+    print(
+        f"{'name':<10} {'model':>6} {'grid':>6} {'knots':>6}"
+        f" {'max error':>10} {'rms':>7}"
+    )
+    for name, fit in fits.items():
+        n_grid = arrays[f"{name}/{'z' if f'{name}/z' in arrays else 'y'}"].size
+        print(
+            f"{name:<10} {'fit' if fit.fitted else 'table':>6} {n_grid:>6}"
+            f" {fit.size:>6} {fit.max_error:>10.3f} {fit.rms:>7.3f}"
+        )
+    tables = [name for name, fit in fits.items() if not fit.fitted]
+    if tables:
+        print(
+            f"{', '.join(tables)}: tolerance needs more than {args.max_fraction:.0%}"
+            " of the grid points, the table is used"
+        )
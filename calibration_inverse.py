@@ -0,0 +1,241 @@
+import argparse
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from calibration import file_path, source_stat_key
+from calibration_chain import CalibrationChain, bilinear_uniform, load_calibration_chain
+
+# gate voltage used by enable_26GHz_power
+nominal_vg = 0.8
+
+
+class InverseSolution(NamedTuple):
+    # solved setpoint [dBm] or gate voltage [V], nan where the target is infeasible
+    value: np.ndarray
+    feasible: np.ndarray
+    # achievable output power range [dBm] for the fixed parameter
+    lower: np.ndarray
+    upper: np.ndarray
+
+
+def inverse_table(
+    x: np.ndarray, response: np.ndarray, levels: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # invert response[:, j] (a function of x) onto levels for every column j, using
+    # the running maximum so the inverse returns the smallest x reaching a level
+    # even if the response flattens or dips in compression
+    n_columns = response.shape[1]
+    inverse = np.full((len(levels), n_columns), np.nan)
+    lower = np.full(n_columns, np.nan)
+    upper = np.full(n_columns, np.nan)
+    for j in range(n_columns):
+        valid = np.isfinite(response[:, j])
+        if np.count_nonzero(valid) < 2:
+            continue
+        xv = x[valid]
+        yv = np.maximum.accumulate(response[valid, j])
+        lower[j], upper[j] = yv[0], yv[-1]
+
+        i = np.clip(np.searchsorted(yv, levels, side="left"), 1, len(yv) - 1)
+        y0, y1 = yv[i - 1], yv[i]
+        t = np.clip((levels - y0) / np.where(y1 > y0, y1 - y0, 1.0), 0, 1)
+        inside = (levels >= yv[0]) & (levels <= yv[-1])
+        inverse[inside, j] = (xv[i - 1] + t * (xv[i] - xv[i - 1]))[inside]
+    return inverse, lower, upper
+
+
+class InverseCalibration:
+    """
+    Target amplifier output power -> SynthHD setpoint (at fixed Vg) or gate voltage
+    (at fixed setpoint), from monotone inverse tables of a fused CalibrationChain.
+    """
+
+    def __init__(self, chain: CalibrationChain, n_levels: int = 1001):
+        if chain.fused is None:
+            chain.fuse()
+        assert chain.fused is not None
+        self.chain = chain
+
+        # output power vs setpoint and vg for every synthesizer output and amplifier
+        n_synth, n_amplifier, n_setpoint, n_vg = chain.fused.shape
+        fused = chain.fused.reshape(n_synth * n_amplifier, n_setpoint, n_vg)
+        setpoints, vg = chain.fused_setpoints, chain.fused_vg
+
+        self.levels = np.linspace(np.nanmin(fused), np.nanmax(fused), n_levels)
+
+        # setpoint for a level at fixed vg
+        self.setpoint_table = np.empty((len(fused), n_levels, n_vg))
+        self.setpoint_bounds = np.empty((len(fused), 2, n_vg))
+        for idx, table in enumerate(fused):
+            inverse, lower, upper = inverse_table(setpoints, table, self.levels)
+            self.setpoint_table[idx] = inverse
+            self.setpoint_bounds[idx] = lower, upper
+
+        # vg for a level at fixed setpoint; a larger |Vg| pinches the amplifier off,
+        # so the output increases towards smaller vg
+        if chain.has_vg:
+            self.vg_table = np.empty((len(fused), n_levels, n_setpoint))
+            self.vg_bounds = np.empty((len(fused), 2, n_setpoint))
+            for idx, table in enumerate(fused):
+                inverse, lower, upper = inverse_table(
+                    vg[::-1], table.T[::-1], self.levels
+                )
+                self.vg_table[idx] = inverse
+                self.vg_bounds[idx] = lower, upper
+
+    def _stack_index(
+        self, synth: npt.ArrayLike, output: npt.ArrayLike, amplifier: npt.ArrayLike
+    ) -> np.ndarray:
+        n_amplifier = len(self.chain.amplifiers)
+        return self.chain.synth_index(synth, output) * n_amplifier + np.asarray(
+            amplifier, dtype=np.intp
+        )
+
+    def _solve(
+        self,
+        table: np.ndarray,
+        bounds: np.ndarray,
+        axis: np.ndarray,
+        index: np.ndarray,
+        target: np.ndarray,
+        fixed: np.ndarray,
+    ) -> InverseSolution:
+        index, target, fixed = np.broadcast_arrays(index, target, fixed)
+        d_level = self.levels[1] - self.levels[0]
+        d_axis = axis[1] - axis[0] if len(axis) > 1 else 1.0
+
+        value = bilinear_uniform(
+            table, index, self.levels[0], d_level, axis[0], d_axis, target, fixed
+        )
+        zeros = np.zeros_like(fixed)
+        lower = bilinear_uniform(
+            bounds[:, 0, :, None], index, axis[0], d_axis, 0, 1, fixed, zeros
+        )
+        upper = bilinear_uniform(
+            bounds[:, 1, :, None], index, axis[0], d_axis, 0, 1, fixed, zeros
+        )
+        feasible = np.isfinite(value) & (target >= lower) & (target <= upper)
+        return InverseSolution(
+            np.where(feasible, value, np.nan), feasible, lower, upper
+        )
+
+    def setpoint(
+        self,
+        target: npt.ArrayLike,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        vg: Optional[npt.ArrayLike] = nominal_vg,
+        amplifier: npt.ArrayLike = 0,
+        temperature: Optional[npt.ArrayLike] = None,
+    ) -> InverseSolution:
+        # the 40 GHz amplifiers have no gate, the vg axis has a single entry
+        if not self.chain.has_vg:
+            vg = self.chain.fused_vg[0]
+        solution = self._solve(
+            self.setpoint_table,
+            self.setpoint_bounds,
+            self.chain.fused_vg,
+            self._stack_index(synth, output, amplifier),
+            np.asarray(target, dtype=float),
+            np.asarray(vg, dtype=float),
+        )
+        if temperature is None:
+            return solution
+
+        # the setpoint at the calibration temperature minus the temperature offset,
+        # infeasible if that leaves the calibrated setpoint range
+        value = solution.value - self.chain.temperature_offset(
+            synth, output, temperature
+        )
+        setpoints = self.chain.fused_setpoints
+        feasible = (
+            solution.feasible & (value >= setpoints[0]) & (value <= setpoints[-1])
+        )
+        return InverseSolution(
+            np.where(feasible, value, np.nan), feasible, solution.lower, solution.upper
+        )
+
+    def vg(
+        self,
+        target: npt.ArrayLike,
+        synth: npt.ArrayLike,
+        output: npt.ArrayLike,
+        setpoint: npt.ArrayLike,
+        amplifier: npt.ArrayLike = 0,
+        temperature: Optional[npt.ArrayLike] = None,
+    ) -> InverseSolution:
+        if not self.chain.has_vg:
+            raise ValueError(f"the {self.chain.system} amplifiers have no gate voltage")
+        return self._solve(
+            self.vg_table,
+            self.vg_bounds,
+            self.chain.fused_setpoints,
+            self._stack_index(synth, output, amplifier),
+            np.asarray(target, dtype=float),
+            self.chain.effective_setpoint(synth, output, setpoint, temperature),
+        )
+
+
+@lru_cache(maxsize=2)
+def _load_inverse_calibration(
+    stat_key: Tuple, system: str, path: Path
+) -> InverseCalibration:
+    return InverseCalibration(load_calibration_chain(system, path, fused=True))
+
+
+def load_inverse_calibration(system: str, path: Path = file_path) -> InverseCalibration:
+    return _load_inverse_calibration(source_stat_key(path), system, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="SynthHD setpoint or gate voltage for a target amplifier output"
+    )
+    parser.add_argument("system", choices=["26_7", "40"])
+    parser.add_argument("target", type=float, nargs="+", help="output power [dBm]")
+    parser.add_argument("--synth", default="SN416")
+    parser.add_argument("--output", default="RFB")
+    parser.add_argument("--amplifier", type=int, default=1, choices=[1, 2])
+    parser.add_argument("--vg", type=float, default=nominal_vg, help="|Vg| [V]")
+    parser.add_argument(
+        "--setpoint", type=float, help="solve for |Vg| at this setpoint [dBm]"
+    )
+    parser.add_argument("--temperature", type=float, help="SynthHD temperature [C]")
+    args = parser.parse_args()
+
+    inverse = load_inverse_calibration(args.system)
+    if args.setpoint is None:
+        solution = inverse.setpoint(
+            args.target,
+            args.synth,
+            args.output,
+            args.vg,
+            args.amplifier - 1,
+            args.temperature,
+        )
+        unit = "dBm setpoint"
+    else:
+        solution = inverse.vg(
+            args.target,
+            args.synth,
+            args.output,
+            args.setpoint,
+            args.amplifier - 1,
+            args.temperature,
+        )
+        unit = "V |Vg|"
+
+    for target, value, lower, upper in zip(
+        args.target, solution.value, solution.lower, solution.upper
+    ):
+        if np.isfinite(value):
+            print(f"{target:.2f} dBm: {value:.3f} {unit}")
+        else:
+            print(
+                f"{target:.2f} dBm: infeasible, achievable range {lower:.2f} to"
+                f" {upper:.2f} dBm"
+            )
@@ -0,0 +1,170 @@
+import hashlib
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from calibration import file_path
+from measurement_store import read_source
+
+# SynthHD temperature during the calibration scans [C]. It was not recorded, the
+# scans ran on a warmed up SynthHD, which settles between 34 C and 39 C in the
+# monitoring runs
+calibration_temperature = 35.0
+
+# the runs of the first SynthHD notebooks don't name the synthesizer
+monitoring_pattern = re.compile(
+    r"_synthHD(?:Pro_SN(\d+)_(RF[AB]))?_time_monitoring\.csv$"
+)
+
+
+def monitoring_files(path: Path = file_path) -> Dict[str, List[Path]]:
+    # synthesizer output ("SN415_RFA", "" if unknown) -> time monitoring CSVs,
+    # copies of the same run are used once
+    files: Dict[str, List[Path]] = {}
+    seen = set()
+    for fname in sorted(path.glob("measurements */data/*_time_monitoring.csv")):
+        match = monitoring_pattern.search(fname.name)
+        if match is None:
+            continue
+        sha1 = hashlib.sha1(fname.read_bytes()).hexdigest()
+        if sha1 in seen:
+            continue
+        seen.add(sha1)
+        key = f"SN{match[1]}_{match[2]}" if match[1] else ""
+        files.setdefault(key, []).append(fname)
+    return files
+
+
+def read_monitoring(
+    fname: Path, path: Path = file_path
+) -> Tuple[np.ndarray, np.ndarray]:
+    # temperature [C], det power [dBm]
+    data = read_source(fname, path)
+    return data[:, 3], data[:, 2]
+
+
+def fit_runs(
+    runs: List[Tuple[np.ndarray, np.ndarray]], degree: int, reference: float
+) -> Tuple[np.ndarray, float]:
+    # polynomial in (T - reference) without constant term shared by all runs, plus
+    # an offset per run (different setups and setpoints); returns the coefficients
+    # of the powers 1..degree and the residual standard deviation [dB]
+    n_rows = sum(len(t) for t, _ in runs)
+    design = np.zeros((n_rows, len(runs) + degree))
+    power = np.concatenate([p for _, p in runs])
+    row = 0
+    for i, (temperature, _) in enumerate(runs):
+        rows = slice(row, row + len(temperature))
+        design[rows, i] = 1
+        for k in range(1, degree + 1):
+            design[rows, len(runs) + k - 1] = (temperature - reference) ** k
+        row += len(temperature)
+    solution, *_ = np.linalg.lstsq(design, power, rcond=None)
+    residual = power - design @ solution
+    return solution[len(runs) :], float(residual.std())
+
+
+class TemperatureModel:
+    """
+    Change of the SynthHD output power with its internal temperature, relative to
+    the calibration temperature, fitted to the time monitoring runs. The change is
+    applied as an equivalent setpoint offset [dB], the monitoring ran at a fixed
+    setpoint and frequency. Outputs without a monitoring run of their own use the
+    fit over all runs.
+    """
+
+    def __init__(
+        self,
+        coefficients: Dict[str, np.ndarray],
+        residuals: Optional[Dict[str, float]] = None,
+        reference: float = calibration_temperature,
+    ):
+        # "" is the fit over all runs
+        self.names = sorted(coefficients)
+        self.coefficients = np.array([coefficients[name] for name in self.names])
+        self.residuals = {} if residuals is None else residuals
+        self.reference = reference
+
+    @property
+    def degree(self) -> int:
+        return self.coefficients.shape[1]
+
+    def index(self, key: npt.ArrayLike) -> np.ndarray:
+        # row of self.coefficients per synthesizer output key, e.g. "SN415_RFA"
+        keys, inverse = np.unique(np.asarray(key), return_inverse=True)
+        fallback = self.names.index("")
+        lookup = np.array(
+            [
+                self.names.index(k) if k in self.names else fallback
+                for k in keys.tolist()
+            ],
+            dtype=np.intp,
+        )
+        return lookup[inverse.reshape(np.shape(key))]
+
+    def offset(self, key: npt.ArrayLike, temperature: npt.ArrayLike) -> np.ndarray:
+        # setpoint offset [dB] at temperature [C], broadcast over keys and
+        # temperatures
+        return self.evaluate(self.index(key), temperature)
+
+    def evaluate(self, index: npt.ArrayLike, temperature: npt.ArrayLike) -> np.ndarray:
+        # offset by row of self.coefficients
+        index, temperature = np.broadcast_arrays(
+            np.asarray(index, dtype=np.intp), np.asarray(temperature, dtype=float)
+        )
+        dt = temperature - self.reference
+        coefficients = self.coefficients[index]
+        result = np.zeros(dt.shape)
+        # Horner without constant term
+        for k in range(self.degree - 1, -1, -1):
+            result = (result + coefficients[..., k]) * dt
+        return result
+
+
+def fit_temperature_model(
+    path: Path = file_path,
+    degree: int = 1,
+    min_span: float = 3.0,
+    reference: float = calibration_temperature,
+) -> TemperatureModel:
+    # runs spanning less than min_span [C] don't constrain the slope and are
+    # skipped
+    runs: Dict[str, List[Tuple[np.ndarray, np.ndarray]]] = {}
+    for key, fnames in monitoring_files(path).items():
+        for fname in fnames:
+            temperature, power = read_monitoring(fname, path)
+            if np.ptp(temperature) >= min_span:
+                runs.setdefault(key, []).append((temperature, power))
+    all_runs = [run for key_runs in runs.values() for run in key_runs]
+    if not all_runs:
+        raise ValueError(f"no time monitoring run spans {min_span} C")
+
+    coefficients: Dict[str, np.ndarray] = {}
+    residuals: Dict[str, float] = {}
+    coefficients[""], residuals[""] = fit_runs(all_runs, degree, reference)
+    for key, key_runs in runs.items():
+        if key:
+            coefficients[key], residuals[key] = fit_runs(key_runs, degree, reference)
+    return TemperatureModel(coefficients, residuals, reference)
+
+
+def temperature_stat_key(path: Path = file_path) -> Tuple:
+    stat_key = []
+    for fname in sorted(path.glob("measurements */data/*_time_monitoring.csv")):
+        stat = fname.stat()
+        stat_key.append((str(fname), stat.st_mtime_ns, stat.st_size))
+    return tuple(stat_key)
+
+
+@lru_cache(maxsize=1)
+def _load_temperature_model(stat_key: Tuple, path: Path) -> TemperatureModel:
+    return fit_temperature_model(path)
+
+
+def load_temperature_model(path: Path = file_path) -> TemperatureModel:
+    # refitted only when one of the monitoring files changes
+    return _load_temperature_model(temperature_stat_key(path), path)
@@ -0,0 +1,476 @@
+import argparse
+import collections
+import csv
+import datetime
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from results_writer import write_json_atomic
+from ring_buffer import RingBuffer
+
+fields = ("power", "temperature")
+sample_dtype = np.dtype([("time", "<f8"), ("power", "<f4"), ("temperature", "<f4")])
+
+# downsampled tiers, name -> bin width [s]
+default_tiers = dict(
+    [("1min", 60.0), ("10min", 600.0), ("1h", 3600.0), ("1d", 86400.0)]
+)
+
+
+def tier_dtype(fields: Sequence[str] = fields) -> np.dtype:
+    # time is the start of the bin
+    columns = [("time", "<f8"), ("count", "<i4")]
+    for field in fields:
+        columns += [
+            (f"{field}_{stat}", "<f4") for stat in ("mean", "std", "min", "max")
+        ]
+    return np.dtype(columns)
+
+
+class RollingStats:
+    """
+    Mean, standard deviation, min and max of the last window values, updated in
+    O(1) per value: running sums for mean and variance (relative to the first
+    value to limit cancellation), monotonic deques for min and max.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.values: collections.deque = collections.deque()
+        self.n_total = 0
+        self.shift = 0.0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        # (sample number, value) with increasing / decreasing values
+        self._min: collections.deque = collections.deque()
+        self._max: collections.deque = collections.deque()
+
+    def update(self, value: float):
+        if not math.isfinite(value):
+            return
+        if self.n_total == 0:
+            self.shift = value
+        if len(self.values) == self.window:
+            old = self.values.popleft() - self.shift
+            self.sum -= old
+            self.sum_squares -= old * old
+        self.values.append(value)
+        x = value - self.shift
+        self.sum += x
+        self.sum_squares += x * x
+
+        n = self.n_total
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((n, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((n, value))
+        for extremes in (self._min, self._max):
+            if extremes[0][0] <= n - self.window:
+                extremes.popleft()
+        self.n_total += 1
+
+    @property
+    def count(self) -> int:
+        return len(self.values)
+
+    @property
+    def mean(self) -> float:
+        if not self.values:
+            return math.nan
+        return self.shift + self.sum / len(self.values)
+
+    @property
+    def std(self) -> float:
+        n = len(self.values)
+        if n < 2:
+            return math.nan
+        variance = (self.sum_squares - self.sum * self.sum / n) / (n - 1)
+        return math.sqrt(max(variance, 0.0))
+
+    @property
+    def min(self) -> float:
+        return self._min[0][1] if self._min else math.nan
+
+    @property
+    def max(self) -> float:
+        return self._max[0][1] if self._max else math.nan
+
+    def summary(self) -> Dict[str, float]:
+        return dict(
+            [
+                ("count", self.count),
+                ("mean", self.mean),
+                ("std", self.std),
+                ("min", self.min),
+                ("max", self.max),
+            ]
+        )
+
+
+class ChunkedFile:
+    """
+    Appends fixed size records to a raw file in chunks of chunk_rows rows, each
+    chunk is fsynced. A torn record at the end of an existing file is truncated.
+    """
+
+    def __init__(self, fname: Path, dtype: npt.DTypeLike, chunk_rows: int = 360):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.chunk = np.zeros(chunk_rows, self.dtype)
+        self.n_chunk = 0
+        if fname.exists():
+            size = fname.stat().st_size
+            with open(fname, "rb+") as f:
+                f.truncate(size - size % self.dtype.itemsize)
+        self.file = open(fname, "ab")
+
+    def append(self, row: Union[np.void, tuple]):
+        self.chunk[self.n_chunk] = row
+        self.n_chunk += 1
+        if self.n_chunk == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        if self.n_chunk:
+            self.chunk[: self.n_chunk].tofile(self.file)
+            self.n_chunk = 0
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class Tier:
+    # bins of resolution seconds with count, mean, std, min and max per field
+    def __init__(
+        self,
+        name: str,
+        resolution: float,
+        capacity: int = 10000,
+        file: Optional[ChunkedFile] = None,
+    ):
+        self.name = name
+        self.resolution = resolution
+        self.dtype = tier_dtype()
+        self.buffer = RingBuffer(capacity, self.dtype)
+        self.file = file
+        self.bin: Optional[int] = None
+        self.reset()
+
+    def reset(self):
+        self.n = np.zeros(len(fields))
+        self.sum = np.zeros(len(fields))
+        self.sum_squares = np.zeros(len(fields))
+        self.min = np.full(len(fields), np.inf)
+        self.max = np.full(len(fields), -np.inf)
+
+    def row(self) -> np.void:
+        row = np.zeros((), self.dtype)
+        row["time"] = self.bin * self.resolution
+        row["count"] = int(self.n.max())
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.n
+            variance = (self.sum_squares - self.sum * mean) / (self.n - 1)
+        for i, field in enumerate(fields):
+            row[f"{field}_mean"] = mean[i]
+            row[f"{field}_std"] = np.sqrt(max(variance[i], 0)) if self.n[i] > 1 else 0
+            row[f"{field}_min"] = self.min[i] if self.n[i] else np.nan
+            row[f"{field}_max"] = self.max[i] if self.n[i] else np.nan
+        return row
+
+    def close_bin(self):
+        if self.bin is None:
+            return
+        row = self.row()
+        self.buffer.append(row)
+        if self.file is not None:
+            self.file.append(row)
+        self.reset()
+
+    def add(self, t: float, values: np.ndarray):
+        index = int(t // self.resolution)
+        if index != self.bin:
+            self.close_bin()
+            self.bin = index
+        valid = np.isfinite(values)
+        values = np.where(valid, values, 0.0)
+        self.n += valid
+        self.sum += values
+        self.sum_squares += values * values
+        self.min = np.where(valid, np.minimum(self.min, values), self.min)
+        self.max = np.where(valid, np.maximum(self.max, values), self.max)
+
+
+class DriftMonitor:
+    """
+    Samples the power meter reading and the SynthHD temperature every interval
+    seconds into a ring buffer, keeps rolling statistics over the last window
+    samples and downsampled tiers (1 min to 1 day bins by default). Raw samples
+    and completed tier bins are persisted in chunks to raw files in directory,
+    which read_tier and query memory map, so months of data are queried without
+    loading them.
+
+    with DriftMonitor(power_meter, synthd, "drift SN416 RFB") as monitor:
+        ...
+        monitor.statistics()["power"]["std"]
+    """
+
+    def __init__(
+        self,
+        power_meter,
+        synthd,
+        directory: Union[str, Path],
+        interval: float = 10.0,
+        count: int = 5,
+        window: int = 360,
+        capacity: int = 8640,
+        tiers: Optional[Dict[str, float]] = None,
+        chunk_rows: int = 30,
+    ):
+        self.power_meter = power_meter
+        self.synthd = synthd
+        self.interval = interval
+        self.count = count
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tiers = default_tiers if tiers is None else tiers
+
+        self.buffer = RingBuffer(capacity, sample_dtype)
+        self.stats = dict((field, RollingStats(window)) for field in fields)
+        self.raw_file = ChunkedFile(
+            self.directory / "raw.bin", sample_dtype, chunk_rows
+        )
+        self.tiers = [
+            Tier(
+                name,
+                resolution,
+                file=ChunkedFile(self.directory / f"{name}.bin", tier_dtype(), 1),
+            )
+            for name, resolution in tiers.items()
+        ]
+        self.write_metadata(tiers)
+
+        self.overruns = 0
+        self.errors = 0
+        self.last_error: Optional[Exception] = None
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def write_metadata(self, tiers: Dict[str, float]):
+        write_json_atomic(
+            self.directory / "monitor.json",
+            dict(
+                [
+                    ("interval", self.interval),
+                    ("count", self.count),
+                    ("fields", list(fields)),
+                    ("raw", dict([("file", "raw.bin"), ("dtype", sample_dtype.descr)])),
+                    (
+                        "tiers",
+                        [
+                            dict(
+                                [
+                                    ("name", name),
+                                    ("resolution", resolution),
+                                    ("file", f"{name}.bin"),
+                                    ("dtype", tier_dtype().descr),
+                                ]
+                            )
+                            for name, resolution in tiers.items()
+                        ],
+                    ),
+                ]
+            ),
+        )
+
+    def sample(self) -> np.void:
+        power, _ = self.power_meter.measure(self.count)
+        row = np.zeros((), sample_dtype)
+        row["time"] = time.time()
+        row["power"] = power
+        row["temperature"] = self.synthd.temperature
+        return row
+
+    def process(self, row: np.void):
+        # O(1) per sample, also used to backfill recorded samples
+        with self.lock:
+            self.buffer.append(row)
+            self.raw_file.append(row)
+            values = np.array([row[field] for field in fields], float)
+            for field, value in zip(fields, values):
+                self.stats[field].update(float(value))
+            for tier in self.tiers:
+                tier.add(float(row["time"]), values)
+
+    def _run(self):
+        t_next = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.process(self.sample())
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+
+            t_next += self.interval
+            t = time.perf_counter()
+            if t > t_next:
+                missed = int((t - t_next) / self.interval) + 1
+                self.overruns += missed
+                t_next += missed * self.interval
+            self._stop.wait(t_next - t)
+
+    def start(self) -> "DriftMonitor":
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="drift monitor", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self.lock:
+            self.raw_file.flush()
+
+    def close(self):
+        # the bins in progress are written, a restart opens new ones
+        self.stop()
+        with self.lock:
+            for tier in self.tiers:
+                tier.close_bin()
+                tier.file.close()
+            self.raw_file.close()
+
+    def __enter__(self) -> "DriftMonitor":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def statistics(self) -> Dict[str, Dict[str, float]]:
+        # rolling statistics over the last window samples per field
+        with self.lock:
+            return dict((field, stats.summary()) for field, stats in self.stats.items())
+
+    def latest(self, n: int = 1) -> np.ndarray:
+        return self.buffer.latest(n)
+
+
+def read_metadata(directory: Union[str, Path]) -> Dict:
+    with open(Path(directory) / "monitor.json") as f:
+        return json.load(f)
+
+
+def read_tier(
+    directory: Union[str, Path],
+    name: str = "raw",
+    start: Optional[float] = None,
+    stop: Optional[float] = None,
+) -> np.ndarray:
+    # memory mapped rows of a tier (or the raw samples) with start <= time < stop
+    directory = Path(directory)
+    metadata = read_metadata(directory)
+    if name == "raw":
+        fname, descr = metadata["raw"]["file"], metadata["raw"]["dtype"]
+    else:
+        tier = [tier for tier in metadata["tiers"] if tier["name"] == name]
+        if not tier:
+            raise KeyError(f"no tier {name} in {directory}")
+        fname, descr = tier[0]["file"], tier[0]["dtype"]
+    dtype = np.dtype([tuple(column) for column in descr])
+    n_rows = (directory / fname).stat().st_size // dtype.itemsize
+    if n_rows == 0:
+        return np.zeros(0, dtype)
+    data = np.memmap(directory / fname, dtype=dtype, mode="r", shape=(n_rows,))
+    # samples are appended in time order
+    i_start = 0 if start is None else np.searchsorted(data["time"], start)
+    i_stop = n_rows if stop is None else np.searchsorted(data["time"], stop)
+    return data[i_start:i_stop]
+
+
+def query(
+    directory: Union[str, Path],
+    start: Optional[float] = None,
+    stop: Optional[float] = None,
+    max_points: int = 2000,
+) -> Tuple[str, np.ndarray]:
+    # the finest resolution (raw first) with at most max_points rows in the range
+    metadata = read_metadata(directory)
+    tiers = sorted(metadata["tiers"], key=lambda tier: tier["resolution"])
+    names = ["raw"] + [tier["name"] for tier in tiers]
+    for name in names:
+        data = read_tier(directory, name, start, stop)
+        if len(data) <= max_points:
+            return name, data
+    return names[-1], data
+
+
+def backfill(monitor: DriftMonitor, fname: Union[str, Path]):
+    # feed a *_time_monitoring.csv into a monitor
+    with open(fname, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            if not row:
+                continue
+            t = datetime.datetime.fromisoformat(row[0]).timestamp()
+            sample = (t, float(row[2]), float(row[3]))
+            monitor.process(np.array(sample, sample_dtype)[()])
+
+
+if __name__ == "__main__":
+    from instrument_server import open_instrument
+
+    parser = argparse.ArgumentParser(
+        description="Monitor the SynthHD output power and temperature drift"
+    )
+    parser.add_argument("directory", type=Path, help="directory of the data files")
+    parser.add_argument("--rf-out", type=int, default=0, help="SynthHD output")
+    parser.add_argument(
+        "--frequency", type=float, default=13.6e9, help="frequency [Hz]"
+    )
+    parser.add_argument("--power", type=float, default=0.0, help="setpoint [dBm]")
+    parser.add_argument(
+        "--interval", type=float, default=10.0, help="sample interval [s]"
+    )
+    args = parser.parse_args()
+
+    power_meter = open_instrument("power_meter")
+    synthd = open_instrument("synthd")
+    synthd[args.rf_out].frequency = args.frequency
+    power_meter.frequency = args.frequency
+    synthd[args.rf_out].power = args.power
+    synthd[args.rf_out].enable = True
+
+    with DriftMonitor(power_meter, synthd, args.directory, args.interval) as monitor:
+        try:
+            while True:
+                time.sleep(60)
+                stats = monitor.statistics()
+                print(
+                    f"{time.strftime('%Y-%m-%dT%H:%M:%S')}"
+                    f" power {stats['power']['mean']:.3f} +- {stats['power']['std']:.3f}"
+                    f" dBm, temperature {stats['temperature']['mean']:.2f} C"
+                )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            synthd[args.rf_out].power = -20
+            synthd[args.rf_out].enable = False
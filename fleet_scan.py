@@ -0,0 +1,253 @@
+import multiprocessing
+import queue
+import time
+import traceback
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from NRP50S import NRP50S
+from results_writer import ResultsWriter
+from scan_runner import GridScan, Index, traversal
+
+# header of the *_scan.csv SynthHD calibrations
+axis_names = ("frequency [Hz]", "synthHD Pro power [dBm]")
+scan_header = ["det power [dBm]"]
+
+
+class ScanJob(NamedTuple):
+    # calibration scan of one SynthHD output with one power meter
+    name: str
+    synth: str
+    synth_resource: str
+    rf_out: int
+    meter_resource: str
+    fname: str
+    frequencies: Sequence[float] = tuple(np.linspace(10e9, 13.9e9, 51))
+    powers: Sequence[float] = tuple(np.linspace(-30, 5, 51))
+    count: int = 5
+    settle: float = 0.1
+
+    def grid(self) -> GridScan:
+        return GridScan(
+            dict(zip(axis_names, (self.frequencies, self.powers))),
+            lambda point: [],
+            scan_header,
+        )
+
+
+# sessions opened by this worker process, by resource
+_sessions: Dict[str, Any] = {}
+
+
+def open_devices(job: ScanJob) -> Tuple[Any, NRP50S]:
+    # (SynthHD, NRP50S) of a job, each opened once per worker process
+    if job.synth_resource not in _sessions:
+        from windfreak import SynthHD
+
+        _sessions[job.synth_resource] = SynthHD(job.synth_resource)
+    if job.meter_resource not in _sessions:
+        _sessions[job.meter_resource] = NRP50S(job.meter_resource)
+    return _sessions[job.synth_resource], _sessions[job.meter_resource]
+
+
+def scan_worker(
+    jobs: List[ScanJob],
+    completed: Dict[str, Set[Index]],
+    results: multiprocessing.Queue,
+    devices: Callable[[ScanJob], Tuple[Any, NRP50S]],
+    batch_rows: int,
+):
+    # runs the jobs of one synthesizer in order, rows are sent to the parent in
+    # batches; the parent is the only process writing files
+    worker = jobs[0].synth_resource
+    try:
+        for job in jobs:
+            synthd, power_meter = devices(job)
+            channel = synthd[job.rf_out]
+            grid = job.grid()
+            axes = list(grid.axes.values())
+            done = completed.get(job.name, set())
+            rows: List[List[float]] = []
+            current: Dict[int, float] = {}
+
+            channel.power = float(axes[1][0])
+            channel.enable = True
+            try:
+                for index in traversal(grid.shape, grid.order):
+                    if index in done:
+                        continue
+                    frequency, power = (float(a[i]) for a, i in zip(axes, index))
+                    if current.get(0) != frequency:
+                        channel.frequency = frequency
+                        power_meter.frequency = frequency
+                        current[0] = frequency
+                    if current.get(1) != power:
+                        channel.power = power
+                        current[1] = power
+                        time.sleep(job.settle)
+                    reading, _ = power_meter.measure(job.count)
+                    rows.append([frequency, power, reading])
+                    if len(rows) >= batch_rows:
+                        results.put(("rows", job.name, rows))
+                        rows = []
+            finally:
+                if rows:
+                    results.put(("rows", job.name, rows))
+                channel.power = -20
+                channel.enable = False
+            results.put(("finished", job.name, None))
+    except Exception:
+        results.put(("error", worker, traceback.format_exc()))
+    finally:
+        results.put(("done", worker, None))
+
+
+class FleetScan:
+    """
+    Runs calibration scans of several SynthHD outputs concurrently, one worker
+    process per synthesizer, each opening its own SynthHD and power meter
+    sessions. Jobs of the same synthesizer run one after the other in its worker.
+    The workers send their rows to this process, the single sink that writes every
+    scan with a ResultsWriter and reports progress, so a fleet calibration takes as
+    long as the slowest synthesizer.
+
+    Scans are resumable like GridScan: points already in a job's file are skipped.
+    """
+
+    def __init__(
+        self,
+        jobs: Sequence[ScanJob],
+        devices: Callable[[ScanJob], Tuple[Any, NRP50S]] = open_devices,
+        batch_rows: int = 10,
+    ):
+        # a power meter can only be used by one worker
+        owners: Dict[str, str] = {}
+        for job in jobs:
+            owner = owners.setdefault(job.meter_resource, job.synth_resource)
+            if owner != job.synth_resource:
+                raise ValueError(
+                    f"power meter {job.meter_resource} is used with {owner} and"
+                    f" {job.synth_resource}"
+                )
+        if len(set(job.name for job in jobs)) != len(jobs):
+            raise ValueError("job names are not unique")
+        self.jobs = list(jobs)
+        self.devices = devices
+        self.batch_rows = batch_rows
+        self.progress: Dict[str, Tuple[int, int]] = {}
+        self.errors: Dict[str, str] = {}
+
+    def groups(self) -> Dict[str, List[ScanJob]]:
+        groups: Dict[str, List[ScanJob]] = {}
+        for job in self.jobs:
+            groups.setdefault(job.synth_resource, []).append(job)
+        return groups
+
+    def run(
+        self,
+        metadata: Optional[Dict[str, Any]] = None,
+        resume: bool = True,
+        progress: Optional[Callable[[str, int, int], None]] = None,
+        timeout: float = 60.0,
+    ) -> Dict[str, Tuple[int, int]]:
+        # returns (points done, points total) per job; raises if a worker failed or
+        # sent nothing for timeout [s], after the other workers finished
+        completed: Dict[str, Set[Index]] = {}
+        writers: Dict[str, ResultsWriter] = {}
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        workers: Dict[str, multiprocessing.Process] = {}
+        try:
+            for job in self.jobs:
+                grid = job.grid()
+                completed[job.name] = grid.completed(job.fname) if resume else set()
+                job_metadata = dict(
+                    metadata or {},
+                    synth=f"{job.synth} RF{'AB'[job.rf_out]}",
+                    power_meter=job.meter_resource,
+                    count=job.count,
+                    scan=grid.definition(),
+                    order=grid.order,
+                )
+                writers[job.name] = ResultsWriter(
+                    job.fname, grid.columns, job_metadata, append=resume
+                )
+                self.progress[job.name] = (
+                    len(completed[job.name]),
+                    int(np.prod(grid.shape)),
+                )
+
+            for synth_resource, jobs in self.groups().items():
+                worker = context.Process(
+                    target=scan_worker,
+                    args=(jobs, completed, results, self.devices, self.batch_rows),
+                    name=f"scan {synth_resource}",
+                )
+                worker.start()
+                workers[synth_resource] = worker
+
+            self._collect(workers, results, writers, progress, timeout)
+        finally:
+            for worker in workers.values():
+                worker.join(timeout)
+                if worker.is_alive():
+                    worker.terminate()
+            for name, writer in writers.items():
+                done, total = self.progress[name]
+                writer.close(complete=done == total)
+
+        if self.errors:
+            raise RuntimeError(
+                "\n".join(f"{worker}: {error}" for worker, error in self.errors.items())
+            )
+        return self.progress
+
+    def _collect(
+        self,
+        workers: Dict[str, multiprocessing.Process],
+        results: multiprocessing.Queue,
+        writers: Dict[str, ResultsWriter],
+        progress: Optional[Callable[[str, int, int], None]],
+        timeout: float,
+    ):
+        # a worker silent for timeout, alive (e.g. stuck in a VISA read) or not, is
+        # terminated and reported in errors; the others carry on
+        worker_of = dict((job.name, job.synth_resource) for job in self.jobs)
+        running = set(workers)
+        last_seen = dict((name, time.monotonic()) for name in workers)
+        while running:
+            try:
+                kind, name, payload = results.get(timeout=1.0)
+            except queue.Empty:
+                t = time.monotonic()
+                for worker in sorted(running):
+                    process = workers[worker]
+                    if not process.is_alive():
+                        # nothing left in the queue, it died without reporting back
+                        self.errors[worker] = (
+                            f"worker exited with code {process.exitcode}"
+                        )
+                    elif t - last_seen[worker] > timeout:
+                        process.terminate()
+                        self.errors[worker] = (
+                            f"no results for {timeout:.0f} s, worker terminated"
+                        )
+                    else:
+                        continue
+                    running.discard(worker)
+                continue
+            worker = worker_of.get(name, name)
+            last_seen[worker] = time.monotonic()
+            if kind == "rows":
+                writers[name].write_rows(payload)
+                done, total = self.progress[name]
+                self.progress[name] = (done + len(payload), total)
+                if progress is not None:
+                    progress(name, *self.progress[name])
+            elif kind == "finished":
+                writers[name].flush()
+            elif kind == "error":
+                self.errors[name] = payload
+            elif kind == "done":
+                running.discard(worker)
@@ -0,0 +1,284 @@
+import argparse
+import contextlib
+import functools
+import threading
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+import pyvisa
+
+from NRP50S import NRP50S
+from scpi_trace import Tracer
+from SPD3303X import SPD3303X
+
+address = ("localhost", 50200)
+authkey = b"centrex-rc-microwaves"
+
+
+class InstrumentConfig(NamedTuple):
+    driver: str
+    resource: str
+    # expected *IDN? response, checked once when the session is opened
+    idn: Optional[str] = None
+
+
+instruments = dict(
+    [
+        (
+            "psu_vg_5pos",
+            InstrumentConfig(
+                "SPD3303X",
+                "USB0::0xF4EC::0x1430::SPD3XIDX5R3677::INSTR",
+                "Siglent Technologies,SPD3303X-E,SPD3XIDX5R3677,1.01.01.02.07R2,V3.0",
+            ),
+        ),
+        (
+            "psu_12pos_vd_5neg",
+            InstrumentConfig(
+                "SPD3303X",
+                "USB0::0xF4EC::0x1430::SPD3XIED5R7612::INSTR",
+                "Siglent Technologies,SPD3303X-E,SPD3XIED5R7612,1.01.01.02.07R2,V3.0",
+            ),
+        ),
+        (
+            "psu_a_5pos",
+            InstrumentConfig(
+                "SPD3303X",
+                "USB0::0xF4EC::0x1430::SPD3XIED5R8368::INSTR",
+                "Siglent Technologies,SPD3303X-E,SPD3XIED5R8368,1.01.01.02.07R2,V3.0",
+            ),
+        ),
+        (
+            "power_meter",
+            InstrumentConfig("NRP50S", "USB0::0x0AAD::0x0161::101074::INSTR"),
+        ),
+        ("synthd", InstrumentConfig("SynthHD", "COM5")),
+    ]
+)
+
+# attribute path below an instrument, integers index, e.g. (0, "frequency") is
+# synthd[0].frequency
+AttributePath = Tuple[Union[str, int], ...]
+
+
+def open_local(
+    name: str, rm: Optional[pyvisa.ResourceManager] = None
+) -> Union[SPD3303X, NRP50S, Any]:
+    config = instruments[name]
+    if config.driver == "SPD3303X":
+        instrument = SPD3303X(config.resource, rm)
+    elif config.driver == "NRP50S":
+        instrument = NRP50S(config.resource, rm)
+    elif config.driver == "SynthHD":
+        from windfreak import SynthHD
+
+        instrument = SynthHD(config.resource)
+    else:
+        raise ValueError(f"unknown driver {config.driver} for {name}")
+
+    if config.idn is not None:
+        idn = instrument.idn
+        if idn != config.idn:
+            raise RuntimeError(f"{name}: expected {config.idn}, got {idn}")
+    return instrument
+
+
+class InstrumentHandle:
+    """
+    Server side of one instrument. Drivers with their own lock (SPD3303X, NRP50S)
+    serialize every command, so requests of different clients interleave per
+    command and a long call like settle() does not hold up the others. Every
+    request to other drivers (the SynthHD) holds the lock of the handle.
+    """
+
+    def __init__(self, name: str, instrument: Any):
+        self.name = name
+        self.instrument = instrument
+        self.lock = threading.RLock()
+        self.locked = (
+            contextlib.nullcontext()
+            if isinstance(getattr(instrument, "lock", None), type(self.lock))
+            else self.lock
+        )
+
+    def _resolve(self, path: AttributePath) -> Any:
+        obj = self.instrument
+        for key in path:
+            obj = obj[key] if isinstance(key, int) else getattr(obj, key)
+        return obj
+
+    def get(self, path: AttributePath) -> Tuple[bool, Any]:
+        # (is_method, value), methods are called through call instead
+        with self.locked:
+            *parent, key = path
+            obj = self._resolve(tuple(parent))
+            if isinstance(key, int):
+                return False, obj[key]
+            # check the class first so properties are only read once
+            if callable(getattr(type(obj), key, None)):
+                return True, None
+            return False, getattr(obj, key)
+
+    def set(self, path: AttributePath, value: Any):
+        with self.locked:
+            *parent, key = path
+            obj = self._resolve(tuple(parent))
+            if isinstance(key, int):
+                obj[key] = value
+            else:
+                setattr(obj, key, value)
+
+    def call(self, path: AttributePath, *args, **kwargs) -> Any:
+        with self.locked:
+            return self._resolve(path)(*args, **kwargs)
+
+    def connect(self) -> "InstrumentHandle":
+        # a client connects: the settings may have been changed since the last one,
+        # from the front panel or by a script using the instrument directly
+        with self.locked:
+            if hasattr(self.instrument, "invalidate"):
+                self.instrument.invalidate()
+        return self
+
+
+class InstrumentManager(BaseManager):
+    pass
+
+
+InstrumentManager.register(
+    "instrument", exposed=["get", "set", "call"], method_to_typeid=None
+)
+InstrumentManager.register("names")
+
+
+class RemoteInstrument:
+    """
+    Client side proxy behaving like the driver object, e.g.
+    psu.ch1_voltage_setpoint = 1.5, psu.settle(1, 1.5) or synthd[0].power = 0.
+    """
+
+    def __init__(self, handle, path: AttributePath = (), methods: Optional[set] = None):
+        object.__setattr__(self, "_handle", handle)
+        object.__setattr__(self, "_path", path)
+        # paths known to be methods, saves the round trip to find out
+        object.__setattr__(self, "_methods", set() if methods is None else methods)
+
+    def __getattr__(self, key: str) -> Any:
+        if key.startswith("_"):
+            raise AttributeError(key)
+        path = self._path + (key,)
+        if path not in self._methods:
+            is_method, value = self._handle.get(path)
+            if not is_method:
+                return value
+            self._methods.add(path)
+        return functools.partial(self._handle.call, path)
+
+    def __setattr__(self, key: str, value: Any):
+        self._handle.set(self._path + (key,), value)
+
+    def __getitem__(self, key: int) -> "RemoteInstrument":
+        return RemoteInstrument(self._handle, self._path + (key,), self._methods)
+
+    def __setitem__(self, key: int, value: Any):
+        self._handle.set(self._path + (key,), value)
+
+
+def connect(
+    server_address: Tuple[str, int] = address, key: bytes = authkey
+) -> InstrumentManager:
+    manager = InstrumentManager(address=server_address, authkey=key)
+    manager.connect()
+    return manager
+
+
+def open_instrument(
+    name: str,
+    server_address: Tuple[str, int] = address,
+    key: bytes = authkey,
+    fallback: bool = True,
+) -> Any:
+    # use the session held by the instrument server if it is running, otherwise
+    # open the instrument in this process
+    try:
+        manager = connect(server_address, key)
+    except ConnectionRefusedError:
+        if not fallback:
+            raise
+        return open_local(name)
+    if name not in manager.names()._getvalue():
+        raise KeyError(f"the instrument server does not hold {name}")
+    return RemoteInstrument(manager.instrument(name))
+
+
+def serve(
+    names: Sequence[str],
+    server_address: Tuple[str, int] = address,
+    key: bytes = authkey,
+    simulate: bool = False,
+    trace_path: Optional[Path] = None,
+):
+    if simulate:
+        from simulation import SimulatedBench
+
+        open_instrument_session = SimulatedBench().open
+    else:
+        rm = pyvisa.ResourceManager()
+        open_instrument_session = functools.partial(open_local, rm=rm)
+
+    handles: Dict[str, InstrumentHandle] = {}
+    for name in names:
+        handles[name] = InstrumentHandle(name, open_instrument_session(name))
+        print(f"{name:<18} {instruments[name].resource}")
+
+    tracer = Tracer()
+    if trace_path is not None:
+        for name, handle in handles.items():
+            if hasattr(handle.instrument, "dev"):
+                tracer.attach(handle.instrument, name)
+
+    InstrumentManager.register(
+        "instrument", callable=lambda name: handles[name].connect()
+    )
+    InstrumentManager.register("names", callable=lambda: list(handles))
+    manager = InstrumentManager(address=server_address, authkey=key)
+    server = manager.get_server()
+    print(f"serving on {server_address[0]}:{server_address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        if trace_path is not None:
+            tracer.to_json(trace_path)
+            print(tracer.report())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Hold the instrument sessions open and share them between scripts"
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help=f"instruments to open, default all of {', '.join(instruments)}",
+    )
+    parser.add_argument("--port", type=int, default=address[1])
+    parser.add_argument(
+        "--simulate", action="store_true", help="serve simulated instruments"
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        help="record all SCPI transactions and write them to this JSON file on exit",
+    )
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in instruments]
+    if unknown:
+        parser.error(f"unknown instruments {unknown}")
+    serve(
+        args.names or list(instruments),
+        (address[0], args.port),
+        simulate=args.simulate,
+        trace_path=args.trace,
+    )
@@ -0,0 +1,347 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from calibration import amplifier_synthesizer, file_date, file_path
+from results_writer import column_name, write_json_atomic
+
+store_path = file_path / "measurement_store"
+
+# bump when the layout of the store or the conversions applied change, this
+# reingests every file
+format_version = 1
+
+dtype = "<f8"
+
+
+def synthesizer(kind: str) -> Callable[[re.Match], Dict[str, Any]]:
+    def metadata(match: re.Match) -> Dict[str, Any]:
+        serial, output = match.groups() if match.groups() else (None, None)
+        return dict(
+            [
+                ("kind", kind),
+                ("device", "SynthHD"),
+                ("serial", None if serial is None else f"SN{serial}"),
+                ("rf_output", output),
+            ]
+        )
+
+    return metadata
+
+
+def amplifier(
+    band: str, kind: str, other_gate: Optional[bool] = None
+) -> Callable[[re.Match], Dict[str, Any]]:
+    # the amplifier scans were all driven by the same synthesizer output
+    serial, output = amplifier_synthesizer.split("_")
+
+    def metadata(match: re.Match) -> Dict[str, Any]:
+        entry = dict(
+            [
+                ("kind", kind),
+                ("device", "amplifier"),
+                ("band", band),
+                ("amplifier", int(match[1])),
+                ("serial", serial),
+                ("rf_output", output),
+            ]
+        )
+        if other_gate is not None:
+            entry["other_gate"] = other_gate
+        return entry
+
+    return metadata
+
+
+# filename pattern -> (number of leading scan axis columns, metadata), the first
+# matching pattern is used
+dataset_patterns: List[Tuple[re.Pattern, int, Callable[[re.Match], Dict[str, Any]]]] = [
+    (
+        re.compile(r"_synthHDPro_SN(\d+)_(RF[AB])_scan\.csv$"),
+        2,
+        synthesizer("frequency scan"),
+    ),
+    (re.compile(r"_synthHD_scan\.csv$"), 2, synthesizer("frequency scan")),
+    (
+        re.compile(r"_synthHDPro_SN(\d+)_(RF[AB])_time_monitoring\.csv$"),
+        2,
+        synthesizer("time monitoring"),
+    ),
+    (
+        re.compile(r"_synthHD_time_monitoring\.csv$"),
+        2,
+        synthesizer("time monitoring"),
+    ),
+    (re.compile(r"_synthpower_vg(\d)\.csv$"), 2, amplifier("26_7", "power vg scan")),
+    (
+        re.compile(r"_vg(\d)_no_vg\d_synth_power_scan_n08Vg\.csv$"),
+        1,
+        amplifier("26_7", "power scan", other_gate=False),
+    ),
+    (re.compile(r"_vg(\d)_vg\d_scan_both\.csv$"), 2, amplifier("26_7", "vg1 vg2 scan")),
+    (
+        re.compile(r"_vg(\d)_no_vg\d\.csv$"),
+        1,
+        amplifier("26_7", "vg scan", other_gate=False),
+    ),
+    (
+        re.compile(r"_vg(\d)_vg\d\.csv$"),
+        1,
+        amplifier("26_7", "vg scan", other_gate=True),
+    ),
+    (re.compile(r"_a(\d)_synthd_power\.csv$"), 1, amplifier("40", "power scan")),
+    (re.compile(r"_a(\d)_power_time\.csv$"), 1, amplifier("40", "time monitoring")),
+    (re.compile(r"_a(\d)\.csv$"), 1, amplifier("40", "supply scan")),
+]
+
+# filename pattern -> wrong header -> header
+header_corrections: List[Tuple[re.Pattern, Dict[str, str]]] = [
+    # the SynthHD setpoint was labeled [W] but is in dBm
+    (
+        re.compile(r"_a\d_synthd_power\.csv$"),
+        dict([("synthHD Pro power [W]", "synthHD Pro power [dBm]")]),
+    ),
+]
+
+
+def file_timestamp(fname: str) -> str:
+    # ISO date (and time if in the filename, e.g. 2023-02-11T12_58_09)
+    date = file_date(fname)
+    if not date:
+        return ""
+    timestamp = datetime.date(*date).isoformat()
+    match = re.match(r"[\d_-]+T(\d{2})_(\d{2})_(\d{2})", fname)
+    if match is not None:
+        timestamp += "T" + ":".join(match.groups())
+    return timestamp
+
+
+def unit(header: str) -> str:
+    # "det power [dBm]" -> "dBm"
+    match = re.search(r"\[(.*)\]\s*$", header)
+    return "" if match is None else match[1]
+
+
+def parse_timestamp(value: str) -> float:
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def read_csv(fname: Path) -> Tuple[List[str], np.ndarray]:
+    # header and float64 data, isoformat timestamps are converted to s since epoch
+    with open(fname, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    for pattern, corrections in header_corrections:
+        if pattern.search(fname.name):
+            header = [corrections.get(h, h) for h in header]
+
+    converters = []
+    for i, h in enumerate(header):
+        if unit(h) == "isoformat":
+            header[i] = h.replace("[isoformat]", "[s since epoch]")
+            converters.append(parse_timestamp)
+        else:
+            converters.append(float)
+    data = np.array(
+        [[convert(v) for convert, v in zip(converters, row)] for row in rows],
+        dtype=dtype,
+    ).reshape(len(rows), len(header))
+    return header, data
+
+
+def file_sha1(fname: Path) -> str:
+    return hashlib.sha1(fname.read_bytes()).hexdigest()
+
+
+class MeasurementStore:
+    """
+    Columnar store of the measurement CSVs. Every CSV is parsed once into one raw
+    float64 file per column and described in index.json: device, serial, RF
+    output, band, amplifier, scan axes, columns and timestamp, parsed from the
+    filename. Queries are a lookup in the index, the columns are memory mapped.
+
+    store = MeasurementStore()
+    store.ingest()
+    data = store.load(store.latest(kind="frequency scan", serial="SN415",
+                                   rf_output="RFB"))
+    data["det_power_dBm"]
+    """
+
+    def __init__(self, path: Path = store_path):
+        self.path = Path(path)
+        self.index: List[Dict[str, Any]] = []
+        index_path = self.path / "index.json"
+        if index_path.exists():
+            with open(index_path) as f:
+                index = json.load(f)
+            if index["format_version"] == format_version:
+                self.index = index["datasets"]
+
+    def write_index(self):
+        self.path.mkdir(exist_ok=True)
+        write_json_atomic(
+            self.path / "index.json",
+            dict([("format_version", format_version), ("datasets", self.index)]),
+        )
+
+    def ingest(self, path: Path = file_path, verbose: bool = False) -> List[str]:
+        # (re)ingest new and changed CSVs, drop removed ones; returns the ids of
+        # the ingested datasets
+        existing = dict((entry["id"], entry) for entry in self.index)
+        index = []
+        ingested = []
+        by_sha1: Dict[str, str] = {}
+        for fname in sorted(path.glob("measurements */data/*.csv")):
+            source = fname.relative_to(path).as_posix()
+            stat = fname.stat()
+            entry = existing.get(fname.stem)
+            if (
+                entry is None
+                or entry["source"] != source
+                or entry["stat"] != [stat.st_mtime_ns, stat.st_size]
+            ):
+                entry = self.ingest_file(fname, source, by_sha1)
+                ingested.append(entry["id"])
+                status = "ingested"
+            else:
+                status = "up to date"
+            by_sha1.setdefault(entry["sha1"], entry["id"])
+            index.append(entry)
+            if verbose:
+                print(f"{entry['id']:<55} {status}")
+
+        # datasets of removed files
+        ids = set(entry["id"] for entry in index)
+        for dataset_id in set(existing) - ids:
+            shutil.rmtree(self.path / dataset_id, ignore_errors=True)
+
+        self.index = sorted(index, key=lambda entry: (entry["timestamp"], entry["id"]))
+        self.write_index()
+        return ingested
+
+    def ingest_file(
+        self, fname: Path, source: str, by_sha1: Dict[str, str]
+    ) -> Dict[str, Any]:
+        n_axes, metadata = 0, dict([("kind", "unknown")])
+        for pattern, n, fn in dataset_patterns:
+            match = pattern.search(fname.name)
+            if match is not None:
+                n_axes, metadata = n, fn(match)
+                break
+
+        header, data = read_csv(fname)
+        stat = fname.stat()
+        entry = dict(
+            [
+                ("id", fname.stem),
+                ("source", source),
+                ("stat", [stat.st_mtime_ns, stat.st_size]),
+                ("sha1", file_sha1(fname)),
+                ("timestamp", file_timestamp(fname.name)),
+            ]
+        )
+        entry.update(metadata)
+        entry["axes"] = header[:n_axes]
+        entry["columns"] = [
+            dict([("name", column_name(h)), ("header", h), ("unit", unit(h))])
+            for h in header
+        ]
+        entry["rows"] = len(data)
+        # identical content is listed under both names, e.g. a copy of a scan
+        # saved under an older naming scheme
+        if entry["sha1"] in by_sha1:
+            entry["duplicate_of"] = by_sha1[entry["sha1"]]
+
+        directory = self.path / entry["id"]
+        directory.mkdir(parents=True, exist_ok=True)
+        for column, values in zip(entry["columns"], data.T):
+            values.tofile(directory / f"{column['name']}.f8")
+        return entry
+
+    def find(self, duplicates: bool = False, **criteria) -> List[Dict[str, Any]]:
+        # index entries matching all criteria, oldest first
+        return [
+            entry
+            for entry in self.index
+            if (duplicates or "duplicate_of" not in entry)
+            and all(entry.get(key) == value for key, value in criteria.items())
+        ]
+
+    def latest(self, **criteria) -> Dict[str, Any]:
+        entries = self.find(**criteria)
+        if not entries:
+            raise KeyError(f"no dataset with {criteria}")
+        return entries[-1]
+
+    def entry(self, dataset_id: str) -> Dict[str, Any]:
+        for entry in self.index:
+            if entry["id"] == dataset_id:
+                return entry
+        raise KeyError(dataset_id)
+
+    def dataset(self, fname: Path, path: Path = file_path) -> Dict[str, Any]:
+        # index entry of a CSV under path, the store is updated first if the file
+        # is new or changed
+        source = fname.relative_to(path).as_posix()
+        stat = fname.stat()
+        key = [stat.st_mtime_ns, stat.st_size]
+        if not any(e["source"] == source and e["stat"] == key for e in self.index):
+            self.ingest(path)
+        for entry in self.index:
+            if entry["source"] == source:
+                return entry
+        raise KeyError(source)
+
+    def load(self, entry: Any, mmap: bool = True) -> Dict[str, np.ndarray]:
+        # columns by name of an index entry or dataset id, read only memory maps
+        # unless mmap is False
+        if isinstance(entry, str):
+            entry = self.entry(entry)
+        directory = self.path / entry["id"]
+        data = {}
+        for column in entry["columns"]:
+            fname = directory / f"{column['name']}.f8"
+            if mmap and entry["rows"] > 0:
+                data[column["name"]] = np.memmap(
+                    fname, dtype=dtype, mode="r", shape=(entry["rows"],)
+                )
+            else:
+                data[column["name"]] = np.fromfile(fname, dtype=dtype)
+        return data
+
+    def array(self, entry: Any) -> np.ndarray:
+        # rows x columns like np.loadtxt of the source CSV
+        return np.column_stack(list(self.load(entry, mmap=False).values()))
+
+
+def read_source(fname: Path, path: Path = file_path) -> np.ndarray:
+    # rows x columns of a measurement CSV under path, from the store in path
+    store = MeasurementStore(path / store_path.name)
+    return store.array(store.dataset(fname, path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Ingest the measurement CSVs into the columnar store"
+    )
+    parser.add_argument(
+        "--store", type=Path, default=store_path, help="store directory"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="reingest all files from scratch"
+    )
+    args = parser.parse_args()
+
+    store = MeasurementStore(args.store)
+    if args.force:
+        store.index = []
+    store.ingest(file_path, verbose=True)
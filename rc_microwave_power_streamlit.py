@@ -1,11 +1,13 @@
-from pathlib import Path
-from typing import Sequence
-
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import streamlit as st
-from scipy.interpolate import RegularGridInterpolator, interp1d
+
+from calibration import load_calibration
+from calibration_chain import load_calibration_chain
+from calibration_inverse import load_inverse_calibration
+from calibration_temperature import calibration_temperature
+from vg_optimizer import load_vg_optimizer
 
 st.set_page_config(
     page_title="CeNTREX Rotational Cooling Microwave Power Settings",
@@ -13,154 +15,34 @@ st.set_page_config(
     layout="centered",
 )
 
-file_path = Path(__file__).parent
-
-
-def interpolate_1D(fname: str, path: Path, indices: Sequence[int]) -> interp1d:
-    data = np.loadtxt(path / fname, skiprows=1, delimiter=",")
-
-    x, y = data.T[indices]
-    return interp1d(x, y)
-
-
-def interpolate_2D(
-    fname: str, path: Path, indices: Sequence[int]
-) -> RegularGridInterpolator:
-    data = np.loadtxt(path / fname, skiprows=1, delimiter=",")
-
-    x, y, z = data.T[indices]
-    _, idx = np.unique(x, return_index=True)
-    x = x[np.sort(idx)]
-    _, idy = np.unique(y, return_index=True)
-    y = y[np.sort(idy)]
-
-    return RegularGridInterpolator((x, y), z.reshape(len(x), len(y)))
-
-
-# Calibrate SynthHD
-
-
-fname_RFA = "2023_02_13_synthHDPro_SN415_RFA_scan.csv"
-fname_RFB = "2023_02_14_synthHDPro_SN415_RFB_scan.csv"
-
-fn_interpolate_SN415_RFA = interpolate_2D(
-    fname_RFA, file_path / "measurements SynthHD/data", indices=[0, 1, 2]
-)
-fn_interpolate_SN415_RFB = interpolate_2D(
-    fname_RFB, file_path / "measurements SynthHD/data", indices=[0, 1, 2]
-)
-
-fname_RFB = "2023_02_10_synthHDPro_SN416_RFB_scan.csv"
-fn_interpolate_SN416_RFB = interpolate_2D(
-    fname_RFB, file_path / "measurements SynthHD/data", indices=[0, 1, 2]
-)
-
-
-# Calibrate 26.7 GHz
-
-
-fname = "2023_2_9_synthpower_vg1.csv"
-
-fn_interpolate_26_6GHz_A1 = interpolate_2D(
-    fname, file_path / "measurements 26 GHz 2023_2/data", [0, 1, 2]
-)
-# dBm setpoints from SynthHD Pro SN 416 RFB
-setpoints_416 = fn_interpolate_26_6GHz_A1.grid[0]
-points = np.vstack([np.ones(len(setpoints_416)) * 13.3e9, setpoints_416]).T
-real_power = fn_interpolate_SN416_RFB(points)
-
-grid = list(fn_interpolate_26_6GHz_A1.grid)
-grid[0] = real_power
-fn_interpolate_26_6GHz_A1.grid = tuple(grid)
-
-fname = "2023_2_9_synthpower_vg2.csv"
-
-fn_interpolate_26_6GHz_A2 = interpolate_2D(
-    fname, file_path / "measurements 26 GHz 2023_2/data", [0, 1, 2]
-)
-# dBm setpoints from SynthHD Pro SN 416 RFB
-setpoints_416 = fn_interpolate_26_6GHz_A2.grid[0]
-points = np.vstack([np.ones(len(setpoints_416)) * 13.3e9, setpoints_416]).T
-real_power = fn_interpolate_SN416_RFB(points)
-
-grid = list(fn_interpolate_26_6GHz_A2.grid)
-grid[0] = real_power
-fn_interpolate_26_6GHz_A2.grid = tuple(grid)
-
-# Calibrate 40 GHz
-
-fname = "2023_2_10_a1_synthd_power.csv"
-
-fn_interpolate_40GHz_A1 = interpolate_1D(
-    fname, file_path / "measurements 40 GHz 2023_2/data", indices=[0, 1]
-)
-# forgot to add 20 dBm to compensate attenuation from directional coupler
-fn_interpolate_40GHz_A1.y += 20
-
-# dBm setpoints from SynthHD Pro SN 416 RFB
-setpoints_416 = fn_interpolate_40GHz_A1.x
-points = np.vstack([np.ones(len(setpoints_416)) * 10e9, setpoints_416]).T
-real_power = fn_interpolate_SN416_RFB(points)
-
-fn_interpolate_40GHz_A1.x = real_power
-
-fname = "2023_2_10_a2_synthd_power.csv"
-
-fn_interpolate_40GHz_A2 = interpolate_1D(
-    fname, file_path / "measurements 40 GHz 2023_2/data", indices=[0, 1]
-)
-
-# forgot to add 20 dBm to compensate attenuation from directional coupler
-fn_interpolate_40GHz_A2.y += 20
-
-# dBm setpoints from SynthHD Pro SN 416 RFB
-setpoints_416 = fn_interpolate_40GHz_A2.x
-points = np.vstack([np.ones(len(setpoints_416)) * 10e9, setpoints_416]).T
-real_power = fn_interpolate_SN416_RFB(points)
-
-fn_interpolate_40GHz_A2.x = real_power
-
-calibration_data = dict(
-    [
-        ("26_7", (fn_interpolate_26_6GHz_A1, fn_interpolate_26_6GHz_A2)),
-        ("40", (fn_interpolate_40GHz_A1, fn_interpolate_40GHz_A2)),
-        (
-            "synthesizers",
-            dict(
-                [
-                    (
-                        "SynthHD Pro SN415",
-                        (fn_interpolate_SN415_RFA, fn_interpolate_SN415_RFB),
-                    ),
-                    ("SynthHD Pro SN416", (fn_interpolate_SN416_RFB,)),
-                ]
-            ),
-        ),
-    ]
-)
-
-# with open(file_path / "calibration.pkl", "rb") as f:
-#     calibration_data = pickle.load(f)
+calibration_data = load_calibration()
 
 with st.sidebar:
     synth_select = st.selectbox(
         "Synthesizer", options=["SynthHD Pro SN415", "SynthHD Pro SN416"]
     )
-    output_select = st.selectbox("Output", options=["RFA", "RFB"])
+    output_select = st.selectbox(
+        "Output", options=list(calibration_data["synthesizers"][synth_select])
+    )
 
     system_select = st.selectbox("System", options=["26.7 GHz", "40 GHz"])
 
-# print(synth_select)
-# print(calibration_data["synthesizers"].keys())
-ids = 0 if output_select == "RFA" else 1
-synthesizer = calibration_data["synthesizers"][synth_select][ids]
+    temperature_select = st.number_input(
+        "SynthHD temperature [C]", 15.0, 50.0, calibration_temperature, step=0.5
+    )
+
+synthesizer = calibration_data["synthesizers"][synth_select][output_select]
 
 if system_select == "26.7 GHz":
     synth_freq = 26.7e9 / 2
     system_calibration = calibration_data["26_7"]
+    chain = load_calibration_chain("26_7")
+    inverse = load_inverse_calibration("26_7")
 elif system_select == "40 GHz":
     synth_freq = 40e9 / 4
     system_calibration = calibration_data["40"]
+    chain = load_calibration_chain("40")
+    inverse = load_inverse_calibration("40")
 
 
 setpoints = np.linspace(-30, 5, 501)
@@ -190,16 +72,26 @@ if system_select == "26.7 GHz":
     col1, col2 = st.columns(2)
     with col1:
         vg_select1 = st.number_input("Vg1 [V]", -1.5, -0.5, -0.7, step=0.01)
-        st.write(
-            "Amplifier 1:"
-            f" {system_calibration[0]([real_power, -vg_select1])[0]:.1f} dBm"
+        amplifier_power = chain(
+            synth_select,
+            output_select,
+            setpoint_select,
+            -vg_select1,
+            0,
+            temperature_select,
         )
+        st.write(f"Amplifier 1: {amplifier_power:.1f} dBm")
     with col2:
         vg_select2 = st.number_input("Vg2 [V]", -1.5, -0.5, -0.7, step=0.01)
-        st.write(
-            "Amplifier 2:"
-            f" {system_calibration[1]([real_power, -vg_select2])[0]:.1f} dBm"
+        amplifier_power = chain(
+            synth_select,
+            output_select,
+            setpoint_select,
+            -vg_select2,
+            1,
+            temperature_select,
         )
+        st.write(f"Amplifier 2: {amplifier_power:.1f} dBm")
 
     real_powers = real_powers[
         real_powers
@@ -246,9 +138,15 @@ elif system_select == "40 GHz":
 
     col1, col2 = st.columns(2)
     with col1:
-        st.write(f"Amplifier 1: {system_calibration[0](real_power):.1f} dBm")
+        amplifier_power = chain(
+            synth_select, output_select, setpoint_select, None, 0, temperature_select
+        )
+        st.write(f"Amplifier 1: {amplifier_power:.1f} dBm")
     with col2:
-        st.write(f"Amplifier 2: {system_calibration[1](real_power):.1f} dBm")
+        amplifier_power = chain(
+            synth_select, output_select, setpoint_select, None, 1, temperature_select
+        )
+        st.write(f"Amplifier 2: {amplifier_power:.1f} dBm")
 
     real_powers = real_powers[
         real_powers
@@ -280,3 +178,76 @@ elif system_select == "40 GHz":
     graph.add_vline(x=real_power, line_width=2, line_dash="dash")
     graph.update_layout(yaxis_title="output power [dBm]")
     st.plotly_chart(graph)
+
+
+target_select = st.number_input(
+    "Target Amplifier Output [dBm]", -20.0, 40.0, 20.0, step=0.25
+)
+if system_select == "26.7 GHz":
+    vg_targets = [-vg_select1, -vg_select2]
+else:
+    vg_targets = [None, None]
+
+col1, col2 = st.columns(2)
+for amplifier, col in enumerate([col1, col2]):
+    solution = inverse.setpoint(
+        target_select,
+        synth_select,
+        output_select,
+        vg_targets[amplifier],
+        amplifier,
+        temperature_select,
+    )
+    with col:
+        if solution.feasible:
+            st.write(f"Amplifier {amplifier + 1} setpoint: {solution.value:.2f} dBm")
+        else:
+            st.write(
+                f"Amplifier {amplifier + 1}: not reachable, output range"
+                f" {solution.lower:.1f} to {solution.upper:.1f} dBm"
+            )
+
+if system_select == "26.7 GHz":
+    st.subheader("Joint Vg1/Vg2 operating point")
+    optimizer = load_vg_optimizer(vg_step=0.005)
+    input_power = float(
+        chain.synth_power(
+            synth_select, output_select, setpoint_select, temperature_select
+        )
+    )
+    front = optimizer.front(input_power)
+    point = optimizer.operating_point(input_power, target_select)
+    if len(front) == 0:
+        st.write(f"Input power {input_power:.1f} dBm outside of the calibration")
+    elif point is None:
+        st.write(
+            f"{target_select:.1f} dBm from both amplifiers not reachable, at most"
+            f" {front['output'].max():.1f} dBm"
+        )
+    else:
+        st.write(
+            f"Vg1 = {-point['vg1']:.3f} V, Vg2 = {-point['vg2']:.3f} V: amplifier 1"
+            f" {point['a1']:.1f} dBm, amplifier 2 {point['a2']:.1f} dBm,"
+            f" {point['dc_power']:.1f} ± {point['dc_spread']:.1f} W drain power"
+        )
+
+    df = pd.DataFrame(
+        dict(
+            [
+                ("drain power [W]", front["dc_power"]),
+                ("weaker output [dBm]", front["output"]),
+                ("Vg1 [V]", -front["vg1"]),
+                ("Vg2 [V]", -front["vg2"]),
+            ]
+        )
+    )
+    graph = px.line(
+        df,
+        x="drain power [W]",
+        y="weaker output [dBm]",
+        hover_data=["Vg1 [V]", "Vg2 [V]"],
+        markers=True,
+        title=f"Pareto optimal gate voltages @ {input_power:.1f} dBm input",
+    )
+    graph.add_hline(y=target_select, line_width=2, line_dash="dash")
+    st.plotly_chart(graph)
@@ -0,0 +1,238 @@
+import csv
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+
+def column_name(header: str) -> str:
+    # "det power [dBm]" -> "det_power_dBm"
+    return re.sub(r"\W+", "_", header).strip("_")
+
+
+def metadata_path(fname: Union[str, Path]) -> Path:
+    return Path(fname).with_suffix(".json")
+
+
+def columns_path(fname: Union[str, Path]) -> Path:
+    fname = Path(fname)
+    return fname.with_name(f"{fname.stem}_columns")
+
+
+def write_json_atomic(fname: Path, data: Dict[str, Any]):
+    fname_tmp = fname.with_name(f"{fname.name}.{os.getpid()}.tmp")
+    with open(fname_tmp, "w") as f:
+        json.dump(data, f, indent=2, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fname_tmp, fname)
+
+
+class ResultsWriter:
+    """
+    Streams scan results to a CSV file that stays open. Rows are buffered and
+    written, flushed and fsynced to disk every flush_rows rows or flush_interval
+    seconds, so a crash loses at most that much data. The scan metadata is stored
+    in a JSON sidecar next to the CSV.
+
+    With binary=True every column is additionally appended to a raw float64 file
+    in <stem>_columns/, which read_columns loads (memory mapped) without parsing.
+
+    append=True continues an existing file with the same header, e.g. to resume an
+    interrupted scan; a partially written last row is discarded. A file without a
+    sidecar gets one rebuilt from its header, it is never overwritten.
+    """
+
+    def __init__(
+        self,
+        fname: Union[str, Path],
+        header: Sequence[str],
+        metadata: Optional[Dict[str, Any]] = None,
+        flush_rows: int = 100,
+        flush_interval: float = 5.0,
+        binary: bool = False,
+        append: bool = False,
+    ):
+        self.fname = Path(fname)
+        self.header = list(header)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rows: List[Sequence[Any]] = []
+        self.n_rows = 0
+        self.t_flush = time.monotonic()
+
+        self.metadata = dict(
+            [
+                ("file", self.fname.name),
+                ("header", self.header),
+                ("started", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                ("complete", False),
+                ("rows", 0),
+                ("metadata", metadata or {}),
+            ]
+        )
+
+        append = append and self.fname.exists()
+        if append:
+            self.n_rows = self.resume()
+
+        self.csv_file = open(self.fname, "a" if append else "w", newline="")
+        self.writer = csv.writer(self.csv_file)
+        if self.csv_file.tell() == 0:
+            self.writer.writerow(self.header)
+
+        self.column_files = []
+        if binary:
+            directory = columns_path(self.fname)
+            directory.mkdir(exist_ok=True)
+            names = [column_name(h) for h in self.header]
+            self.metadata["columns"] = dict(
+                [
+                    ("directory", directory.name),
+                    ("dtype", "<f8"),
+                    ("files", [f"{name}.f8" for name in names]),
+                ]
+            )
+            if append:
+                self.resume_columns(directory, names)
+            self.column_files = [
+                open(directory / f"{name}.f8", "ab" if append else "wb")
+                for name in names
+            ]
+        self.write_metadata()
+        self.flush()
+
+    def resume(self) -> int:
+        # keep the metadata of the first run, drop a torn last row; returns the
+        # number of complete rows
+        with open(self.fname, "rb") as f:
+            content = f.read()
+        if not content:
+            return 0
+        if metadata_path(self.fname).exists():
+            previous = read_metadata(self.fname)
+        else:
+            # written without a sidecar, e.g. before the ResultsWriter, rebuilt
+            # from the CSV header
+            line = content.split(b"\n", 1)[0].decode().rstrip("\r")
+            previous = dict(
+                [
+                    ("header", next(csv.reader([line]))),
+                    ("started", self.metadata["started"]),
+                ]
+            )
+            self.metadata["rebuilt"] = True
+        if previous["header"] != self.header:
+            raise ValueError(
+                f"{self.fname} has header {previous['header']}, not {self.header}"
+            )
+        self.metadata["started"] = previous["started"]
+        self.metadata["resumed"] = previous.get("resumed", []) + [
+            time.strftime("%Y-%m-%dT%H:%M:%S")
+        ]
+
+        end = content.rfind(b"\n") + 1
+        with open(self.fname, "rb+") as f:
+            f.truncate(end)
+        return max(content[:end].count(b"\n") - 1, 0)
+
+    def resume_columns(self, directory: Path, names: Sequence[str]):
+        # the CSV is written first, so the column files can only be ahead of it if
+        # the CSV row was torn, or behind it if the crash happened in between
+        itemsize = np.dtype("<f8").itemsize
+        sizes = [
+            (
+                (directory / f"{name}.f8").stat().st_size // itemsize
+                if (directory / f"{name}.f8").exists()
+                else 0
+            )
+            for name in names
+        ]
+        if all(size >= self.n_rows for size in sizes):
+            for name in names:
+                with open(directory / f"{name}.f8", "rb+") as f:
+                    f.truncate(self.n_rows * itemsize)
+            return
+        data = np.loadtxt(self.fname, delimiter=",", skiprows=1, ndmin=2)
+        for name, column in zip(names, data.T):
+            column.astype("<f8").tofile(directory / f"{name}.f8")
+
+    def write_metadata(self):
+        self.metadata["rows"] = self.n_rows
+        write_json_atomic(metadata_path(self.fname), self.metadata)
+
+    def write(self, row: Sequence[Any]):
+        self.rows.append(row)
+        if (
+            len(self.rows) >= self.flush_rows
+            or time.monotonic() - self.t_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def write_rows(self, rows: Sequence[Sequence[Any]]):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        # write the buffered rows and make sure they reached the disk
+        if self.rows:
+            self.writer.writerows(self.rows)
+            if self.column_files:
+                columns = np.asarray(self.rows, dtype="<f8").T
+                for f, column in zip(self.column_files, columns):
+                    column.tofile(f)
+            self.n_rows += len(self.rows)
+            self.rows = []
+        for f in [self.csv_file] + self.column_files:
+            f.flush()
+            os.fsync(f.fileno())
+        self.t_flush = time.monotonic()
+
+    def close(self, complete: bool = True):
+        if self.csv_file.closed:
+            return
+        self.flush()
+        for f in [self.csv_file] + self.column_files:
+            f.close()
+        self.metadata["complete"] = complete
+        self.metadata["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.write_metadata()
+
+    def __enter__(self) -> "ResultsWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # an interrupted scan keeps its data but is marked incomplete
+        self.close(complete=exc_type is None)
+
+
+def read_metadata(fname: Union[str, Path]) -> Dict[str, Any]:
+    with open(metadata_path(fname)) as f:
+        return json.load(f)
+
+
+def read_columns(fname: Union[str, Path], mmap: bool = True) -> Dict[str, np.ndarray]:
+    # columns written with binary=True by header name; the row count follows from
+    # the file sizes, so an interrupted scan can be read too
+    metadata = read_metadata(fname)
+    columns = metadata["columns"]
+    directory = Path(fname).with_name(columns["directory"])
+    sizes = [
+        (directory / name).stat().st_size // np.dtype(columns["dtype"]).itemsize
+        for name in columns["files"]
+    ]
+    n_rows = min(sizes)
+    data = {}
+    for header, name in zip(metadata["header"], columns["files"]):
+        if mmap and n_rows > 0:
+            values = np.memmap(
+                directory / name, dtype=columns["dtype"], mode="r", shape=(n_rows,)
+            )
+        else:
+            values = np.fromfile(directory / name, dtype=columns["dtype"])[:n_rows]
+        data[header] = values
+    return data
@@ -0,0 +1,53 @@
+import threading
+from typing import Union
+
+import numpy as np
+import numpy.typing as npt
+
+
+class RingBuffer:
+    """
+    Preallocated ring buffer of structured (or plain) rows; appending never
+    allocates, the oldest rows are overwritten once capacity is reached.
+    """
+
+    def __init__(self, capacity: int, dtype: npt.DTypeLike):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        # rows appended in total, the next row goes to total % capacity
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    def append(self, row: Union[np.void, np.ndarray, tuple]):
+        with self.lock:
+            self.buffer[self.total % self.capacity] = row
+            self.total += 1
+
+    def extend(self, rows: np.ndarray):
+        n_rows = len(rows)
+        # only the last capacity rows survive
+        rows = rows[-self.capacity :]
+        with self.lock:
+            start = (self.total + n_rows - len(rows)) % self.capacity
+            n_first = min(len(rows), self.capacity - start)
+            self.buffer[start : start + n_first] = rows[:n_first]
+            self.buffer[: len(rows) - n_first] = rows[n_first:]
+            self.total += n_rows
+
+    def latest(self, n: int = 1) -> np.ndarray:
+        # copy of the n most recent rows, oldest first
+        with self.lock:
+            n = min(n, len(self))
+            index = (self.total - n + np.arange(n)) % self.capacity
+            return self.buffer[index]
+
+    def array(self) -> np.ndarray:
+        # copy of all rows held, oldest first
+        return self.latest(self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.total = 0
@@ -1,8 +1,7 @@
-import csv
-
 import numpy as np
 from windfreak import SynthHD
 
+from results_writer import ResultsWriter
 from SPD3303X import SPD3303X
 from startup_26GHz import enable_26GHz_power
 
@@ -23,22 +22,28 @@ assert psu_vg.idn == ""
 assert psu_2.idn == ""
 assert psu_3.idn == ""
 
-with open(fname, "w") as csv_file:
-    writer = csv.writer(csv_file)
-    # write header
-    writer.writerow(["frequency", "power", "vg", "measured power"])
-
-enable_26GHz_power(psu_vg, psu_2, psu_3)
+enable_26GHz_power(psu_vg, psu_2)
 
 synthhd_pro[0].frequency = 26e9
 synthhd_pro[0].power = 0
 synthhd_pro[0].enable = True
 
-for vg in np.linspace(1.5, 0.7, 51):
-    psu_vg.ch1_voltage_setpoint = vg
-    measured_power = 0
-    with open(fname, "a") as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(
+metadata = dict(
+    [
+        ("psu_vg", psu_vg.idn),
+        ("psu_2", psu_2.idn),
+        ("psu_3", psu_3.idn),
+        ("synthhd", resource_name_windfreak),
+        ("frequency [Hz]", synthhd_pro[0].frequency),
+        ("power [dBm]", synthhd_pro[0].power),
+    ]
+)
+with ResultsWriter(
+    fname, ["frequency", "power", "vg", "measured power"], metadata
+) as writer:
+    for vg in np.linspace(1.5, 0.7, 51):
+        psu_vg.ch1_voltage_setpoint = vg
+        measured_power = 0
+        writer.write(
             [synthhd_pro[0].frequency, synthhd_pro[0].power, vg, measured_power]
         )
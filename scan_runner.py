@@ -0,0 +1,142 @@
+import csv
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+
+from results_writer import ResultsWriter, metadata_path, read_metadata
+
+Index = Tuple[int, ...]
+
+
+def traversal(shape: Sequence[int], order: str = "serpentine") -> Iterator[Index]:
+    """
+    Grid indices with the last axis varying fastest. In serpentine order every axis
+    reverses direction whenever an outer axis steps, so consecutive points differ
+    by a single step of a single axis (e.g. no jump from +5 dBm back to -30 dBm).
+    """
+    if order not in ("raster", "serpentine"):
+        raise ValueError(f"unknown scan order {order}")
+    for flat in range(int(np.prod(shape))):
+        index = list(np.unravel_index(flat, shape))
+        if order == "serpentine":
+            # an axis runs backwards if the outer axes took an odd number of steps
+            for axis, n in enumerate(shape):
+                if (flat // int(np.prod(shape[axis:]))) % 2:
+                    index[axis] = n - 1 - index[axis]
+        yield tuple(int(i) for i in index)
+
+
+class GridScan:
+    """
+    Scan over the cartesian product of axes, e.g. dict(frequency=..., power=...),
+    streamed to a CSV with a ResultsWriter. Completed points are read back from the
+    CSV on restart and skipped, so an interrupted scan continues where it stopped.
+
+    setters are called only when their axis value changes, measure is called with
+    the full point and returns the measured columns.
+    """
+
+    def __init__(
+        self,
+        axes: Dict[str, Sequence[float]],
+        measure: Callable[[Dict[str, float]], Sequence[float]],
+        header: Sequence[str],
+        setters: Optional[Dict[str, Callable[[float], None]]] = None,
+        order: str = "serpentine",
+    ):
+        self.axes = dict(
+            (name, np.asarray(values, float)) for name, values in axes.items()
+        )
+        self.measure = measure
+        self.header = list(header)
+        self.setters = {} if setters is None else setters
+        self.order = order
+        self.shape = tuple(len(values) for values in self.axes.values())
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.axes) + self.header
+
+    def definition(self) -> Dict:
+        return dict(
+            [
+                (
+                    "axes",
+                    dict((name, values.tolist()) for name, values in self.axes.items()),
+                ),
+                ("header", self.header),
+            ]
+        )
+
+    def grid_index(self, values: Sequence[float]) -> Optional[Index]:
+        index = []
+        for axis, value in zip(self.axes.values(), values):
+            i = int(np.argmin(np.abs(axis - value)))
+            if not np.isclose(axis[i], value, rtol=1e-9, atol=1e-12):
+                return None
+            index.append(i)
+        return tuple(index)
+
+    def completed(self, fname: Union[str, Path]) -> Set[Index]:
+        # grid points with a complete row in an existing scan file
+        fname = Path(fname)
+        if not fname.exists():
+            return set()
+        # a file without a sidecar is resumed from the rows on the grid alone
+        if metadata_path(fname).exists():
+            scan = read_metadata(fname)["metadata"].get("scan")
+            if scan != self.definition():
+                raise ValueError(f"{fname} holds a different scan, not resuming it")
+
+        with open(fname, newline="") as f:
+            # anything after the last newline is a torn row, measured again
+            lines = f.read().split("\n")[1:-1]
+
+        done = set()
+        n_axes = len(self.axes)
+        for row in csv.reader(lines):
+            if len(row) != len(self.columns):
+                continue
+            try:
+                index = self.grid_index([float(v) for v in row[:n_axes]])
+            except ValueError:
+                continue
+            if index is not None:
+                done.add(index)
+        return done
+
+    def run(
+        self,
+        fname: Union[str, Path],
+        metadata: Optional[Dict] = None,
+        resume: bool = True,
+        progress: Optional[Callable[[int, int], None]] = None,
+        **writer_options,
+    ) -> int:
+        # returns the number of points measured in this run
+        done = self.completed(fname) if resume else set()
+        metadata = dict(metadata or {}, scan=self.definition(), order=self.order)
+        names = list(self.axes)
+        current: Dict[str, float] = {}
+        n_total = int(np.prod(self.shape))
+        n_measured = 0
+
+        with ResultsWriter(
+            fname, self.columns, metadata, append=resume, **writer_options
+        ) as writer:
+            for index in traversal(self.shape, self.order):
+                if index in done:
+                    continue
+                point = dict(
+                    (name, float(self.axes[name][i])) for name, i in zip(names, index)
+                )
+                for name, value in point.items():
+                    if name in self.setters and current.get(name) != value:
+                        self.setters[name](value)
+                        current[name] = value
+                writer.write(list(point.values()) + list(self.measure(point)))
+                n_measured += 1
+                if progress is not None:
+                    progress(len(done) + n_measured, n_total)
+        return n_measured
@@ -0,0 +1,139 @@
+import abc
+import math
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class VerificationError(AssertionError):
+    pass
+
+
+def matches(written: Any, readback: Any, tolerance: float) -> bool:
+    if isinstance(written, float) or isinstance(readback, float):
+        return math.isclose(written, readback, rel_tol=1e-9, abs_tol=tolerance)
+    return written == readback
+
+
+class ShadowedInstrument(abc.ABC):
+    """
+    Write-through shadow of the settings this process wrote to or read from an
+    instrument. Writes that would not change a known setting are skipped and reads
+    of known settings are answered from the shadow.
+
+    Writes are verified either immediately by reading the setting back (readback =
+    True) or, inside a verify_after block, once at the end of the block with
+    *OPC? (if supported) and SYST:ERR?. A failed verification forgets the whole
+    shadow, the instrument was evidently changed behind its back. Call
+    invalidate() if the instrument may have been changed by someone else, e.g.
+    from the front panel; the instrument server does so whenever a client
+    connects.
+    """
+
+    readback = True
+    opc = True
+
+    @abc.abstractmethod
+    def _query(self, command: str) -> str: ...
+
+    @abc.abstractmethod
+    def _write(self, command: str): ...
+
+    def _init_shadow(self, lock: Optional[threading.RLock] = None):
+        # lock shared with the driver, if any, so check and write are atomic
+        self._shadow_lock = threading.RLock() if lock is None else lock
+        self.shadow: Dict[str, Any] = {}
+        self._deferred = 0
+        self._pending: List[str] = []
+
+    def invalidate(self, header: str = ""):
+        # forget one setting, or all settings
+        if header:
+            self.shadow.pop(header, None)
+        else:
+            self.shadow.clear()
+
+    def _get_setting(self, header: str, parse: Callable[[str], Any]) -> Any:
+        with self._shadow_lock:
+            if header not in self.shadow:
+                self.shadow[header] = parse(self._query(f"{header}?"))
+            return self.shadow[header]
+
+    def _set_setting(
+        self,
+        header: str,
+        value: Any,
+        parse: Callable[[str], Any],
+        command_value: str = "",
+        tolerance: float = 0.0,
+        force: bool = False,
+    ):
+        # force writes even an unchanged setting, the shadow may be stale
+        with self._shadow_lock:
+            known = self.shadow.get(header)
+            if not force and known is not None and matches(value, known, tolerance):
+                return
+            self._write(f"{header} {command_value or value}")
+            if self._deferred:
+                self.shadow[header] = value
+                self._pending.append(header)
+            elif self.readback:
+                readback = parse(self._query(f"{header}?"))
+                if not matches(value, readback, tolerance):
+                    self.invalidate()
+                    self.shadow[header] = readback
+                    raise VerificationError(f"{header}: wrote {value}, read {readback}")
+                self.shadow[header] = readback
+            else:
+                self.shadow[header] = value
+
+    def errors(self) -> List[str]:
+        # drain the error queue
+        errors = []
+        while True:
+            error = self._query("SYST:ERR?")
+            code = error.split(",", 1)[0].strip()
+            if not code or int(code) == 0:
+                return errors
+            errors.append(error)
+
+    def verify(self):
+        # one round trip (two with *OPC?) for all writes since the last check
+        pending, self._pending = self._pending, []
+        if self.opc:
+            self._query("*OPC?")
+        errors = self.errors()
+        if errors:
+            # the instrument state is unknown now, not only that of the pending
+            # settings
+            self.invalidate()
+            raise VerificationError(
+                f"{', '.join(errors)} after writing {', '.join(pending)}"
+            )
+
+    @contextmanager
+    def verify_after(self) -> Iterator[None]:
+        """
+        Defer the verification of all writes in the block to a single check at
+        its end, e.g. per scan point:
+
+        with power_meter.verify_after():
+            power_meter.frequency = frequency
+            power_meter.average_count = 16
+
+        If the block raises, the pending settings are forgotten unverified.
+        """
+        self._deferred += 1
+        try:
+            yield
+        except BaseException:
+            if self._deferred == 1:
+                # not verified, so not known either
+                for header in self._pending:
+                    self.invalidate(header)
+                self._pending = []
+            raise
+        finally:
+            self._deferred -= 1
+        if not self._deferred and self._pending:
+            self.verify()
@@ -0,0 +1,305 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+# latency histogram bins [s], 10 per decade from 10 us to 10 s
+latency_bins = np.logspace(-5, 1, 61)
+
+# timeline rows, strings are truncated to the field widths
+trace_dtype = np.dtype(
+    [
+        ("time", "<f8"),
+        ("duration", "<f8"),
+        ("device", "<U32"),
+        ("kind", "<U8"),
+        ("command", "<U64"),
+        ("response_bytes", "<i8"),
+        ("thread", "<U32"),
+        ("error", "<U128"),
+    ]
+)
+
+
+class TraceRecord(NamedTuple):
+    # wall clock time of the start of the transaction [s since epoch]
+    time: float
+    duration: float
+    device: str
+    kind: str
+    command: str
+    response_bytes: int
+    thread: str
+    error: str = ""
+
+
+def command_key(command: str) -> str:
+    # command header without arguments, e.g. "MEAS:VOLT? CH1" -> "MEAS:VOLT?"
+    return command.split(" ", 1)[0]
+
+
+class CommandStats:
+    """
+    Latency statistics of one (device, command header): count, total, max and the
+    histogram over all transactions, percentiles of the most recent window.
+    """
+
+    def __init__(self, window: int, bins: np.ndarray = latency_bins):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bins = bins
+        self.counts = np.zeros(len(bins) - 1, dtype=np.int64)
+        self.recent = RingBuffer(window, "<f8")
+
+    def update(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        # like np.histogram, the last bin includes its right edge
+        index = int(np.searchsorted(self.bins, duration, "right")) - 1
+        if duration == self.bins[-1]:
+            index -= 1
+        if 0 <= index < len(self.counts):
+            self.counts[index] += 1
+        self.recent.append(duration)
+
+
+class Tracer:
+    """
+    Records every SCPI transaction of the attached instruments. Instruments are
+    traced by replacing their pyvisa resource with a TracedResource, untraced
+    instruments run without any overhead.
+
+    Memory stays bounded for long running servers: the timeline keeps the last
+    capacity transactions and the percentiles use the last window durations per
+    command, while counts, totals, maxima and histograms cover all transactions.
+    """
+
+    def __init__(self, capacity: int = 100_000, window: int = 10_000):
+        self.timeline = RingBuffer(capacity, trace_dtype)
+        self.window = window
+        self.stats: Dict[Tuple[str, str], CommandStats] = {}
+        # perf_counter is used for durations, offset to wall clock time
+        self._offset = time.time() - time.perf_counter()
+        self._attached: List[Tuple[object, object]] = []
+        self._lock = threading.Lock()
+
+    def attach(self, instrument, device: Optional[str] = None):
+        # trace an SPD3303X or NRP50S (anything with a pyvisa resource in .dev)
+        if isinstance(instrument.dev, TracedResource):
+            return
+        device = type(instrument).__name__ if device is None else device
+        with self._lock:
+            self._attached.append((instrument, instrument.dev))
+            instrument.dev = TracedResource(instrument.dev, self, device)
+
+    def detach(self):
+        with self._lock:
+            for instrument, dev in self._attached:
+                instrument.dev = dev
+            self._attached.clear()
+
+    def record(
+        self,
+        t_start: float,
+        t_stop: float,
+        device: str,
+        kind: str,
+        command: str,
+        response: str = "",
+        error: str = "",
+    ):
+        duration = t_stop - t_start
+        self.timeline.append(
+            (
+                t_start + self._offset,
+                duration,
+                device,
+                kind,
+                command,
+                len(response),
+                threading.current_thread().name,
+                error,
+            )
+        )
+        key = (device, command_key(command))
+        with self._lock:
+            if key not in self.stats:
+                self.stats[key] = CommandStats(self.window)
+            self.stats[key].update(duration)
+
+    @property
+    def records(self) -> List[TraceRecord]:
+        # the transactions still held in the timeline, oldest first
+        return [
+            TraceRecord(*(row[field].item() for field in TraceRecord._fields))
+            for row in self.timeline.array()
+        ]
+
+    def durations(self) -> Dict[Tuple[str, str], np.ndarray]:
+        # the most recent durations of every (device, command header)
+        with self._lock:
+            return dict(
+                (key, stats.recent.array()) for key, stats in self.stats.items()
+            )
+
+    def histograms(self) -> Dict[Tuple[str, str], np.ndarray]:
+        # counts per latency bin for every (device, command header)
+        with self._lock:
+            return dict((key, stats.counts.copy()) for key, stats in self.stats.items())
+
+    def summary(self) -> List[Dict[str, Union[str, float]]]:
+        # per (device, command header) statistics, largest total time first
+        rows = []
+        with self._lock:
+            stats = list(self.stats.items())
+        for (device, command), command_stats in stats:
+            recent = command_stats.recent.array()
+            rows.append(
+                dict(
+                    [
+                        ("device", device),
+                        ("command", command),
+                        ("count", command_stats.count),
+                        ("total", command_stats.total),
+                        ("mean", command_stats.total / command_stats.count),
+                        ("p50", float(np.percentile(recent, 50))),
+                        ("p95", float(np.percentile(recent, 95))),
+                        ("max", command_stats.max),
+                    ]
+                )
+            )
+        return sorted(rows, key=lambda row: -row["total"])
+
+    def report(self) -> str:
+        lines = [
+            f"{'device':<18} {'command':<22} {'count':>6} {'total [s]':>10}"
+            f" {'mean [ms]':>10} {'p50 [ms]':>10} {'p95 [ms]':>10} {'max [ms]':>10}"
+        ]
+        for row in self.summary():
+            lines.append(
+                f"{row['device']:<18} {row['command']:<22} {row['count']:>6}"
+                f" {row['total']:>10.3f} {row['mean'] * 1e3:>10.3f}"
+                f" {row['p50'] * 1e3:>10.3f} {row['p95'] * 1e3:>10.3f}"
+                f" {row['max'] * 1e3:>10.3f}"
+            )
+        return "\n".join(lines)
+
+    def to_csv(self, fname: Union[str, Path]):
+        # timeline with one row per transaction, time in s since epoch like the
+        # time monitoring CSVs
+        with open(fname, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(TraceRecord._fields)
+            writer.writerows(self.records)
+
+    def to_json(self, fname: Union[str, Path]):
+        with open(fname, "w") as f:
+            json.dump(
+                dict(
+                    [
+                        ("timeline", [record._asdict() for record in self.records]),
+                        ("summary", self.summary()),
+                        ("latency_bins", latency_bins.tolist()),
+                        (
+                            "histograms",
+                            [
+                                dict(
+                                    [
+                                        ("device", device),
+                                        ("command", command),
+                                        ("counts", counts.tolist()),
+                                    ]
+                                )
+                                for (device, command), counts in (
+                                    self.histograms().items()
+                                )
+                            ],
+                        ),
+                    ]
+                ),
+                f,
+                indent=1,
+            )
+
+
+class TracedResource:
+    # wraps a pyvisa resource, anything but write and query is passed through
+    def __init__(self, dev, tracer: Tracer, device: str):
+        self.__dict__["_dev"] = dev
+        self.__dict__["_tracer"] = tracer
+        self.__dict__["_device"] = device
+
+    def __getattr__(self, key: str):
+        return getattr(self._dev, key)
+
+    def __setattr__(self, key: str, value):
+        setattr(self._dev, key, value)
+
+    def write(self, command: str):
+        t_start = time.perf_counter()
+        try:
+            result = self._dev.write(command)
+        except Exception as e:
+            self._tracer.record(
+                t_start,
+                time.perf_counter(),
+                self._device,
+                "write",
+                command,
+                "",
+                repr(e),
+            )
+            raise
+        self._tracer.record(
+            t_start, time.perf_counter(), self._device, "write", command
+        )
+        return result
+
+    def query(self, command: str) -> str:
+        t_start = time.perf_counter()
+        try:
+            response = self._dev.query(command)
+        except Exception as e:
+            self._tracer.record(
+                t_start,
+                time.perf_counter(),
+                self._device,
+                "query",
+                command,
+                "",
+                repr(e),
+            )
+            raise
+        self._tracer.record(
+            t_start, time.perf_counter(), self._device, "query", command, response
+        )
+        return response
+
+
+@contextmanager
+def trace(*instruments, **named_instruments) -> Iterator[Tracer]:
+    """
+    Trace the given instruments within the block, e.g.
+
+    with trace(psu_vg_5pos=psu_vg_5pos, power_meter=power_meter) as tracer:
+        enable_26GHz_power(...)
+    print(tracer.report())
+    """
+    tracer = Tracer()
+    for instrument in instruments:
+        tracer.attach(instrument)
+    for device, instrument in named_instruments.items():
+        tracer.attach(instrument, device)
+    try:
+        yield tracer
+    finally:
+        tracer.detach()
@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+
+@dataclass
+class Step:
+    name: str
+    action: Callable[[], None]
+    # names of the steps that have to finish before this step starts
+    after: Sequence[str] = ()
+
+
+class SequenceError(Exception):
+    pass
+
+
+def merge_steps(*step_lists: Sequence[Step]) -> List[Step]:
+    # steps shared between sequences (e.g. the 12V rail) are identified by name and
+    # only run once; their dependencies are combined
+    merged: Dict[str, Step] = {}
+    for steps in step_lists:
+        for step in steps:
+            if step.name in merged:
+                after = list(merged[step.name].after)
+                after += [name for name in step.after if name not in after]
+                merged[step.name] = Step(step.name, merged[step.name].action, after)
+            else:
+                merged[step.name] = Step(step.name, step.action, list(step.after))
+    return list(merged.values())
+
+
+def check_sequence(steps: Sequence[Step]):
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise SequenceError(f"duplicate step names in {names}")
+    for step in steps:
+        missing = [name for name in step.after if name not in names]
+        if missing:
+            raise SequenceError(f"{step.name} depends on unknown steps {missing}")
+
+    # Kahn's algorithm, anything left over is part of a cycle
+    remaining = dict((step.name, set(step.after)) for step in steps)
+    while True:
+        ready = [name for name, after in remaining.items() if not after]
+        if not ready:
+            break
+        for name in ready:
+            del remaining[name]
+        for after in remaining.values():
+            after.difference_update(ready)
+    if remaining:
+        raise SequenceError(f"dependency cycle between {sorted(remaining)}")
+
+
+def run_sequence(
+    steps: Sequence[Step], max_workers: Optional[int] = None
+) -> Dict[str, float]:
+    # run every step as soon as the steps it depends on finished, independent
+    # branches run concurrently; returns the duration of each step [s]. If a step
+    # fails no new steps are started, running steps finish and the first error is
+    # raised.
+    check_sequence(steps)
+    if not steps:
+        return {}
+    max_workers = len(steps) if max_workers is None else max_workers
+
+    pending = dict((step.name, step) for step in steps)
+    done: Dict[str, float] = {}
+    running: Dict[Future, str] = {}
+    error: Optional[BaseException] = None
+
+    def timed(step: Step) -> float:
+        t_start = time.perf_counter()
+        step.action()
+        return time.perf_counter() - t_start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                for name, step in list(pending.items()):
+                    if all(dep in done for dep in step.after):
+                        running[executor.submit(timed, step)] = name
+                        del pending[name]
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    done[name] = future.result()
+                except BaseException as e:
+                    if error is None:
+                        error = e
+
+    if error is not None:
+        raise error
+    return done
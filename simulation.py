@@ -0,0 +1,546 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from calibration import file_path, load_calibration_arrays
+from calibration_chain import CalibrationChain
+from instrument_server import instruments
+from NRP50S import NRP50S
+from SPD3303X import SPD3303X
+from utils import check_voltage
+
+# reading of the power meter without a signal [dBm]
+noise_floor = -60.0
+
+
+@dataclass
+class SimulationConfig:
+    # time per SCPI command or serial transaction [s]
+    supply_latency: float = 10e-3
+    meter_latency: float = 1e-3
+    synth_latency: float = 5e-3
+    # supply output slew rate [V/s] and voltage readback noise [V]
+    slew_rate: float = 20.0
+    voltage_noise: float = 2e-3
+    # power meter time per reading [s] and noise per reading [dB]
+    aperture: float = 20e-3
+    meter_noise: float = 0.02
+    seed: Optional[int] = None
+    # load resistance per (supply, channel) [Ohm], the output current is limited to
+    # the current setpoint; channels not listed draw no current
+    loads: Dict[Tuple[str, int], float] = field(
+        default_factory=lambda: dict(
+            [
+                (("psu_12pos_vd_5neg", 1), 12.0 / 1.5),
+                (("psu_12pos_vd_5neg", 2), 6.0 / 1.2),
+                (("psu_a_5pos", 1), 12.0 / 1.0),
+                (("psu_a_5pos", 2), 12.0 / 1.0),
+            ]
+        )
+    )
+
+
+class SimulatedChannel:
+    def __init__(self):
+        self.voltage_setpoint = 0.0
+        self.current_setpoint = 0.0
+        self.enabled = False
+        # the output ramps from v_start at t_start towards the target
+        self.v_start = 0.0
+        self.t_start = 0.0
+
+    @property
+    def target(self) -> float:
+        return self.voltage_setpoint if self.enabled else 0.0
+
+    def voltage(self, t: float, slew_rate: float) -> float:
+        dv = self.target - self.v_start
+        step = min(abs(dv), slew_rate * (t - self.t_start))
+        return self.v_start + np.sign(dv) * step
+
+    def change(self, t: float, slew_rate: float, **state):
+        self.v_start = self.voltage(t, slew_rate)
+        self.t_start = t
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+class SimulatedSupply:
+    """
+    SCPI behavior of one SPD3303X: setpoints, outputs slewing towards the setpoint,
+    noisy readback and a resistive load per channel.
+    """
+
+    def __init__(self, bench: "SimulatedBench", name: str):
+        self.bench = bench
+        self.name = name
+        self.channels = dict((ch, SimulatedChannel()) for ch in (1, 2, 3))
+        self.channels[3].voltage_setpoint = 5.0
+        self.errors: List[str] = []
+
+    def voltage(self, channel: int, noise: bool = True) -> float:
+        # a disabled output reads back without noise, so it settles at 0 V
+        state = self.channels[channel]
+        v = state.voltage(time.perf_counter(), self.bench.slew_rate)
+        if noise and state.enabled:
+            v += self.bench.rng.normal(0, self.bench.config.voltage_noise)
+        return max(v, 0.0)
+
+    def current(self, channel: int) -> float:
+        load = self.bench.config.loads.get((self.name, channel))
+        if load is None:
+            return 0.0
+        return min(
+            self.voltage(channel, noise=False) / load,
+            self.channels[channel].current_setpoint,
+        )
+
+    def write(self, command: str):
+        header, _, argument = command.partition(" ")
+        t = time.perf_counter()
+        slew = self.bench.slew_rate
+        if header.startswith("CH") and header.endswith(":VOLT"):
+            self.channels[int(header[2])].change(
+                t, slew, voltage_setpoint=float(argument)
+            )
+        elif header.startswith("CH") and header.endswith(":CURR"):
+            self.channels[int(header[2])].current_setpoint = float(argument)
+        elif header == "OUTP":
+            channel, state = argument.split(",")
+            self.channels[int(channel[2])].change(t, slew, enabled=state == "ON")
+        elif header.startswith("*SAV"):
+            pass
+        else:
+            self.errors.append(f'-113,"Undefined header {command}"')
+
+    def query(self, command: str) -> str:
+        header, _, argument = command.partition(" ")
+        if header == "*IDN?":
+            return str(instruments[self.name].idn)
+        elif header == "*OPC?":
+            return "1"
+        elif header == "SYST:ERR?":
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        elif header.startswith("CH") and header.endswith(":VOLT?"):
+            return f"{self.channels[int(header[2])].voltage_setpoint:.3f}"
+        elif header.startswith("CH") and header.endswith(":CURR?"):
+            return f"{self.channels[int(header[2])].current_setpoint:.3f}"
+        elif header == "MEAS:VOLT?":
+            return f"{self.voltage(int(argument[2])):.3f}"
+        elif header == "MEAS:CURR?":
+            return f"{self.current(int(argument[2])):.3f}"
+        elif header == "MEAS:POWE?":
+            channel = int(argument[2])
+            return f"{self.voltage(channel) * self.current(channel):.3f}"
+        self.errors.append(f'-113,"Undefined header {command}"')
+        return ""
+
+
+class SimulatedPowerMeter:
+    """
+    SCPI behavior of the NRP50S: INIT starts a measurement of trigger count readings
+    taking aperture per (averaged) reading, FETCH? returns the readings of the power
+    routed to the meter by the bench. With an external trigger source one reading is
+    taken per SimulatedBench.pulse().
+    """
+
+    def __init__(self, bench: "SimulatedBench"):
+        self.bench = bench
+        self.state: Dict[str, str] = dict(
+            [
+                ("SENS:FREQ", "1e9"),
+                ("SENS:TRAC:AVER:STAT", "0"),
+                ("SENS:TRAC:AVER:COUN", "1"),
+                ("SENS:BUFF:SIZE", "1"),
+                ("SENS:BUFF:STAT", "0"),
+                ("TRIG:COUN", "1"),
+                ("TRIG:SOUR", "IMM"),
+                ("TRIG:DEL", "0"),
+                ("UNIT:POW", "DBM"),
+            ]
+        )
+        self.readings = np.array([noise_floor])
+        self.t_done = 0.0
+        # readings still to be triggered externally
+        self.armed = 0
+        self.errors: List[str] = []
+
+    def averages(self) -> int:
+        if self.state["SENS:TRAC:AVER:STAT"] in ("1", "ON"):
+            return int(self.state["SENS:TRAC:AVER:COUN"])
+        return 1
+
+    def reading(self, count: int = 1) -> np.ndarray:
+        noise = self.bench.config.meter_noise / np.sqrt(self.averages())
+        return self.bench.meter_power() + self.bench.rng.normal(0, noise, count)
+
+    def trigger(self):
+        if self.armed:
+            self.readings = np.append(self.readings, self.reading())
+            self.armed -= 1
+
+    def write(self, command: str):
+        header, _, argument = command.partition(" ")
+        if header == "INIT":
+            count = int(self.state["TRIG:COUN"])
+            if self.state["TRIG:SOUR"].startswith("EXT"):
+                self.readings = np.empty(0)
+                self.armed = count
+                return
+            self.armed = 0
+            self.readings = self.reading(count)
+            self.t_done = (
+                time.perf_counter()
+                + count * self.averages() * self.bench.config.aperture
+            )
+        elif header in self.state:
+            value = {"ON": "1", "OFF": "0"}.get(argument, argument)
+            self.state[header] = value.upper()
+        elif header in ("RST", "*RST"):
+            pass
+        else:
+            self.errors.append(f'-113,"Undefined header {command}"')
+
+    def query(self, command: str) -> str:
+        header = command.rstrip("?")
+        if command == "*IDN?":
+            return "Rohde&Schwarz,NRP50S,1424.1008K02/101074,simulated"
+        elif command == "*OPC?":
+            # answered once the measurement is done
+            time.sleep(max(self.t_done - time.perf_counter(), 0))
+            while self.armed:
+                time.sleep(1e-3)
+            return "1"
+        elif command == "SYST:ERR?":
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        elif command == "STAT:OPER:COND?":
+            measuring = self.armed or time.perf_counter() < self.t_done
+            return "16" if measuring else "0"
+        elif command == "FETCH?":
+            # fetching blocks until the measurement is done
+            time.sleep(max(self.t_done - time.perf_counter(), 0))
+            while self.armed:
+                time.sleep(1e-3)
+            readings = self.readings
+            if self.state["UNIT:POW"] == "W":
+                readings = 10 ** (readings / 10) * 1e-3
+            if self.state["SENS:BUFF:STAT"] == "1":
+                return ",".join(f"{r:.6g}" for r in readings)
+            return f"{readings[-1]:.6g}"
+        elif header in self.state:
+            return self.state[header]
+        self.errors.append(f'-113,"Undefined header {command}"')
+        return ""
+
+
+class SimulatedResource:
+    # pyvisa resource with the latency of a USB transaction
+    def __init__(self, bench: "SimulatedBench", name: str, device, latency: float):
+        self.bench = bench
+        self.name = name
+        self.device = device
+        self.latency = latency
+        self.read_termination = "\n"
+        # [ms], unused
+        self.timeout = 2000
+        self.lock = threading.Lock()
+
+    def write(self, command: str):
+        with self.lock:
+            self.bench.count(self.name)
+            time.sleep(self.latency)
+            self.device.write(command)
+
+    def query(self, command: str) -> str:
+        with self.lock:
+            self.bench.count(self.name)
+            time.sleep(self.latency)
+            return self.device.query(command)
+
+
+class SimulatedResourceManager:
+    # stands in for pyvisa.ResourceManager, resources are matched to the instruments
+    # in instrument_server.instruments
+    def __init__(self, bench: "SimulatedBench"):
+        self.bench = bench
+
+    def open_resource(self, resource_name: str) -> SimulatedResource:
+        for name, config in instruments.items():
+            if config.resource != resource_name:
+                continue
+            if config.driver == "SPD3303X":
+                return SimulatedResource(
+                    self.bench,
+                    name,
+                    self.bench.supplies[name],
+                    self.bench.config.supply_latency,
+                )
+            if config.driver == "NRP50S":
+                return SimulatedResource(
+                    self.bench,
+                    name,
+                    self.bench.power_meter,
+                    self.bench.config.meter_latency,
+                )
+        raise ValueError(f"no simulated instrument for {resource_name}")
+
+
+class SimulatedSynthChannel:
+    def __init__(self, synth: "SimulatedSynthHD", index: int):
+        object.__setattr__(self, "_synth", synth)
+        object.__setattr__(
+            self,
+            "_state",
+            dict(frequency=10e9, power=-20.0, enable=False, index=index),
+        )
+
+    def __getattr__(self, key: str):
+        if key not in self._state:
+            raise AttributeError(key)
+        self._synth.bench.count("synthd")
+        time.sleep(self._synth.bench.config.synth_latency)
+        return self._state[key]
+
+    def __setattr__(self, key: str, value):
+        if key not in self._state or key == "index":
+            raise AttributeError(f"can't set {key}")
+        self._synth.bench.count("synthd")
+        time.sleep(self._synth.bench.config.synth_latency)
+        self._state[key] = type(self._state[key])(value)
+
+    def select(self):
+        self._synth.write("channel", self._state["index"])
+
+    def write(self, attribute: str, value):
+        self.select()
+        self._synth.write(attribute, value)
+
+    def read(self, attribute: str):
+        self.select()
+        return self._synth.read(attribute)
+
+
+class SimulatedSynthHD:
+    """
+    The subset of windfreak.SynthHD used in this repo, synthd[0] is RFA. Linear
+    sweeps are stepped by SimulatedBench.pulse() in the "single frequency step"
+    trigger mode, the first pulse after sweep_single starts at sweep_freq_low.
+    """
+
+    def __init__(self, bench: "SimulatedBench", serial: str = "SN416"):
+        self.bench = bench
+        self.model = "SynthHD PRO v2 (simulated)"
+        self.serial_number = int(serial[2:])
+        self.serial = serial
+        self.temperature = 40.0
+        self.channels = [SimulatedSynthChannel(self, i) for i in range(2)]
+        self.registers: Dict[str, Any] = dict(
+            [
+                ("channel", 0),
+                ("trig_function", 0),
+                ("sweep_freq_low", 10e3),
+                ("sweep_freq_high", 10e3),
+                ("sweep_freq_step", 1.0),
+                ("sweep_time_step", 10.0),
+                ("sweep_power_low", -20.0),
+                ("sweep_power_high", -20.0),
+                ("sweep_direction", 1),
+                ("sweep_type", 0),
+                ("sweep_single", False),
+                ("sweep_cont", False),
+            ]
+        )
+        self.trigger_modes = (
+            "disabled",
+            "full frequency sweep",
+            "single frequency step",
+        )
+        # (channel, next sweep point) of an armed sweep
+        self.sweep: Optional[Tuple[int, int]] = None
+
+    def write(self, attribute: str, value):
+        if attribute not in self.registers:
+            raise KeyError(attribute)
+        self.bench.count("synthd")
+        time.sleep(self.bench.config.synth_latency)
+        self.registers[attribute] = type(self.registers[attribute])(value)
+        if attribute == "sweep_single" and value:
+            self.sweep = (self.registers["channel"], 0)
+
+    def read(self, attribute: str):
+        self.bench.count("synthd")
+        time.sleep(self.bench.config.synth_latency)
+        return self.registers[attribute]
+
+    @property
+    def trigger_mode(self) -> str:
+        return self.trigger_modes[self.read("trig_function")]
+
+    @trigger_mode.setter
+    def trigger_mode(self, mode: str):
+        self.write("trig_function", self.trigger_modes.index(mode))
+
+    def pulse(self):
+        # one trigger pulse, steps an armed linear sweep
+        mode = self.trigger_modes[self.registers["trig_function"]]
+        if self.sweep is None or mode != "single frequency step":
+            return
+        channel, point = self.sweep
+        registers = self.registers
+        low, high = registers["sweep_freq_low"], registers["sweep_freq_high"]
+        n_points = int(round((high - low) / registers["sweep_freq_step"])) + 1
+        if registers["sweep_direction"] == 0:
+            low, high = high, low
+        state = self.channels[channel]._state
+        state["frequency"] = (low + (high - low) * point / max(n_points - 1, 1)) * 1e6
+        state["power"] = registers["sweep_power_low"]
+        point += 1
+        self.sweep = None if point == n_points else (channel, point)
+
+    def __getitem__(self, index: int) -> SimulatedSynthChannel:
+        return self.channels[index]
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+
+class SimulatedPulseTrigger:
+    # stands in for synth_sweep.PulseTrigger, pulses the bench from a thread
+    def __init__(self, bench: "SimulatedBench"):
+        self.bench = bench
+        self.thread: Optional[threading.Thread] = None
+
+    def _run(self, count: int, rate: float):
+        t_next = time.perf_counter()
+        for _ in range(count):
+            t_next += 1 / rate
+            time.sleep(max(t_next - time.perf_counter(), 0))
+            self.bench.pulse()
+
+    def fire(self, count: int, rate: float):
+        self.thread = threading.Thread(target=self._run, args=(count, rate))
+        self.thread.start()
+
+    def wait(self, timeout: float = 10.0):
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                raise TimeoutError(f"pulse train not finished in {timeout} s")
+
+    def close(self):
+        self.wait()
+
+
+class SimulatedBench:
+    """
+    Simulated instruments of the RC microwave setup sharing one state. The power
+    meter reads the calibrated output of a SynthHD channel, either directly or
+    through one of the amplifiers, using the calibration built from the measurement
+    CSVs; the amplifier output depends on the simulated supply voltages.
+    """
+
+    def __init__(
+        self,
+        config: Optional[SimulationConfig] = None,
+        path: Path = file_path,
+        serial: str = "SN416",
+    ):
+        self.config = SimulationConfig() if config is None else config
+        self.rng = np.random.default_rng(self.config.seed)
+        # instrument transactions per instrument name
+        self.transactions: Dict[str, int] = {}
+        self._count_lock = threading.Lock()
+        self.slew_rate = self.config.slew_rate
+
+        self.supplies = dict(
+            (name, SimulatedSupply(self, name))
+            for name, config in instruments.items()
+            if config.driver == "SPD3303X"
+        )
+        self.power_meter = SimulatedPowerMeter(self)
+        self.synthd = SimulatedSynthHD(self, serial)
+        self.rm = SimulatedResourceManager(self)
+
+        arrays = load_calibration_arrays(path)
+        self.chains = dict(
+            (system, CalibrationChain(arrays, system)) for system in ["26_7", "40"]
+        )
+        # (system, amplifier index) between the synthesizer and the meter, None to
+        # measure the synthesizer directly
+        self.route: Optional[Tuple[str, int]] = None
+        self.rf_out = 1
+
+    def count(self, name: str):
+        with self._count_lock:
+            self.transactions[name] = self.transactions.get(name, 0) + 1
+
+    def synth_power(self) -> float:
+        state = self.synthd.channels[self.rf_out]._state
+        if not state["enable"]:
+            return noise_floor
+        name = f"{self.synthd.serial}_RF{'AB'[self.rf_out]}"
+        chain = self.chains["26_7"]
+        if name not in chain.synthesizers:
+            raise ValueError(f"no calibration for {name}")
+        return float(chain.synthesizers[name]((state["frequency"], state["power"])))
+
+    def amplifier_powered(self, system: str, amplifier: int) -> Tuple[bool, float]:
+        # (powered, |Vg|) of an amplifier from the supply outputs
+        if system == "26_7":
+            vd = self.supplies["psu_12pos_vd_5neg"].voltage(2, noise=False)
+            vg = self.supplies["psu_vg_5pos"].voltage(amplifier + 1, noise=False)
+            return check_voltage(vd, 6.0, 0.05), vg
+        v = self.supplies["psu_a_5pos"].voltage(amplifier + 1, noise=False)
+        return check_voltage(v, 12.0, 0.05), 0.0
+
+    def meter_power(self) -> float:
+        power = self.synth_power()
+        if self.route is not None and power > noise_floor:
+            system, amplifier = self.route
+            powered, vg = self.amplifier_powered(system, amplifier)
+            chain = self.chains[system]
+            power = float(
+                chain.amplifier_power(power, vg if chain.has_vg else None, amplifier)
+            )
+            if not powered:
+                power = noise_floor
+        return power if np.isfinite(power) else noise_floor
+
+    def pulse(self):
+        # trigger pulse wired to the SynthHD and power meter trigger inputs
+        self.synthd.pulse()
+        self.power_meter.trigger()
+
+    def supply(self, name: str) -> SPD3303X:
+        return SPD3303X(instruments[name].resource, self.rm)
+
+    def meter(self) -> NRP50S:
+        return NRP50S(instruments["power_meter"].resource, self.rm)
+
+    def open(self, name: str):
+        # simulated counterpart of instrument_server.open_local
+        if name == "synthd":
+            return self.synthd
+        if name == "power_meter":
+            return self.meter()
+        return self.supply(name)
+
+
+# benches of this process by SynthHD serial, for worker processes
+_benches: Dict[str, "SimulatedBench"] = {}
+_meters: Dict[str, NRP50S] = {}
+
+
+def open_simulated_devices(job) -> Tuple[SimulatedSynthHD, NRP50S]:
+    # fleet_scan devices for a ScanJob, one simulated bench per synthesizer with
+    # the job output routed to the meter
+    if job.synth not in _benches:
+        _benches[job.synth] = SimulatedBench(serial=job.synth)
+        _meters[job.synth] = _benches[job.synth].meter()
+    bench = _benches[job.synth]
+    bench.rf_out = job.rf_out
+    return bench.synthd, _meters[job.synth]
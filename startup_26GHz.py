@@ -1,72 +1,87 @@
-import time
+from typing import List
 
+from instrument_server import open_instrument
+from sequencer import Step, run_sequence
 from SPD3303X import SPD3303X
-from utils import check_voltage
+
+
+def enable_26GHz_steps(
+    psu_vg_5pos: SPD3303X,
+    psu_12pos_vd_5neg: SPD3303X,
+    timeout: float = 2,
+    vg1: float = 0.8,
+    vg2: float = 0.8,
+) -> List[Step]:
+    def enable_12V():
+        # enable 12V fans, doubling stage
+        psu_12pos_vd_5neg.ch1_voltage_setpoint = 12
+        psu_12pos_vd_5neg.ch1_current_setpoint = 3.0
+        psu_12pos_vd_5neg.output(True, 1)
+        psu_12pos_vd_5neg.settle(1, 12.0, timeout=timeout)
+
+    def enable_switches_neg():
+        # enable -5V for the SPDT switches
+        psu_12pos_vd_5neg.output(True, 3)
+
+    def enable_switches_pos():
+        # enable +5V for the SPDT switches
+        psu_vg_5pos.output(True, 3)
+
+    def enable_gates():
+        # enable amplifiers
+        # first set the gate voltage to -1.5V
+        psu_vg_5pos.ch1_voltage_setpoint = 1.5
+        psu_vg_5pos.ch1_current_setpoint = 0.07
+
+        psu_vg_5pos.ch2_voltage_setpoint = 1.5
+        psu_vg_5pos.ch2_current_setpoint = 0.07
+
+        psu_vg_5pos.output(True, 1)
+        psu_vg_5pos.output(True, 2)
+        psu_vg_5pos.settle(1, 1.5, timeout=timeout)
+        psu_vg_5pos.settle(2, 1.5, timeout=timeout)
+
+    def enable_drain():
+        # turn on the VD = +6V PSU
+        psu_12pos_vd_5neg.ch2_voltage_setpoint = 6.0
+        psu_12pos_vd_5neg.ch2_current_setpoint = 3.2
+
+        psu_12pos_vd_5neg.output(True, 2)
+        psu_12pos_vd_5neg.settle(2, 6.0, timeout=timeout)
+
+    def tune_gates():
+        # tune gate voltage for appropriate amplification, see calibration_inverse.py
+        # for the gate voltage giving a target output power
+        psu_vg_5pos.ch1_voltage_setpoint = vg1
+        psu_vg_5pos.ch2_voltage_setpoint = vg2
+        psu_vg_5pos.settle(1, vg1, timeout=timeout)
+        psu_vg_5pos.settle(2, vg2, timeout=timeout)
+
+    # the gates of the TGA4536 amplifiers have to be pinched off before the drain
+    # voltage is applied, and the drain removed before the gates
+    return [
+        Step("12V", enable_12V),
+        Step("-5V switches", enable_switches_neg, after=["12V"]),
+        Step("+5V switches 26 GHz", enable_switches_pos, after=["12V"]),
+        Step("gates 26 GHz", enable_gates, after=["12V"]),
+        Step("drain 26 GHz", enable_drain, after=["gates 26 GHz"]),
+        Step("tune gates 26 GHz", tune_gates, after=["drain 26 GHz"]),
+    ]
 
 
 def enable_26GHz_power(
-    psu_vg_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, dt: float = 2
+    psu_vg_5pos: SPD3303X,
+    psu_12pos_vd_5neg: SPD3303X,
+    timeout: float = 2,
+    vg1: float = 0.8,
+    vg2: float = 0.8,
 ):
-    # enable 12V fans, doubling stage
-    psu_12pos_vd_5neg.ch1_voltage_setpoint = 12
-    psu_12pos_vd_5neg.ch1_current_setpoint = 3.0
-    psu_12pos_vd_5neg.output(True, 1)
-    time.sleep(dt)
-    assert check_voltage(psu_12pos_vd_5neg.ch1_voltage, 12.0)
-
-    # enable +/- 5V for the SPDT switches
-    psu_vg_5pos.output(True, 3)
-    psu_12pos_vd_5neg.output(True, 3)
-
-    # enable amplifiers
-    # first set the gate voltage to -1.5V
-    psu_vg_5pos.ch1_voltage_setpoint = 1.5
-    psu_vg_5pos.ch1_current_setpoint = 0.07
-
-    psu_vg_5pos.ch2_voltage_setpoint = 1.5
-    psu_vg_5pos.ch2_current_setpoint = 0.07
-
-    psu_vg_5pos.output(True, 1)
-    psu_vg_5pos.output(True, 2)
-    time.sleep(dt)
-    assert check_voltage(psu_vg_5pos.ch1_voltage, 1.5)
-    assert check_voltage(psu_vg_5pos.ch2_voltage, 1.5)
-
-    # turn on the VD = +6V PSU
-    psu_12pos_vd_5neg.ch2_voltage_setpoint = 6.0
-    psu_12pos_vd_5neg.ch2_current_setpoint = 3.2
-
-    psu_12pos_vd_5neg.output(True, 2)
-    time.sleep(dt)
-    assert check_voltage(psu_12pos_vd_5neg.ch2_voltage, 6.0)
-
-    # tune gate voltage for appropriate amplification
-    psu_vg_5pos.ch1_voltage_setpoint = 0.8
-    psu_vg_5pos.ch2_voltage_setpoint = 0.8
-    time.sleep(dt)
-    assert check_voltage(psu_vg_5pos.ch1_voltage, 0.8)
-    assert check_voltage(psu_vg_5pos.ch2_voltage, 0.8)
+    run_sequence(enable_26GHz_steps(psu_vg_5pos, psu_12pos_vd_5neg, timeout, vg1, vg2))
 
 
 if __name__ == "__main__":
-    psu_vg_5pos = "USB0::0xF4EC::0x1430::SPD3XIDX5R3677::INSTR"
-    psu_12pos_vd_5neg = "USB0::0xF4EC::0x1430::SPD3XIED5R7612::INSTR"
-    psu_a_5pos = "USB0::0xF4EC::0x1430::SPD3XIED5R8368::INSTR"
-
-    psu_vg_5pos = SPD3303X(psu_vg_5pos)
-    psu_12pos_vd_5neg = SPD3303X(psu_12pos_vd_5neg)
-    psu_a_5pos = SPD3303X(psu_a_5pos)
-
-    assert (
-        psu_vg_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIDX5R3677,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_12pos_vd_5neg.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R7612,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_a_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R8368,1.01.01.02.07R2,V3.0"
-    )
+    # sessions are shared through instrument_server.py if it is running
+    psu_vg_5pos = open_instrument("psu_vg_5pos")
+    psu_12pos_vd_5neg = open_instrument("psu_12pos_vd_5neg")
+    psu_a_5pos = open_instrument("psu_a_5pos")
     enable_26GHz_power(psu_vg_5pos, psu_12pos_vd_5neg)
@@ -1,55 +1,62 @@
-import time
+from typing import List
 
+from instrument_server import open_instrument
+from sequencer import Step, run_sequence
 from SPD3303X import SPD3303X
-from utils import check_voltage
 
 
-def enable_40GHz_power(
-    psu_a_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, dt: float = 2
-):
-    # enable 12V fans, doubling stage
-    psu_12pos_vd_5neg.ch1_voltage_setpoint = 12.0
-    psu_12pos_vd_5neg.ch1_current_setpoint = 3.0
-    time.sleep(dt)
-    assert check_voltage(psu_12pos_vd_5neg.ch1_voltage, 12.0)
-
-    # enable +/- 5V for the SPDT switches
-    psu_12pos_vd_5neg.output(True, 3)  # -5V
-    psu_a_5pos.output(True, 3)  # +5V
+def enable_40GHz_steps(
+    psu_a_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, timeout: float = 2
+) -> List[Step]:
+    def enable_12V():
+        # enable 12V fans, doubling stage
+        psu_12pos_vd_5neg.ch1_voltage_setpoint = 12.0
+        psu_12pos_vd_5neg.ch1_current_setpoint = 3.0
+        psu_12pos_vd_5neg.output(True, 1)
+        psu_12pos_vd_5neg.settle(1, 12.0, timeout=timeout)
+
+    def enable_switches_neg():
+        # enable -5V for the SPDT switches
+        psu_12pos_vd_5neg.output(True, 3)
+
+    def enable_switches_pos():
+        # enable +5V for the SPDT switches
+        psu_a_5pos.output(True, 3)
+
+    def enable_amplifiers():
+        # enable 12V for the two 40 GHz amplifiers
+        psu_a_5pos.ch1_voltage_setpoint = 12.0
+        psu_a_5pos.ch1_current_setpoint = 2.5
+
+        psu_a_5pos.ch2_voltage_setpoint = 12.0
+        psu_a_5pos.ch2_current_setpoint = 2.5
+
+        psu_a_5pos.output(True, 1)
+        psu_a_5pos.output(True, 2)
+        psu_a_5pos.settle(1, 12.0, timeout=timeout)
+        psu_a_5pos.settle(2, 12.0, timeout=timeout)
+
+    return [
+        Step("12V", enable_12V),
+        Step("-5V switches", enable_switches_neg, after=["12V"]),
+        Step("+5V switches 40 GHz", enable_switches_pos, after=["12V"]),
+        Step(
+            "amplifiers 40 GHz",
+            enable_amplifiers,
+            after=["-5V switches", "+5V switches 40 GHz"],
+        ),
+    ]
 
-    # enable 12V for the two 40 GHz amplifiers
-    psu_a_5pos.ch1_voltage_setpoint = 12.0
-    psu_a_5pos.ch1_current_setpoint = 2.5
 
-    psu_a_5pos.ch2_voltage_setpoint = 12.0
-    psu_a_5pos.ch2_current_setpoint = 2.5
-
-    psu_a_5pos.output(True, 1)
-    psu_a_5pos.output(True, 2)
-    time.sleep(dt)
-    assert check_voltage(psu_a_5pos.ch1_voltage, 12.0)
-    assert check_voltage(psu_a_5pos.ch2_voltage, 12.0)
+def enable_40GHz_power(
+    psu_a_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, timeout: float = 2
+):
+    run_sequence(enable_40GHz_steps(psu_a_5pos, psu_12pos_vd_5neg, timeout))
 
 
 if __name__ == "__main__":
-    psu_vg_5pos = "USB0::0xF4EC::0x1430::SPD3XIDX5R3677::INSTR"
-    psu_12pos_vd_5neg = "USB0::0xF4EC::0x1430::SPD3XIED5R7612::INSTR"
-    psu_a_5pos = "USB0::0xF4EC::0x1430::SPD3XIED5R8368::INSTR"
-
-    psu_vg_5pos = SPD3303X(psu_vg_5pos)
-    psu_12pos_vd_5neg = SPD3303X(psu_12pos_vd_5neg)
-    psu_a_5pos = SPD3303X(psu_a_5pos)
-
-    assert (
-        psu_vg_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIDX5R3677,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_12pos_vd_5neg.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R7612,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_a_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R8368,1.01.01.02.07R2,V3.0"
-    )
+    # sessions are shared through instrument_server.py if it is running
+    psu_vg_5pos = open_instrument("psu_vg_5pos")
+    psu_12pos_vd_5neg = open_instrument("psu_12pos_vd_5neg")
+    psu_a_5pos = open_instrument("psu_a_5pos")
     enable_40GHz_power(psu_a_5pos, psu_12pos_vd_5neg)
@@ -1,59 +1,61 @@
-import time
+from typing import List
 
+from instrument_server import open_instrument
+from sequencer import Step, run_sequence
 from SPD3303X import SPD3303X
-from utils import check_voltage
 
 
-def disable_26GHz_power(
-    psu_vg_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, dt: float = 2
-):
-    # tune gate voltage for appropriate amplification
-    psu_vg_5pos.ch1_voltage_setpoint = 1.5
-    psu_vg_5pos.ch2_voltage_setpoint = 1.5
-    time.sleep(dt)
-    assert check_voltage(psu_vg_5pos.ch1_voltage, 1.5)
-    assert check_voltage(psu_vg_5pos.ch2_voltage, 1.5)
-
-    # turn off the VD = +6V PSU
-    psu_12pos_vd_5neg.ch2_voltage_setpoint = 0
-    psu_12pos_vd_5neg.output(False, 2)
-    time.sleep(dt)
-    assert check_voltage(psu_12pos_vd_5neg.ch2_voltage, 0)
-
-    # disable Vg
-    psu_vg_5pos.ch1_voltage_setpoint = 0.0
-    psu_vg_5pos.ch2_voltage_setpoint = 0.0
+def disable_26GHz_steps(
+    psu_vg_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, timeout: float = 2
+) -> List[Step]:
+    def pinch_off_gates():
+        # tune gate voltage for appropriate amplification
+        psu_vg_5pos.ch1_voltage_setpoint = 1.5
+        psu_vg_5pos.ch2_voltage_setpoint = 1.5
+        psu_vg_5pos.settle(1, 1.5, timeout=timeout)
+        psu_vg_5pos.settle(2, 1.5, timeout=timeout)
+
+    def disable_drain():
+        # turn off the VD = +6V PSU
+        psu_12pos_vd_5neg.ch2_voltage_setpoint = 0
+        psu_12pos_vd_5neg.output(False, 2)
+        psu_12pos_vd_5neg.settle(2, 0, timeout=timeout)
+
+    def disable_gates():
+        # disable Vg
+        psu_vg_5pos.ch1_voltage_setpoint = 0.0
+        psu_vg_5pos.ch2_voltage_setpoint = 0.0
+
+        psu_vg_5pos.output(False, 1)
+        psu_vg_5pos.output(False, 2)
+        psu_vg_5pos.settle(1, 0.0, timeout=timeout)
+        psu_vg_5pos.settle(2, 0.0, timeout=timeout)
+
+    def disable_switches_pos():
+        # disable +5V for switch and doubler
+        psu_vg_5pos.output(False, 3)
+
+    return [
+        Step("pinch off gates 26 GHz", pinch_off_gates),
+        Step("drain off 26 GHz", disable_drain, after=["pinch off gates 26 GHz"]),
+        Step("gates off 26 GHz", disable_gates, after=["drain off 26 GHz"]),
+        Step(
+            "+5V switches off 26 GHz",
+            disable_switches_pos,
+            after=["gates off 26 GHz"],
+        ),
+    ]
 
-    psu_vg_5pos.output(False, 1)
-    psu_vg_5pos.output(False, 2)
 
-    time.sleep(dt)
-    assert check_voltage(psu_vg_5pos.ch1_voltage, 0.0)
-    assert check_voltage(psu_vg_5pos.ch2_voltage, 0.0)
-
-    # disable +5V for switch and doubler
-    psu_vg_5pos.output(False, 3)
+def disable_26GHz_power(
+    psu_vg_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, timeout: float = 2
+):
+    run_sequence(disable_26GHz_steps(psu_vg_5pos, psu_12pos_vd_5neg, timeout))
 
 
 if __name__ == "__main__":
-    psu_vg_5pos = "USB0::0xF4EC::0x1430::SPD3XIDX5R3677::INSTR"
-    psu_12pos_vd_5neg = "USB0::0xF4EC::0x1430::SPD3XIED5R7612::INSTR"
-    psu_a_5pos = "USB0::0xF4EC::0x1430::SPD3XIED5R8368::INSTR"
-
-    psu_vg_5pos = SPD3303X(psu_vg_5pos)
-    psu_12pos_vd_5neg = SPD3303X(psu_12pos_vd_5neg)
-    psu_a_5pos = SPD3303X(psu_a_5pos)
-
-    assert (
-        psu_vg_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIDX5R3677,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_12pos_vd_5neg.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R7612,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_a_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R8368,1.01.01.02.07R2,V3.0"
-    )
+    # sessions are shared through instrument_server.py if it is running
+    psu_vg_5pos = open_instrument("psu_vg_5pos")
+    psu_12pos_vd_5neg = open_instrument("psu_12pos_vd_5neg")
+    psu_a_5pos = open_instrument("psu_a_5pos")
     disable_26GHz_power(psu_vg_5pos, psu_12pos_vd_5neg)
@@ -1,44 +1,46 @@
-import time
+from typing import List
 
+from instrument_server import open_instrument
+from sequencer import Step, run_sequence
 from SPD3303X import SPD3303X
-from stop_26GHz import disable_26GHz_power
-from stop_40GHz import disable_40GHz_power
-from utils import check_voltage
+from stop_26GHz import disable_26GHz_steps
+from stop_40GHz import disable_40GHz_steps
+
+
+def disable_all_steps(
+    psu_vg_5pos: SPD3303X,
+    psu_12pos_vd_5neg: SPD3303X,
+    psu_a_5pos: SPD3303X,
+    timeout: float = 2,
+) -> List[Step]:
+    steps = disable_26GHz_steps(psu_vg_5pos, psu_12pos_vd_5neg, timeout)
+    steps += disable_40GHz_steps(psu_a_5pos, timeout)
+
+    def disable_shared():
+        # disable 12V and -5V
+        psu_12pos_vd_5neg.ch1_voltage_setpoint = 0.0
+        psu_12pos_vd_5neg.output(False, 1)  # +5V
+        psu_12pos_vd_5neg.output(False, 3)  # -5V
+        psu_12pos_vd_5neg.settle(1, 0.0, timeout=timeout)
+
+    # only after both bands are off
+    return steps + [
+        Step("12V and -5V off", disable_shared, after=[step.name for step in steps])
+    ]
 
 
 def disable_all_power(
-    psu_vg_5pos: SPD3303X, psu_12pos_vd_5neg: SPD3303X, psu_a_5pos, dt: float = 2
+    psu_vg_5pos: SPD3303X,
+    psu_12pos_vd_5neg: SPD3303X,
+    psu_a_5pos: SPD3303X,
+    timeout: float = 2,
 ):
-    disable_26GHz_power(psu_vg_5pos, psu_12pos_vd_5neg, dt)
-    disable_40GHz_power(psu_a_5pos, dt)
-
-    # disable 12V and -5V
-    psu_12pos_vd_5neg.ch1_voltage_setpoint = 0.0
-    psu_12pos_vd_5neg.output(False, 1)  # +5V
-    psu_12pos_vd_5neg.output(False, 3)  # -5V
-    time.sleep(dt)
-    assert check_voltage(psu_12pos_vd_5neg.ch1_voltage, 0.0)
+    run_sequence(disable_all_steps(psu_vg_5pos, psu_12pos_vd_5neg, psu_a_5pos, timeout))
 
 
 if __name__ == "__main__":
-    psu_vg_5pos = "USB0::0xF4EC::0x1430::SPD3XIDX5R3677::INSTR"
-    psu_12pos_vd_5neg = "USB0::0xF4EC::0x1430::SPD3XIED5R7612::INSTR"
-    psu_a_5pos = "USB0::0xF4EC::0x1430::SPD3XIED5R8368::INSTR"
-
-    psu_vg_5pos = SPD3303X(psu_vg_5pos)
-    psu_12pos_vd_5neg = SPD3303X(psu_12pos_vd_5neg)
-    psu_a_5pos = SPD3303X(psu_a_5pos)
-
-    assert (
-        psu_vg_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIDX5R3677,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_12pos_vd_5neg.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R7612,1.01.01.02.07R2,V3.0"
-    )
-    assert (
-        psu_a_5pos.idn
-        == "Siglent Technologies,SPD3303X-E,SPD3XIED5R8368,1.01.01.02.07R2,V3.0"
-    )
+    # sessions are shared through instrument_server.py if it is running
+    psu_vg_5pos = open_instrument("psu_vg_5pos")
+    psu_12pos_vd_5neg = open_instrument("psu_12pos_vd_5neg")
+    psu_a_5pos = open_instrument("psu_a_5pos")
     disable_all_power(psu_vg_5pos, psu_12pos_vd_5neg, psu_a_5pos)
@@ -0,0 +1,227 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from NRP50S import NRP50S
+from results_writer import ResultsWriter
+
+# header of the *_scan.csv SynthHD calibrations
+scan_header = ["frequency [Hz]", "synthHD Pro power [dBm]", "det power [dBm]"]
+
+
+def linear_table(frequencies: Sequence[float]) -> Tuple[float, float, float]:
+    # (low, high, step) [MHz] of the SynthHD linear sweep through frequencies [Hz]
+    frequencies = np.asarray(frequencies, float)
+    if len(frequencies) < 2:
+        raise ValueError("a sweep needs at least 2 frequencies")
+    steps = np.diff(frequencies)
+    if steps[0] <= 0 or not np.allclose(steps, steps[0], rtol=1e-6, atol=1.0):
+        raise ValueError("the SynthHD sweeps linearly, use increasing equal steps")
+    return frequencies[0] / 1e6, frequencies[-1] / 1e6, steps[0] / 1e6
+
+
+class PulseTrigger:
+    """
+    Finite pulse train from an NI DAQ counter output, wired to the SynthHD trigger
+    input and the NRP50S external trigger input. nidaqmx is only imported when
+    the first pulse train is started.
+    """
+
+    def __init__(self, counter: str = "Dev1/ctr0", terminal: Optional[str] = None):
+        self.counter = counter
+        self.terminal = terminal
+        self.task = None
+
+    def fire(self, count: int, rate: float):
+        import nidaqmx
+        from nidaqmx.constants import AcquisitionType
+
+        self.close()
+        self.task = nidaqmx.Task()
+        channel = self.task.co_channels.add_co_pulse_chan_freq(
+            self.counter, freq=rate, duty_cycle=0.5
+        )
+        if self.terminal is not None:
+            channel.co_pulse_term = self.terminal
+        self.task.timing.cfg_implicit_timing(
+            sample_mode=AcquisitionType.FINITE, samps_per_chan=count
+        )
+        self.task.start()
+
+    def wait(self, timeout: float = 10.0):
+        if self.task is not None:
+            self.task.wait_until_done(timeout)
+
+    def close(self):
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+
+
+class HardwareSweep:
+    """
+    Frequency sweeps stepped by the SynthHD itself instead of setting the synth and
+    power meter frequency over USB for every point. The linear sweep of a SynthHD
+    channel is programmed once per sweep power and stepped by a pulse train that
+    also triggers the NRP50S, which buffers one reading per pulse, settle seconds
+    after it. A whole sweep costs a handful of host transactions: the sweep power,
+    arming synth and meter, waiting and a single FETCH?.
+
+    dwell has to cover settle plus the meter aperture times its average count. The
+    meter stays at one reference frequency during a sweep, its frequency response
+    relative to the reference is measured once with measure_correction() and added
+    to the readings.
+    """
+
+    def __init__(
+        self,
+        synthd,
+        power_meter: NRP50S,
+        trigger,
+        rf_out: int = 0,
+        dwell: float = 10e-3,
+        settle: float = 2e-3,
+        trigger_source: str = "EXT1",
+        reference_frequency: Optional[float] = None,
+    ):
+        if settle >= dwell:
+            raise ValueError(f"settle time {settle} s not shorter than dwell {dwell} s")
+        self.synthd = synthd
+        self.power_meter = power_meter
+        self.trigger = trigger
+        self.rf_out = rf_out
+        self.dwell = dwell
+        self.settle = settle
+        self.trigger_source = trigger_source
+        self.reference_frequency = reference_frequency
+        # (frequencies [Hz], meter reading at frequency - at reference [dB])
+        self.correction: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        # sweep registers written by this process, only changes are written
+        self.registers: Dict[str, Any] = {}
+
+    def reference(self, frequencies: Sequence[float]) -> float:
+        if self.reference_frequency is not None:
+            return self.reference_frequency
+        return float((frequencies[0] + frequencies[-1]) / 2)
+
+    def _write(self, name: str, value: Any):
+        if self.registers.get(name) != value:
+            self.synthd[self.rf_out].write(name, value)
+            self.registers[name] = value
+
+    def program(self, frequencies: Sequence[float], power: float):
+        low, high, step = linear_table(frequencies)
+        if self.registers.get("trigger_mode") != "single frequency step":
+            self.synthd.trigger_mode = "single frequency step"
+            self.registers["trigger_mode"] = "single frequency step"
+        self._write("sweep_type", 0)
+        self._write("sweep_direction", 1)
+        self._write("sweep_freq_low", low)
+        self._write("sweep_freq_high", high)
+        self._write("sweep_freq_step", step)
+        self._write("sweep_time_step", max(self.dwell * 1e3, 4.0))
+        self._write("sweep_power_low", float(power))
+        self._write("sweep_power_high", float(power))
+
+    def sweep(self, frequencies: Sequence[float], power: float) -> np.ndarray:
+        # meter readings [dBm] at frequencies [Hz] for SynthHD setpoint power [dBm]
+        frequencies = np.asarray(frequencies, float)
+        count = len(frequencies)
+        self.program(frequencies, power)
+        self.power_meter.frequency = self.reference(frequencies)
+        self.power_meter.arm(count, self.trigger_source, self.settle)
+        self.synthd[self.rf_out].write("sweep_single", True)
+
+        timeout = count * self.dwell + 5.0
+        self.trigger.fire(count, 1 / self.dwell)
+        self.trigger.wait(timeout)
+        self.power_meter.wait(timeout)
+        readings = self.power_meter.fetch_buffer()
+        if len(readings) != count:
+            raise RuntimeError(f"{count} trigger pulses but {len(readings)} readings")
+
+        if self.correction is not None:
+            readings = readings + np.interp(frequencies, *self.correction)
+        return readings
+
+    def measure_correction(
+        self, frequencies: Sequence[float], power: float = 0.0, count: int = 5
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # stepped once over frequencies: the difference between readings with the
+        # meter at the synth frequency and at the reference frequency
+        frequencies = np.asarray(frequencies, float)
+        reference = self.reference(frequencies)
+        channel = self.synthd[self.rf_out]
+        channel.power = power
+        channel.enable = True
+        correction = np.empty(len(frequencies))
+        for i, frequency in enumerate(frequencies):
+            channel.frequency = frequency
+            self.power_meter.frequency = frequency
+            at_frequency, _ = self.power_meter.measure(count)
+            self.power_meter.frequency = reference
+            at_reference, _ = self.power_meter.measure(count)
+            correction[i] = at_frequency - at_reference
+        self.correction = (frequencies, correction)
+        return self.correction
+
+    def scan(
+        self,
+        frequencies: Sequence[float],
+        powers: Sequence[float],
+        repeat: int = 1,
+        fname: Optional[Union[str, Path]] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> np.ndarray:
+        """
+        Frequency x power calibration scan, one sweep per power (averaged over
+        repeat sweeps). Returns rows of frequency [Hz], setpoint [dBm] and reading
+        [dBm] in the order of the *_scan.csv files. With fname, the rows of each
+        sweep are streamed to it as soon as the sweep is done.
+        """
+        frequencies = np.asarray(frequencies, float)
+        powers = np.asarray(powers, float)
+        readings = np.empty((len(frequencies), len(powers)))
+        writer = None
+        if fname is not None:
+            metadata = dict(
+                metadata or {},
+                mode="hardware sweep",
+                dwell=self.dwell,
+                settle=self.settle,
+                repeat=repeat,
+                reference_frequency=self.reference(frequencies),
+                frequency_corrected=self.correction is not None,
+            )
+            writer = ResultsWriter(fname, scan_header, metadata)
+
+        channel = self.synthd[self.rf_out]
+        channel.power = powers[0]
+        channel.enable = True
+        try:
+            for j, power in enumerate(powers):
+                readings[:, j] = np.mean(
+                    [self.sweep(frequencies, power) for _ in range(repeat)], axis=0
+                )
+                if writer is not None:
+                    # every sweep is on disk before the next one starts
+                    writer.write_rows(
+                        [[f, power, r] for f, r in zip(frequencies, readings[:, j])]
+                    )
+                    writer.flush()
+                if progress is not None:
+                    progress(j + 1, len(powers))
+        except BaseException:
+            if writer is not None:
+                writer.close(complete=False)
+            raise
+        finally:
+            channel.power = -20
+            channel.enable = False
+
+        if writer is not None:
+            writer.close()
+        f, p = np.meshgrid(frequencies, powers, indexing="ij")
+        return np.column_stack([f.ravel(), p.ravel(), readings.ravel()])
@@ -0,0 +1,90 @@
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+from SPD3303X import SPD3303X, snapshot_dtype
+
+
+class TelemetryPoller:
+    """
+    Samples SPD3303X.snapshot() of every supply at a fixed rate into a preallocated
+    ring buffer per supply. Each supply is polled from its own thread, so a slow
+    supply does not reduce the rate of the others; the drivers only lock per
+    command, so control code on the same supply waits for at most one query.
+    """
+
+    def __init__(
+        self,
+        supplies: Dict[str, SPD3303X],
+        rate: float = 5.0,
+        capacity: int = 3600 * 5,
+        measure_power: bool = False,
+    ):
+        self.supplies = supplies
+        self.period = 1 / rate
+        self.measure_power = measure_power
+        self.buffers = dict(
+            (name, RingBuffer(capacity, snapshot_dtype)) for name in supplies
+        )
+        # samples skipped because a snapshot took longer than the period
+        self.overruns = dict((name, 0) for name in supplies)
+        self.errors = dict((name, 0) for name in supplies)
+        self.last_error: Dict[str, Optional[Exception]] = dict(
+            (name, None) for name in supplies
+        )
+        self._stop = threading.Event()
+        self._threads: Dict[str, threading.Thread] = {}
+
+    def _poll(self, name: str):
+        supply = self.supplies[name]
+        buffer = self.buffers[name]
+        t_next = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                buffer.append(supply.snapshot(self.measure_power))
+            except Exception as e:
+                self.errors[name] += 1
+                self.last_error[name] = e
+
+            # schedule on a fixed grid so the rate doesn't drift, skip samples
+            # that can't be taken in time
+            t_next += self.period
+            t = time.perf_counter()
+            if t > t_next:
+                missed = int((t - t_next) / self.period) + 1
+                self.overruns[name] += missed
+                t_next += missed * self.period
+            self._stop.wait(t_next - t)
+
+    def start(self) -> "TelemetryPoller":
+        self._stop.clear()
+        for name in self.supplies:
+            thread = threading.Thread(
+                target=self._poll, args=(name,), name=f"telemetry {name}", daemon=True
+            )
+            self._threads[name] = thread
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads.values():
+            thread.join()
+        self._threads.clear()
+
+    def __enter__(self) -> "TelemetryPoller":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def latest(self, name: str) -> Optional[np.void]:
+        buffer = self.buffers[name]
+        return buffer.latest(1)[0] if len(buffer) else None
+
+    def data(self, name: str) -> np.ndarray:
+        # all samples held for a supply, oldest first
+        return self.buffers[name].array()
@@ -0,0 +1,266 @@
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from calibration_chain import CalibrationChain
+from drift_monitor import RollingStats
+from NRP50S import NRP50S
+from ring_buffer import RingBuffer
+from SPD3303X import SPD3303X
+
+loop_dtype = np.dtype(
+    [
+        ("time", "<f8"),
+        ("reading", "<f4"),
+        ("error", "<f4"),
+        ("vg", "<f4"),
+        ("jacobian", "<f4"),
+        # time since the previous iteration and time taken by this one [s]
+        ("period", "<f4"),
+        ("latency", "<f4"),
+    ]
+)
+
+
+class VgController:
+    """
+    Closed loop control of the output power of one 26.7 GHz amplifier by trimming
+    its gate voltage |Vg| (psu_vg_5pos channel amplifier + 1) from power meter
+    readings. Each iteration takes a damped Newton step with d output / d Vg of
+    the calibration at the present operating point, so the feedback only corrects
+    the error of the calibration. Steps are limited to max_step and Vg never leaves
+    vg_limits. Changes of the target or the amplifier input power are fed forward
+    through the calibration immediately.
+
+    Without a period the loop runs back to back, as fast as the meter and supply
+    allow; the period and latency of every iteration are recorded. After a failed
+    iteration the loop waits error_backoff seconds.
+    """
+
+    def __init__(
+        self,
+        psu_vg_5pos: SPD3303X,
+        power_meter: NRP50S,
+        chain: CalibrationChain,
+        amplifier: int,
+        target: float,
+        input_power: float,
+        vg: Optional[float] = None,
+        vg_limits: Optional[Tuple[float, float]] = None,
+        gain: float = 0.5,
+        max_step: float = 0.02,
+        deadband: float = 0.0,
+        count: int = 1,
+        period: float = 0.0,
+        error_backoff: float = 0.1,
+        capacity: int = 100000,
+        window: int = 1000,
+    ):
+        if not chain.has_vg:
+            raise ValueError(f"the {chain.system} amplifiers have no gate voltage")
+        self.supply = psu_vg_5pos
+        self.power_meter = power_meter
+        self.chain = chain
+        self.amplifier = amplifier
+        self.channel = amplifier + 1
+        self.target = target
+        self.input_power = input_power
+        self.vg_min, self.vg_max = chain.vg_range if vg_limits is None else vg_limits
+        self.gain = gain
+        self.max_step = max_step
+        self.deadband = deadband
+        self.count = count
+        self.period = period
+        self.error_backoff = error_backoff
+
+        if vg is None:
+            vg = getattr(psu_vg_5pos, f"ch{self.channel}_voltage_setpoint")
+        if not self.vg_min <= vg <= self.vg_max:
+            raise ValueError(
+                f"Vg {vg} V outside of the limits {self.vg_min} to {self.vg_max} V"
+            )
+        self.vg = float(vg)
+
+        self.history = RingBuffer(capacity, loop_dtype)
+        self.period_stats = RollingStats(window)
+        self.latency_stats = RollingStats(window)
+        self.iterations = 0
+        # iterations with Vg held at a limit
+        self.limited = 0
+        self.overruns = 0
+        self.errors = 0
+        self.last_error: Optional[Exception] = None
+        self.lock = threading.RLock()
+        self._t_last: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def jacobian(
+        self, vg: float, input_power: float, dv: float = 0.01, dp: float = 0.1
+    ) -> Tuple[float, float]:
+        # (d output / d Vg [dB/V], d output / d input [dB/dB]) of the calibration,
+        # central differences shrink to one sided ones at the edge of the grid,
+        # a fitted calibration has exact derivatives
+        if self.chain.fitted:
+            d_input, d_vg = self.chain.amplifier_gradient(
+                input_power, vg, self.amplifier
+            )
+            return float(d_vg), float(d_input)
+        vg_range = self.chain.vg_range
+        v = np.clip([vg - dv, vg + dv], *vg_range)
+        p = np.array([input_power - dp, input_power + dp])
+        output = self.chain.amplifier_power(
+            np.concatenate([[input_power] * 2, p]),
+            np.concatenate([v, [vg] * 2]),
+            self.amplifier,
+        )
+        return (
+            float((output[1] - output[0]) / (v[1] - v[0])),
+            float((output[3] - output[2]) / (p[1] - p[0])),
+        )
+
+    def apply(self, vg: float) -> float:
+        # write a gate voltage clamped to the hard limits, returns the voltage set
+        vg = float(np.clip(vg, self.vg_min, self.vg_max))
+        if vg != self.vg:
+            self.supply.voltage_setpoint(vg, self.channel)
+            self.vg = vg
+        return vg
+
+    def feed_forward(self, d_output: float):
+        # change Vg for a predicted change of the output [dB]
+        slope, _ = self.jacobian(self.vg, self.input_power)
+        if np.isfinite(slope) and slope != 0:
+            self.apply(self.vg - d_output / slope)
+
+    def set_target(self, target: float):
+        with self.lock:
+            d_target = target - self.target
+            self.target = target
+            self.feed_forward(-d_target)
+
+    def set_input_power(self, input_power: float):
+        # the amplifier input power [dBm] changed, e.g. a new SynthHD setpoint
+        with self.lock:
+            _, slope = self.jacobian(self.vg, self.input_power)
+            d_input = input_power - self.input_power
+            self.input_power = input_power
+            if np.isfinite(slope):
+                self.feed_forward(slope * d_input)
+
+    def step(self) -> np.void:
+        t_start = time.perf_counter()
+        with self.lock:
+            reading = float(self.power_meter.acquire(self.count).mean())
+            error = self.target - reading
+            slope, _ = self.jacobian(self.vg, self.input_power)
+
+            if abs(error) <= self.deadband:
+                delta = 0.0
+            elif np.isfinite(slope) and abs(slope) > 1e-3:
+                delta = self.gain * error / slope
+            else:
+                # no usable model, the output increases towards smaller |Vg|
+                delta = -np.sign(error) * self.max_step
+            delta = float(np.clip(delta, -self.max_step, self.max_step))
+            vg = self.apply(self.vg + delta)
+            if delta != 0 and vg in (self.vg_min, self.vg_max):
+                self.limited += 1
+
+            t_stop = time.perf_counter()
+            period = np.nan if self._t_last is None else t_start - self._t_last
+            self._t_last = t_start
+            row = np.array(
+                (
+                    time.time(),
+                    reading,
+                    error,
+                    vg,
+                    slope,
+                    period,
+                    t_stop - t_start,
+                ),
+                loop_dtype,
+            )[()]
+            self.history.append(row)
+            self.period_stats.update(period)
+            self.latency_stats.update(t_stop - t_start)
+            self.iterations += 1
+        return row
+
+    def _run(self):
+        self._t_last = None
+        t_next = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                # the gate voltage is held at its last value; a step failing at once
+                # (e.g. the meter unplugged) is not retried in a busy loop
+                self.errors += 1
+                self.last_error = e
+                self._stop.wait(self.error_backoff)
+
+            if self.period > 0:
+                t_next += self.period
+                t = time.perf_counter()
+                if t > t_next:
+                    missed = int((t - t_next) / self.period) + 1
+                    self.overruns += missed
+                    t_next += missed * self.period
+                self._stop.wait(t_next - t)
+
+    def start(self) -> "VgController":
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"vg controller {self.channel}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "VgController":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def statistics(self) -> Dict[str, Dict[str, float]]:
+        # rolling loop timing over the last window iterations, the standard
+        # deviation of the period is the jitter
+        with self.lock:
+            period = self.period_stats.summary()
+            return dict(
+                [
+                    ("period", period),
+                    ("latency", self.latency_stats.summary()),
+                    (
+                        "loop",
+                        dict(
+                            [
+                                ("iterations", self.iterations),
+                                (
+                                    "rate",
+                                    (
+                                        1 / period["mean"]
+                                        if period["mean"] > 0
+                                        else math.nan
+                                    ),
+                                ),
+                                ("jitter", period["std"]),
+                                ("limited", self.limited),
+                                ("overruns", self.overruns),
+                                ("errors", self.errors),
+                            ]
+                        ),
+                    ),
+                ]
+            )
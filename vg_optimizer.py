@@ -0,0 +1,359 @@
+import argparse
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from scipy.interpolate import RegularGridInterpolator
+
+from calibration import (
+    amplifier_synth_frequency,
+    amplifier_synthesizer,
+    file_date,
+    file_path,
+    grid_2D,
+    interpolator_2D,
+    load_calibration_arrays,
+    source_stat_key,
+)
+from calibration_chain import CalibrationChain, load_calibration_chain
+from measurement_store import read_source
+
+# Vg1 x Vg2 scans of the 26.7 GHz amplifiers at a fixed SynthHD setpoint, the number
+# is the amplifier at the power meter; the drain supply powers both amplifiers
+joint_pattern = re.compile(r"_vg(\d)_vg\d_scan_both\.csv$")
+joint_setpoint = 0.0
+# gate voltage of the other amplifier during the single amplifier calibrations,
+# pinched off
+reference_vg = 1.5
+
+front_dtype = np.dtype(
+    [
+        ("vg1", "<f8"),
+        ("vg2", "<f8"),
+        # objective, output of amplifier 1 and 2 [dBm]
+        ("output", "<f8"),
+        ("a1", "<f8"),
+        ("a2", "<f8"),
+        # drain supply power and half the difference between the joint scans [W]
+        ("dc_power", "<f8"),
+        ("dc_spread", "<f8"),
+    ]
+)
+
+# "min" is the weaker of the two outputs, "total" their sum
+objectives = ("min", "total", "A1", "A2")
+
+
+def joint_files(path: Path = file_path) -> Dict[int, Path]:
+    # amplifier (0, 1) -> most recent joint scan
+    found: Dict[int, Tuple[Tuple[int, ...], Path]] = {}
+    for fname in sorted(path.glob("measurements */data/*_scan_both.csv")):
+        match = joint_pattern.search(fname.name)
+        if match is None:
+            continue
+        amplifier = int(match[1]) - 1
+        date = file_date(fname.name)
+        if amplifier not in found or date >= found[amplifier][0]:
+            found[amplifier] = (date, fname)
+    return dict((amplifier, fname) for amplifier, (_, fname) in found.items())
+
+
+def joint_stat_key(path: Path = file_path) -> Tuple:
+    stat_key = []
+    for fname in joint_files(path).values():
+        stat = fname.stat()
+        stat_key.append((str(fname), stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(stat_key))
+
+
+def pareto_front(output: np.ndarray, cost: np.ndarray) -> np.ndarray:
+    # indices of the points no other point beats in both a higher output and a
+    # lower cost, by increasing cost
+    candidates = np.flatnonzero(np.isfinite(output) & np.isfinite(cost))
+    order = candidates[np.lexsort((-output[candidates], cost[candidates]))]
+    best = np.maximum.accumulate(output[order])
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = best[1:] > best[:-1]
+    return order[keep]
+
+
+class VgOptimizer:
+    """
+    Joint operating points (Vg1, Vg2) of the two 26.7 GHz amplifiers, trading the
+    output power for the drain supply power. The single amplifier calibrations of
+    the chain give the output at any input power. The joint scans add the
+    coupling between the amplifiers through the shared drain supply: the output
+    with both gates set relative to the output with the other amplifier pinched
+    off, as it was during the calibrations. The drain power is the mean of the
+    joint scans, which disagree by a few W in places, shifted by its change with
+    the input power in the calibration scans. The coupling is measured at one
+    input power and assumed to hold at the others.
+
+    Gate voltages are magnitudes, like in the calibration. Pareto fronts are
+    cached per input power, rounded to resolution [dB].
+    """
+
+    def __init__(
+        self,
+        chain: CalibrationChain,
+        vg1: np.ndarray,
+        vg2: np.ndarray,
+        joint_power: List[np.ndarray],
+        joint_dc_power: List[np.ndarray],
+        drain_power: List[RegularGridInterpolator],
+        reference_input: float,
+        vg_step: Optional[float] = None,
+        resolution: float = 0.01,
+        max_cached: int = 256,
+    ):
+        if not chain.has_vg:
+            raise ValueError(f"the {chain.system} amplifiers have no gate voltage")
+        self.chain = chain
+        self.drain_power = drain_power
+        self.reference_input = reference_input
+        self.resolution = resolution
+        self.max_cached = max_cached
+        self._fronts: Dict[Tuple[int, str], np.ndarray] = {}
+
+        if vg_step is None:
+            self.vg1, self.vg2 = vg1, vg2
+        else:
+            # descending like the scans
+            self.vg1, self.vg2 = (
+                np.linspace(vg.max(), vg.min(), int(round(np.ptp(vg) / vg_step)) + 1)
+                for vg in (vg1, vg2)
+            )
+        v1, v2 = np.meshgrid(self.vg1, self.vg2, indexing="ij")
+        self.v = (v1.ravel(), v2.ravel())
+
+        # output with both gates set minus the output with the other amplifier at
+        # reference_vg, per amplifier
+        self.coupling = []
+        for amplifier, power in enumerate(joint_power):
+            fn = RegularGridInterpolator((vg1, vg2), power)
+            reference = list(self.v)
+            reference[1 - amplifier] = np.full(len(v1.ravel()), reference_vg)
+            self.coupling.append(
+                fn(np.stack(self.v, axis=-1)) - fn(np.stack(reference, axis=-1))
+            )
+        # drain power of the joint scans, their mean and half their difference
+        dc_power = np.stack(joint_dc_power)
+        points = np.stack(self.v, axis=-1)
+        self.joint_dc_power = RegularGridInterpolator(
+            (vg1, vg2), dc_power.mean(axis=0)
+        )(points)
+        self.dc_spread = RegularGridInterpolator(
+            (vg1, vg2), np.ptp(dc_power, axis=0) / 2
+        )(points)
+
+    def evaluate(self, input_power: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (amplifier 1 output, amplifier 2 output [dBm], drain power [W]) on the
+        # flattened vg1 x vg2 grid
+        outputs = []
+        dc_power = self.joint_dc_power.copy()
+        for amplifier in range(2):
+            vg = self.v[amplifier]
+            outputs.append(
+                self.chain.amplifier_power(input_power, vg, amplifier)
+                + self.coupling[amplifier]
+            )
+            drain = self.drain_power[amplifier]
+            dc_power += drain(np.stack(np.broadcast_arrays(input_power, vg), -1))
+            dc_power -= drain(
+                np.stack(np.broadcast_arrays(self.reference_input, vg), -1)
+            )
+        return outputs[0], outputs[1], dc_power
+
+    def objective(self, a1: np.ndarray, a2: np.ndarray, objective: str) -> np.ndarray:
+        if objective == "min":
+            return np.minimum(a1, a2)
+        if objective == "total":
+            return 10 * np.log10(10 ** (a1 / 10) + 10 ** (a2 / 10))
+        if objective == "A1":
+            return a1
+        if objective == "A2":
+            return a2
+        raise ValueError(f"objective {objective} not one of {', '.join(objectives)}")
+
+    def front(self, input_power: float, objective: str = "min") -> np.ndarray:
+        # Pareto optimal operating points by increasing drain power, front_dtype
+        key = (int(round(input_power / self.resolution)), objective)
+        if key not in self._fronts:
+            a1, a2, dc_power = self.evaluate(key[0] * self.resolution)
+            output = self.objective(a1, a2, objective)
+            idx = pareto_front(output, dc_power)
+            front = np.empty(len(idx), front_dtype)
+            front["vg1"], front["vg2"] = self.v[0][idx], self.v[1][idx]
+            front["output"] = output[idx]
+            front["a1"], front["a2"] = a1[idx], a2[idx]
+            front["dc_power"] = dc_power[idx]
+            front["dc_spread"] = self.dc_spread[idx]
+            if len(self._fronts) >= self.max_cached:
+                self._fronts.pop(next(iter(self._fronts)))
+            self._fronts[key] = front
+        return self._fronts[key]
+
+    def sensitivity(
+        self, input_power: float, vg1: npt.ArrayLike, vg2: npt.ArrayLike
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (d A1 / d Vg1, d A2 / d Vg2 [dB/V]) of the fitted calibration, how
+        # precisely the gates have to be set; the coupling is taken as constant
+        d_vg = []
+        for amplifier, vg in enumerate((vg1, vg2)):
+            d_vg.append(self.chain.amplifier_gradient(input_power, vg, amplifier)[1])
+        return d_vg[0], d_vg[1]
+
+    def operating_point(
+        self,
+        input_power: float,
+        target: Optional[float] = None,
+        max_dc_power: Optional[float] = None,
+        objective: str = "min",
+    ) -> Optional[np.void]:
+        # least drain power reaching target, or most output within max_dc_power,
+        # or both; the highest output without either. None if not reachable
+        front = self.front(input_power, objective)
+        if max_dc_power is not None:
+            front = front[front["dc_power"] <= max_dc_power]
+        if target is not None:
+            front = front[front["output"] >= target]
+            return front[0] if len(front) else None
+        return front[-1] if len(front) else None
+
+
+def build_vg_optimizer(
+    path: Path = file_path, fitted: bool = False, vg_step: Optional[float] = None
+) -> VgOptimizer:
+    arrays = load_calibration_arrays(path)
+    chain = load_calibration_chain("26_7", path, fitted=fitted)
+
+    files = joint_files(path)
+    if sorted(files) != [0, 1]:
+        raise ValueError(
+            f"joint Vg1 x Vg2 scans of both amplifiers not found in {path}"
+        )
+    axes = []
+    joint_power = []
+    joint_dc_power = []
+    for amplifier in range(2):
+        data = read_source(files[amplifier], path)
+        vg1, vg2, power = grid_2D(data, [0, 1, 2])
+        axes.append((vg1, vg2))
+        joint_power.append(power)
+        joint_dc_power.append(grid_2D(data, [0, 1, 4])[2])
+    # both scans on the same gate voltages
+    (vg1, vg2), (other_vg1, other_vg2) = axes
+    if not (np.array_equal(vg1, other_vg1) and np.array_equal(vg2, other_vg2)):
+        raise ValueError(
+            f"the gate voltages of {files[1].name} differ from those of"
+            f" {files[0].name}"
+        )
+
+    # drain power of the calibration scans, on the input power axis of the
+    # calibration
+    drain_power = []
+    for amplifier in range(2):
+        name = f"26_7_A{amplifier + 1}"
+        data = read_source(path / str(arrays[f"{name}/source"]), path)
+        _, vg, drain = grid_2D(data, [0, 1, 4])
+        drain_power.append(
+            RegularGridInterpolator(
+                (arrays[f"{name}/x"], vg),
+                drain,
+                bounds_error=False,
+                fill_value=np.nan,
+            )
+        )
+
+    # SynthHD output during the joint scans, converted like the calibration
+    reference_input = float(
+        interpolator_2D(arrays, amplifier_synthesizer)(
+            [amplifier_synth_frequency["26_7"], joint_setpoint]
+        )[0]
+    )
+    return VgOptimizer(
+        chain,
+        vg1,
+        vg2,
+        joint_power,
+        joint_dc_power,
+        drain_power,
+        reference_input,
+        vg_step,
+    )
+
+
+@lru_cache(maxsize=4)
+def _load_vg_optimizer(
+    stat_key: Tuple, path: Path, fitted: bool, vg_step: Optional[float]
+) -> VgOptimizer:
+    return build_vg_optimizer(path, fitted, vg_step)
+
+
+def load_vg_optimizer(
+    path: Path = file_path, fitted: bool = False, vg_step: Optional[float] = None
+) -> VgOptimizer:
+    # kept in memory, with the cached fronts, until one of the scans changes
+    stat_key = (source_stat_key(path), joint_stat_key(path))
+    return _load_vg_optimizer(stat_key, path, fitted, vg_step)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Pareto optimal (output power, drain power) gate voltages of the 26.7 GHz"
+            " amplifiers"
+        )
+    )
+    parser.add_argument("power", type=float, help="SynthHD setpoint [dBm]")
+    parser.add_argument("--synth", default="SN416")
+    parser.add_argument("--output", default="RFB")
+    parser.add_argument(
+        "--input", action="store_true", help="power is the amplifier input [dBm]"
+    )
+    parser.add_argument("--objective", choices=objectives, default="min")
+    parser.add_argument("--target", type=float, help="output power [dBm]")
+    parser.add_argument("--max-dc-power", type=float, help="drain power [W]")
+    parser.add_argument("--vg-step", type=float, help="gate voltage step [V]")
+    parser.add_argument(
+        "--fitted",
+        action="store_true",
+        help="use the fitted calibration, shows the gate sensitivity [dB/V]",
+    )
+    args = parser.parse_args()
+
+    optimizer = load_vg_optimizer(fitted=args.fitted, vg_step=args.vg_step)
+    if args.input:
+        input_power = args.power
+    else:
+        input_power = float(
+            optimizer.chain.synth_power(args.synth, args.output, args.power)
+        )
+    print(f"amplifier input {input_power:.2f} dBm")
+    print(
+        f"{'Vg1 [V]':>8} {'Vg2 [V]':>8} {args.objective + ' [dBm]':>12}"
+        f" {'A1 [dBm]':>9} {'A2 [dBm]':>9} {'DC [W]':>7} {'+- [W]':>6}"
+        + (f" {'dA1/dVg1':>12} {'dA2/dVg2':>12}" if args.fitted else "")
+    )
+    if args.target is not None or args.max_dc_power is not None:
+        point = optimizer.operating_point(
+            input_power, args.target, args.max_dc_power, args.objective
+        )
+        points = [] if point is None else [point]
+    else:
+        points = list(optimizer.front(input_power, args.objective))
+    for point in points:
+        line = (
+            f"{point['vg1']:>8.3f} {point['vg2']:>8.3f} {point['output']:>12.2f}"
+            f" {point['a1']:>9.2f} {point['a2']:>9.2f} {point['dc_power']:>7.2f}"
+            f" {point['dc_spread']:>6.2f}"
+        )
+        if args.fitted:
+            d1, d2 = optimizer.sensitivity(input_power, point["vg1"], point["vg2"])
+            line += f" {float(d1):>12.1f} {float(d2):>12.1f}"
+        print(line)
+    if not points:
+        print("not reachable")
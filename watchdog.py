@@ -0,0 +1,528 @@
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from drift_monitor import RollingStats
+from ring_buffer import RingBuffer
+from SPD3303X import SPD3303X, snapshot_dtype
+from stop_26GHz import disable_26GHz_power
+from stop_40GHz import disable_40GHz_power
+
+# (supply, channel) switched off in this order when the stop sequence of a band
+# fails, the drain before the gates
+emergency_outputs = dict(
+    [
+        (
+            "26_7",
+            [
+                ("psu_12pos_vd_5neg", 2),
+                ("psu_vg_5pos", 1),
+                ("psu_vg_5pos", 2),
+                ("psu_vg_5pos", 3),
+            ],
+        ),
+        ("40", [("psu_a_5pos", 3), ("psu_a_5pos", 1), ("psu_a_5pos", 2)]),
+    ]
+)
+
+
+class Envelope(NamedTuple):
+    # limits of one measured quantity ("voltage" or "current") of a supply channel,
+    # crossing them shuts down band ("26_7" or "40")
+    name: str
+    supply: str
+    channel: int
+    quantity: str
+    low: float = -math.inf
+    high: float = math.inf
+    band: str = "26_7"
+    # only checked while this (supply, channel) measures above active_above [V]
+    while_on: Optional[Tuple[str, int]] = None
+    active_above: float = 1.0
+
+
+def default_envelopes() -> List[Envelope]:
+    # the setpoints of startup_26GHz.py and startup_40GHz.py; the current limits
+    # are below the supply current setpoints (3.2 A drain, 0.07 A gates, 2.5 A
+    # 40 GHz), which would hold a runaway instead of showing it
+    drain = ("psu_12pos_vd_5neg", 2)
+    envelopes = [
+        Envelope("drain voltage 26 GHz", *drain, "voltage", high=6.3),
+        Envelope("drain current 26 GHz", *drain, "current", high=3.0),
+    ]
+    for channel in (1, 2):
+        # a gate rail dropping out while the drain is on opens the TGA4536
+        # channel; |Vg| is 0.5 V to 1.5 V in use
+        envelopes += [
+            Envelope(
+                f"gate {channel} voltage 26 GHz",
+                "psu_vg_5pos",
+                channel,
+                "voltage",
+                low=0.45,
+                high=1.55,
+                while_on=drain,
+            ),
+            Envelope(
+                f"gate {channel} current 26 GHz",
+                "psu_vg_5pos",
+                channel,
+                "current",
+                high=0.05,
+                while_on=drain,
+            ),
+            Envelope(
+                f"amplifier {channel} voltage 40 GHz",
+                "psu_a_5pos",
+                channel,
+                "voltage",
+                high=12.6,
+                band="40",
+            ),
+            Envelope(
+                f"amplifier {channel} current 40 GHz",
+                "psu_a_5pos",
+                channel,
+                "current",
+                high=2.3,
+                band="40",
+            ),
+        ]
+    return envelopes
+
+
+def record_dict(record: np.void) -> Dict[str, Optional[float]]:
+    # JSON friendly, quantities that were not read are None
+    return dict(
+        (name, None if math.isnan(record[name]) else float(record[name]))
+        for name in record.dtype.names
+    )
+
+
+class Watchdog:
+    """
+    Checks the SPD3303X channels against per rail voltage and current envelopes and
+    shuts a band down with its ordered stop sequence when a limit is crossed. Each
+    supply is read from its own thread every period, only the quantities the
+    envelopes need, so a limit crossing starts the shutdown within period plus
+    one read cycle. That bound is not guaranteed, a read can wait for another user
+    of the session, so cycles exceeding max_latency are counted as late and
+    max_late late cycles in a row shut down the bands of the supply, as do
+    max_errors failed reads in a row.
+
+    Envelopes conditional on a channel of another supply are checked once that
+    supply has been read. A gate rail that dropped out while the drain is on can't
+    pinch off its amplifier, so then, and if the stop sequence fails, the outputs
+    are switched off directly, drain first. Trips are appended to a JSON lines log
+    with the triggering sample and the recent samples of every supply; errors
+    writing it are counted with the supply's errors. A tripped band is ignored
+    until reset().
+    """
+
+    def __init__(
+        self,
+        supplies: Dict[str, SPD3303X],
+        envelopes: Optional[List[Envelope]] = None,
+        period: float = 0.1,
+        max_latency: float = 0.5,
+        max_errors: int = 3,
+        max_late: Optional[int] = 3,
+        log: Optional[Path] = None,
+        history: int = 50,
+        timeout: float = 2.0,
+        shutdowns: Optional[Dict[str, Callable[[], None]]] = None,
+    ):
+        self.supplies = supplies
+        envelopes = default_envelopes() if envelopes is None else envelopes
+        # envelopes of supplies not given can't be checked
+        self.envelopes = [e for e in envelopes if e.supply in supplies]
+        self.period = period
+        self.max_latency = max_latency
+        self.max_errors = max_errors
+        self.max_late = max_late
+        self.log = log
+        self.timeout = timeout
+        self.shutdowns = self.default_shutdowns() if shutdowns is None else shutdowns
+
+        # (channel, quantity) read per supply
+        self.reads: Dict[str, List[Tuple[int, str]]] = dict(
+            (name, []) for name in supplies
+        )
+        for envelope in self.envelopes:
+            self.reads[envelope.supply].append((envelope.channel, envelope.quantity))
+            if envelope.while_on is not None and envelope.while_on[0] in supplies:
+                supply, channel = envelope.while_on
+                self.reads[supply].append((channel, "voltage"))
+        for name, reads in self.reads.items():
+            self.reads[name] = sorted(set(reads))
+
+        self.buffers = dict(
+            (name, RingBuffer(history, snapshot_dtype)) for name in supplies
+        )
+        self.cycle_stats = dict((name, RollingStats(1000)) for name in supplies)
+        self.cycles = dict((name, 0) for name in supplies)
+        self.late = dict((name, 0) for name in supplies)
+        self.errors = dict((name, 0) for name in supplies)
+        self.last_error: Dict[str, Optional[Exception]] = dict(
+            (name, None) for name in supplies
+        )
+        self.trips: List[Dict[str, Any]] = []
+        self.tripped: Dict[str, threading.Event] = dict(
+            (envelope.band, threading.Event()) for envelope in self.envelopes
+        )
+        self.lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: Dict[str, threading.Thread] = {}
+        self._shutdown_threads: List[threading.Thread] = []
+
+    def default_shutdowns(self) -> Dict[str, Callable[[], None]]:
+        shutdowns: Dict[str, Callable[[], None]] = {}
+        supplies = self.supplies
+        if "psu_vg_5pos" in supplies and "psu_12pos_vd_5neg" in supplies:
+            shutdowns["26_7"] = lambda: disable_26GHz_power(
+                supplies["psu_vg_5pos"], supplies["psu_12pos_vd_5neg"], self.timeout
+            )
+        if "psu_a_5pos" in supplies:
+            shutdowns["40"] = lambda: disable_40GHz_power(
+                supplies["psu_a_5pos"], self.timeout
+            )
+        return shutdowns
+
+    def read(self, name: str) -> np.void:
+        supply = self.supplies[name]
+        record = np.full((), np.nan, dtype=snapshot_dtype)
+        record["time"] = time.time()
+        for channel, quantity in self.reads[name]:
+            record[f"ch{channel}_{quantity}"] = getattr(supply, quantity)(channel)
+        return record[()]
+
+    def latest(self, supply: str) -> Optional[np.void]:
+        # latest reading of a supply, None before the first
+        buffer = self.buffers[supply]
+        if not len(buffer):
+            return None
+        return buffer.latest(1)[0]
+
+    def condition_on(self, envelope: Envelope, name: str, record: np.void) -> bool:
+        # whether the while_on channel of an envelope of supply name is on; readings
+        # of another supply are up to one period older than record, so on or stale
+        # readings are confirmed by reading the channel again, a failed read counts
+        # as on
+        supply, channel = envelope.while_on
+        if supply == name:
+            return record[f"ch{channel}_voltage"] > envelope.active_above
+        latest = None if supply not in self.supplies else self.latest(supply)
+        if latest is None:
+            # not watched yet
+            return False
+        age = float(record["time"] - latest["time"])
+        if latest[f"ch{channel}_voltage"] <= envelope.active_above:
+            if age <= self.max_latency:
+                return False
+        try:
+            return self.supplies[supply].voltage(channel) > envelope.active_above
+        except Exception as e:
+            self.errors[supply] += 1
+            self.last_error[supply] = e
+            return True
+
+    def check(self, name: str, record: np.void) -> List[Tuple[Envelope, float]]:
+        # (envelope, value) of the limits a sample of supply name crosses
+        violations = []
+        for envelope in self.envelopes:
+            if envelope.supply != name or self.tripped[envelope.band].is_set():
+                continue
+            value = float(record[f"ch{envelope.channel}_{envelope.quantity}"])
+            if envelope.low <= value <= envelope.high:
+                continue
+            if envelope.while_on is None or self.condition_on(envelope, name, record):
+                violations.append((envelope, value))
+        return violations
+
+    def cycle(self, name: str, consecutive_errors: int) -> int:
+        # read and check one supply, returns the number of failed reads in a row
+        try:
+            record = self.read(name)
+        except Exception as e:
+            self.errors[name] += 1
+            self.last_error[name] = e
+            consecutive_errors += 1
+            if consecutive_errors >= self.max_errors:
+                self.trip_supply(name, f"{name} not readable: {e!r}")
+            return consecutive_errors
+
+        self.buffers[name].append(record)
+        for envelope, value in self.check(name, record):
+            limit = envelope.low if value < envelope.low else envelope.high
+            reason = (
+                f"{envelope.name}: {value:.4g} outside of"
+                f" {envelope.low:.4g} to {envelope.high:.4g}"
+            )
+            self.trip(envelope.band, reason, record, name, envelope, limit)
+        return 0
+
+    def trip_supply(self, name: str, reason: str):
+        # shut down every band with an envelope on supply name
+        for band in set(e.band for e in self.envelopes if e.supply == name):
+            self.trip(band, reason, None, name)
+
+    def _poll(self, name: str):
+        consecutive_errors = 0
+        consecutive_late = 0
+        t_next = time.perf_counter()
+        while not self._stop.is_set():
+            t_start = time.perf_counter()
+            try:
+                consecutive_errors = self.cycle(name, consecutive_errors)
+            except Exception as e:
+                # keep watching, e.g. after a failed trip
+                self.errors[name] += 1
+                self.last_error[name] = e
+
+            cycle = time.perf_counter() - t_start
+            self.cycle_stats[name].update(cycle)
+            self.cycles[name] += 1
+            # a limit crossed just after a read is seen one period and one cycle
+            # later
+            if self.period + cycle > self.max_latency:
+                self.late[name] += 1
+                consecutive_late += 1
+                if self.max_late is not None and consecutive_late >= self.max_late:
+                    try:
+                        self.trip_supply(
+                            name,
+                            f"{name}: {consecutive_late} read cycles in a row over"
+                            f" the reaction time budget of {self.max_latency} s,"
+                            f" last {cycle:.3f} s",
+                        )
+                    except Exception as e:
+                        self.errors[name] += 1
+                        self.last_error[name] = e
+            else:
+                consecutive_late = 0
+
+            t_next += self.period
+            t = time.perf_counter()
+            if t > t_next:
+                t_next = t
+            self._stop.wait(t_next - t)
+
+    def trip(
+        self,
+        band: str,
+        reason: str,
+        record: Optional[np.void],
+        supply: str,
+        envelope: Optional[Envelope] = None,
+        limit: Optional[float] = None,
+    ):
+        t_detect = time.time()
+        with self.lock:
+            if self.tripped[band].is_set():
+                return
+            self.tripped[band].set()
+            event = dict(
+                [
+                    ("event", "trip"),
+                    ("time", t_detect),
+                    ("band", band),
+                    ("reason", reason),
+                    ("supply", supply),
+                    ("envelope", None if envelope is None else envelope._asdict()),
+                    ("limit", limit),
+                    ("sample", None if record is None else record_dict(record)),
+                    (
+                        "detection_latency",
+                        None if record is None else t_detect - float(record["time"]),
+                    ),
+                ]
+            )
+            self.trips.append(event)
+
+        # a gate rail that dropped out can't pinch off its amplifier, the drain is
+        # switched off at once instead of after the gates
+        ordered = not (
+            envelope is not None
+            and envelope.while_on is not None
+            and limit == envelope.low
+        )
+        # shut down first, the log is written while the sequence runs
+        line = dict(event)
+        thread = threading.Thread(
+            target=self._shutdown, args=(band, event, ordered), name=f"shutdown {band}"
+        )
+        thread.start()
+        self._shutdown_threads.append(thread)
+        line["history"] = dict(
+            (name, [record_dict(r) for r in buffer.array()])
+            for name, buffer in self.buffers.items()
+        )
+        self.write_log(line, supply)
+
+    def outputs_off(self, band: str) -> List[str]:
+        # switch the outputs of a band off in the emergency order, returns the
+        # errors
+        errors = []
+        for supply, channel in emergency_outputs.get(band, []):
+            if supply not in self.supplies:
+                continue
+            try:
+                self.supplies[supply].output(False, channel)
+            except Exception as e:
+                errors.append(f"{supply} CH{channel} off: {e!r}")
+        return errors
+
+    def _shutdown(self, band: str, event: Dict[str, Any], ordered: bool = True):
+        t_start = time.perf_counter()
+        errors = []
+        if ordered:
+            try:
+                if band not in self.shutdowns:
+                    raise ValueError(f"no shutdown sequence for {band}")
+                self.shutdowns[band]()
+            except Exception as e:
+                errors.append(repr(e))
+        if not ordered or errors:
+            errors += self.outputs_off(band)
+        if errors:
+            self.errors[event["supply"]] += 1
+            self.last_error[event["supply"]] = RuntimeError(
+                f"shutdown {band}: {'; '.join(errors)}"
+            )
+        result = dict(
+            [
+                ("event", "shutdown"),
+                ("time", time.time()),
+                ("band", band),
+                ("duration", time.perf_counter() - t_start),
+                ("ordered", ordered),
+                ("errors", errors),
+            ]
+        )
+        event["shutdown"] = result
+        self.write_log(result, event["supply"])
+
+    def write_log(self, event: Dict[str, Any], supply: str):
+        # a log that can't be written counts as an error of supply, the trip and
+        # the shutdown go ahead
+        if self.log is None:
+            return
+        try:
+            with self._log_lock, open(self.log, "a") as f:
+                f.write(json.dumps(event, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            self.errors[supply] += 1
+            self.last_error[supply] = e
+
+    def reset(self, band: str):
+        # watch a band again, e.g. after it was powered up anew
+        self.tripped[band].clear()
+
+    def wait_shutdowns(self, timeout: Optional[float] = None):
+        for thread in list(self._shutdown_threads):
+            thread.join(timeout)
+
+    def start(self) -> "Watchdog":
+        self._stop.clear()
+        for name in self.supplies:
+            if not self.reads[name]:
+                continue
+            thread = threading.Thread(
+                target=self._poll, args=(name,), name=f"watchdog {name}", daemon=True
+            )
+            self._threads[name] = thread
+            thread.start()
+        return self
+
+    def stop(self):
+        # running shutdowns are completed
+        self._stop.set()
+        for thread in self._threads.values():
+            thread.join()
+        self._threads.clear()
+        self.wait_shutdowns()
+
+    def __enter__(self) -> "Watchdog":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def statistics(self) -> Dict[str, Dict[str, float]]:
+        # read cycle time per supply over the last 1000 cycles, and the worst case
+        # time from a limit crossing to the start of the shutdown
+        statistics = {}
+        for name in self.supplies:
+            cycle = self.cycle_stats[name].summary()
+            statistics[name] = dict(
+                [
+                    ("cycles", self.cycles[name]),
+                    ("cycle_mean", cycle["mean"]),
+                    ("cycle_max", cycle["max"]),
+                    ("latency_bound", self.period + cycle["max"]),
+                    ("late", self.late[name]),
+                    ("errors", self.errors[name]),
+                ]
+            )
+        return statistics
+
+
+if __name__ == "__main__":
+    from instrument_server import open_instrument
+
+    parser = argparse.ArgumentParser(
+        description="Shut the amplifiers down when a supply rail leaves its limits"
+    )
+    parser.add_argument(
+        "--log", type=Path, default=Path("watchdog.jsonl"), help="trip log"
+    )
+    parser.add_argument("--period", type=float, default=0.1, help="poll period [s]")
+    parser.add_argument(
+        "--max-latency", type=float, default=0.5, help="reaction time budget [s]"
+    )
+    parser.add_argument(
+        "--max-late",
+        type=int,
+        default=3,
+        help="late read cycles in a row that shut the bands of a supply down",
+    )
+    args = parser.parse_args()
+
+    # sessions are shared through instrument_server.py if it is running; the
+    # watchdog reads interleave with the commands of other clients, a read waits
+    # for at most one command, not for a whole settle() or acquisition
+    supplies = dict(
+        (name, open_instrument(name))
+        for name in ["psu_vg_5pos", "psu_12pos_vd_5neg", "psu_a_5pos"]
+    )
+    with Watchdog(
+        supplies,
+        period=args.period,
+        max_latency=args.max_latency,
+        max_late=args.max_late,
+        log=args.log,
+    ) as watchdog:
+        try:
+            while True:
+                time.sleep(60)
+                for name, stats in watchdog.statistics().items():
+                    print(
+                        f"{time.strftime('%Y-%m-%dT%H:%M:%S')} {name}"
+                        f" latency bound {stats['latency_bound'] * 1e3:.0f} ms,"
+                        f" {stats['late']} late, {stats['errors']} errors"
+                    )
+                for band, tripped in watchdog.tripped.items():
+                    if tripped.is_set():
+                        print(f"{band} tripped")
+        except KeyboardInterrupt:
+            pass